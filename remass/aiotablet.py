@@ -0,0 +1,156 @@
+"""Asyncio facade for the (blocking) TabletConnection."""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from remass.filesystem import RCollection, RDirEntry, RDocument
+from remass.tablet import DeviceStatus, TabletConnection
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class AsyncTabletConnection(object):
+    """Awaitable counterpart of TabletConnection.
+
+    Paramiko is blocking, thus every operation is dispatched to a thread pool.
+    The underlying transport (and the SFTP session pool) is shared, so several
+    operations may run concurrently from a single event loop.
+
+    Cancelling an awaiting task cancels the operation if it hasn't started
+    yet. Renderings and file transfers are also aborted while they are
+    running (checked upon each progress update). All other operations can't
+    be interrupted once they're running on the tablet, i.e. the awaiting
+    task is cancelled immediately, but the operation itself finishes in the
+    background.
+
+    Like TabletConnection, a closed facade can be opened again.
+    """
+    def __init__(self, config, max_workers: int = 4, connection: TabletConnection = None):
+        self._connection = TabletConnection(config) if connection is None else connection
+        self._max_workers = max_workers
+        self._executor = None
+
+    @property
+    def connection(self) -> TabletConnection:
+        """The wrapped (blocking) connection."""
+        return self._connection
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _run(self, func: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix='remass-async')
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def _cancellable_callback(
+            self, progress_cb: Callable[[float], None],
+            description: str) -> Tuple[Callable[[float], None], threading.Event]:
+        """Returns a progress callback for the worker threads, which forwards
+        the progress to the event loop, and the event to cancel the operation.
+        Raising from within the progress callback is the only way to abort
+        a running operation."""
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+
+        def _progress(percentage: float) -> None:
+            if cancelled.is_set():
+                raise OperationCancelled(f'{description} was cancelled')
+            if progress_cb is not None:
+                loop.call_soon_threadsafe(progress_cb, percentage)
+        return _progress, cancelled
+
+    async def _run_cancellable(self, cancelled: threading.Event, func: Callable, *args, **kwargs):
+        try:
+            return await self._run(func, *args, **kwargs)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def open(self) -> None:
+        await self._run(self._connection.open)
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+    async def is_connected(self) -> bool:
+        return await self._run(self._connection.is_connected)
+
+    async def get_device_status(self) -> DeviceStatus:
+        return await self._run(self._connection.get_device_status)
+
+    async def get_free_space_kb(self, location: str) -> int:
+        return await self._run(self._connection.get_free_space_kb, location)
+
+    async def get_filesystem(
+            self) -> Tuple[RCollection, RCollection, Dict[str, RDirEntry]]:
+        return await self._run(self._connection.get_filesystem)
+
+    async def render_document(
+            self, rm_file: RDocument, output_filename: str,
+            progress_cb: Callable[[float], None] = None, **kwargs) -> None:
+        """Renders the document. The optional progress_cb will be invoked
+        within the event loop. kwargs will be passed to rmrl.render()"""
+        progress, cancelled = self._cancellable_callback(progress_cb, f"Rendering '{rm_file.uuid}'")
+        await self._run_cancellable(
+            cancelled, self._connection.render_document, rm_file, output_filename,
+            progress, **kwargs)
+
+    async def download_thumbnail(
+            self, rm_file: RDocument, output_basename: str,
+            dpi: int = 20) -> str:
+        return await self._run(
+            self._connection.download_thumbnail, rm_file, output_basename, dpi)
+
+    async def download_file(
+            self, remote_filename: str, local_filename: str,
+            progress_cb: Callable[[float], None] = None, *args, **kwargs) -> bool:
+        """See TabletConnection.download_file, the optional progress_cb will
+        be invoked within the event loop. A cancelled download can be
+        resumed later on."""
+        progress, cancelled = self._cancellable_callback(progress_cb, f'Downloading "{remote_filename}"')
+        return await self._run_cancellable(
+            cancelled, self._connection.download_file, remote_filename, local_filename,
+            progress, *args, **kwargs)
+
+    async def upload_file(
+            self, local_filename: str, remote_filename: str,
+            progress_cb: Callable[[float], None] = None, *args, **kwargs) -> bool:
+        """See TabletConnection.upload_file, the optional progress_cb will be
+        invoked within the event loop. A cancelled upload can be resumed
+        later on."""
+        progress, cancelled = self._cancellable_callback(progress_cb, f'Uploading "{local_filename}"')
+        return await self._run_cancellable(
+            cancelled, self._connection.upload_file, local_filename, remote_filename,
+            progress, *args, **kwargs)
+
+    async def upload_files(
+            self, files: List[Tuple[str, str]], *args,
+            progress_cb: Callable[[float], None] = None, **kwargs) -> List[str]:
+        """See TabletConnection.upload_files, the optional progress_cb will be
+        invoked within the event loop."""
+        progress, cancelled = self._cancellable_callback(progress_cb, f'Uploading {len(files)} files')
+        return await self._run_cancellable(
+            cancelled, self._connection.upload_files, files, *args,
+            progress_cb=progress, **kwargs)
+
+    async def download_templates(self, dst_folder: str) -> None:
+        await self._run(self._connection.download_templates, dst_folder)
+
+    async def restart_ui(self) -> None:
+        await self._run(self._connection.restart_ui)
+
+    async def reboot_tablet(self) -> None:
+        await self._run(self._connection.reboot_tablet)
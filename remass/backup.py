@@ -0,0 +1,209 @@
+"""Backups of the tablet's documents (xochitl files)."""
+import logging
+import os
+import posixpath
+import shutil
+import stat
+import tarfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Dict
+import paramiko
+from remass import transfer
+from remass.filesystem import REMOTE_XOCHITL_DIR
+
+
+@dataclass
+class BackupStats(object):
+    transferred_files: int = 0
+    transferred_bytes: int = 0
+    skipped_files: int = 0
+    deleted_files: int = 0
+
+
+def _local_path(folder: str, relative_path: str) -> str:
+    return os.path.join(folder, *relative_path.split('/'))
+
+
+def list_remote_tree(
+        sftp_session: Callable[[], AbstractContextManager],
+        remote_dir: str,
+        executor: ThreadPoolExecutor) -> Dict[str, paramiko.SFTPAttributes]:
+    """Recursively lists all regular files below remote_dir. Subfolders are
+    listed concurrently.
+    :sftp_session: returns a context manager which provides an SFTP session
+    :return: dict{path relative to remote_dir (posix): attributes}
+    """
+    def _list(relative_dir: str):
+        with sftp_session() as sftp:
+            return relative_dir, sftp.listdir_attr(posixpath.join(remote_dir, relative_dir))
+
+    files = dict()
+    pending = {executor.submit(_list, '')}
+    while len(pending) > 0:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            relative_dir, entries = future.result()
+            for attr in entries:
+                relative_path = posixpath.join(relative_dir, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    pending.add(executor.submit(_list, relative_path))
+                elif stat.S_ISREG(attr.st_mode):
+                    files[relative_path] = attr
+    return files
+
+
+def _remove_stale(dst_folder: str, files: Dict[str, paramiko.SFTPAttributes]) -> int:
+    """Deletes all local files (and empty folders) which no longer exist on
+    the tablet. Partial downloads of existing files are kept."""
+    num_deleted = 0
+    for dirpath, dirnames, filenames in os.walk(dst_folder, topdown=False):
+        relative_dir = os.path.relpath(dirpath, dst_folder).replace(os.sep, '/')
+        for fn in filenames:
+            relative_path = fn if relative_dir == '.' else f'{relative_dir}/{fn}'
+            if transfer.partial_transfer_target(relative_path) in files:
+                continue
+            if relative_path not in files:
+                os.remove(os.path.join(dirpath, fn))
+                num_deleted += 1
+        if dirpath != dst_folder and len(os.listdir(dirpath)) == 0:
+            os.rmdir(dirpath)
+    return num_deleted
+
+
+def backup_xochitl(
+        sftp_session: Callable[[], AbstractContextManager], dst_folder: str,
+        max_workers: int = 4, delete: bool = True,
+        progress_cb: Callable[[float], None] = None) -> BackupStats:
+    """Mirrors the tablet's xochitl folder into dst_folder (rsync-style).
+
+    Only files which are new or differ in size/modification time from the
+    previous backup (i.e. the local copy) will be transferred, using
+    max_workers concurrent (pipelined) SFTP sessions. Since downloaded files
+    get the remote modification time, the local folder itself is the state
+    of the previous backup. The result can be loaded via
+    load_local_filesystem(dst_folder).
+    :sftp_session: returns a context manager which provides an SFTP session
+    :delete: if True, local files which no longer exist on the tablet will
+             be removed
+    :progress_cb: optional callback, invoked with the progress in percent
+                  (of the bytes to be transferred)
+    """
+    stats = BackupStats()
+    os.makedirs(dst_folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        files = list_remote_tree(sftp_session, REMOTE_XOCHITL_DIR, executor)
+        changed = list()
+        for relative_path, attr in files.items():
+            if transfer.is_transferred(_local_path(dst_folder, relative_path), attr):
+                stats.skipped_files += 1
+            else:
+                changed.append((relative_path, attr))
+        total_bytes = sum(attr.st_size for _, attr in changed)
+        lock = threading.Lock()
+
+        def _download(relative_path: str, attr: paramiko.SFTPAttributes) -> None:
+            local_filename = _local_path(dst_folder, relative_path)
+            os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+            with sftp_session() as sftp:
+                transfer.download(
+                    sftp, posixpath.join(REMOTE_XOCHITL_DIR, relative_path),
+                    local_filename, attr=attr)
+            with lock:
+                stats.transferred_files += 1
+                stats.transferred_bytes += attr.st_size
+                if progress_cb is not None:
+                    progress_cb(100.0 if total_bytes == 0 else 100.0 * stats.transferred_bytes / total_bytes)
+
+        # Start with the largest files, so that the workers finish at roughly
+        # the same time
+        changed.sort(key=lambda entry: entry[1].st_size, reverse=True)
+        futures = [executor.submit(_download, relative_path, attr)
+                   for relative_path, attr in changed]
+        for future in futures:
+            future.result()
+    if delete:
+        stats.deleted_files = _remove_stale(dst_folder, files)
+    logging.getLogger(__name__).info(
+        f'Backed up xochitl to "{dst_folder}": {stats.transferred_files} files '
+        f'({stats.transferred_bytes / 2**20:.1f} MB) transferred, '
+        f'{stats.skipped_files} unchanged, {stats.deleted_files} deleted.')
+    return stats
+
+
+def tar_backup_cmd(compression: str = 'none') -> str:
+    """Returns the shell command which streams the xochitl folder as a tar
+    archive to stdout."""
+    cmd = f'/bin/tar -c -f - -C "{REMOTE_XOCHITL_DIR}" .'
+    return cmd + ' | /bin/gzip -c' if _check_compression(compression) == 'gzip' else cmd
+
+
+def tar_restore_cmd(compression: str = 'none') -> str:
+    """Returns the shell command which extracts a tar archive from stdin into
+    the xochitl folder."""
+    cmd = f'/bin/tar -x -f - -C "{REMOTE_XOCHITL_DIR}"'
+    return '/bin/gzip -d -c | ' + cmd if _check_compression(compression) == 'gzip' else cmd
+
+
+def _check_compression(compression: str) -> str:
+    if compression not in ('gzip', 'none'):
+        raise ValueError(f"Unsupported compression '{compression}', must be 'gzip' or 'none'")
+    return compression
+
+
+def archive_compression(filename: str) -> str:
+    """Returns the compression of the archive ('gzip' or 'none'), determined
+    by its file extension, or None if the filename is not a tar archive."""
+    fn = filename.lower()
+    if fn.endswith('.tar.gz') or fn.endswith('.tgz'):
+        return 'gzip'
+    if fn.endswith('.tar'):
+        return 'none'
+    return None
+
+
+class _CountingReader(object):
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self.num_bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.num_bytes += len(data)
+        return data
+
+
+def receive_tar_stream(stream: BinaryIO, dst: str, compression: str) -> int:
+    """Stores the tar stream as archive file (if dst is a .tar, .tar.gz or
+    .tgz filename) or extracts it on-the-fly into the folder dst.
+    :return: number of received bytes
+    """
+    reader = _CountingReader(stream)
+    if archive_compression(dst) is not None:
+        with open(dst, 'wb') as f:
+            shutil.copyfileobj(reader, f, transfer.TRANSFER_CHUNK_SIZE)
+        return reader.num_bytes
+    os.makedirs(dst, exist_ok=True)
+    mode = 'r|gz' if _check_compression(compression) == 'gzip' else 'r|'
+    with tarfile.open(fileobj=reader, mode=mode, bufsize=transfer.TRANSFER_CHUNK_SIZE) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(dst, filter='data')
+        else:
+            tar.extractall(dst)
+    return reader.num_bytes
+
+
+def send_tar_stream(src: str, stream: BinaryIO, compression: str) -> None:
+    """Writes the archive file src as is, or the contents of the folder src
+    as tar archive (compressed on-the-fly) to the stream."""
+    if archive_compression(src) is not None:
+        with open(src, 'rb') as f:
+            shutil.copyfileobj(f, stream, transfer.TRANSFER_CHUNK_SIZE)
+        return
+    mode = 'w|gz' if _check_compression(compression) == 'gzip' else 'w|'
+    with tarfile.open(fileobj=stream, mode=mode, bufsize=transfer.TRANSFER_CHUNK_SIZE) as tar:
+        # Skip partial downloads
+        tar.add(src, arcname='.',
+                filter=lambda info: None if transfer.partial_transfer_target(info.name) is not None else info)
@@ -1,7 +1,10 @@
 """Application configuration."""
 
 import logging
-from typing import Tuple
+import re
+import threading
+import time
+from typing import List, Optional, Tuple
 import appdirs
 import os
 import toml
@@ -12,32 +15,136 @@ import platform
 APP_NAME = 'remass'
 
 
-def _backup_filename(filename: str, backup_folder: str, return_latest: bool) -> str:
-    froot, fext = os.path.splitext(filename)
-    _, fname = os.path.split(froot)
-    prev = None
-    bpath = os.path.join(backup_folder, f'{fname:s}{fext:s}.bak')
-    cnt = 1
-    while os.path.exists(bpath):
-        prev = bpath
-        bpath = os.path.join(backup_folder, f'{fname:s}{fext:s}.{cnt:d}.bak')
-        cnt += 1
-    if return_latest:
-        return prev
-    else:
-        return bpath
+# Backups are numbered as "name.ext.bak", "name.ext.1.bak", "name.ext.2.bak", ...
+_BACKUP_PATTERN = re.compile(r'(.+?)(?:\.(\d+))?\.bak')
+
+
+class BackupCatalog(object):
+    """Index of the numbered backups within a folder. The folder is scanned
+    once (and only again if its modification time changes), so looking up
+    the latest backup or the next backup filename doesn't probe the file
+    system."""
+    def __init__(self, backup_folder: str):
+        self.folder = backup_folder
+        self._lock = threading.Lock()
+        self._mtime_ns = None
+        # {filename: sorted list of backup numbers}
+        self._index = dict()
+
+    def _refresh(self, force: bool = False) -> None:
+        try:
+            mtime_ns = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if not force and mtime_ns is not None and mtime_ns == self._mtime_ns:
+            return
+        index = dict()
+        if mtime_ns is not None:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    match = _BACKUP_PATTERN.fullmatch(entry.name)
+                    if match is not None and entry.is_file():
+                        number = 0 if match.group(2) is None else int(match.group(2))
+                        index.setdefault(match.group(1), list()).append(number)
+        for numbers in index.values():
+            numbers.sort()
+        self._index, self._mtime_ns = index, mtime_ns
+
+    def _numbers(self, filename: str, force_refresh: bool = False) -> List[int]:
+        with self._lock:
+            self._refresh(force_refresh)
+            return self._index.get(os.path.basename(filename), list())
+
+    def _filename(self, filename: str, number: int) -> str:
+        fname = os.path.basename(filename)
+        return os.path.join(self.folder, f'{fname:s}.bak' if number == 0 else f'{fname:s}.{number:d}.bak')
+
+    def backups(self, filename: str) -> List[str]:
+        """Returns all backups of the file, sorted from oldest to newest."""
+        return [self._filename(filename, n) for n in self._numbers(filename)]
+
+    def latest(self, filename: str) -> Optional[str]:
+        """Returns the most recent backup of the file (or None)."""
+        numbers = self._numbers(filename)
+        if len(numbers) > 0 and not os.path.exists(self._filename(filename, numbers[-1])):
+            # Removed within the resolution of the folder's modification time
+            numbers = self._numbers(filename, force_refresh=True)
+        return self._filename(filename, numbers[-1]) if len(numbers) > 0 else None
+
+    def next_filename(self, filename: str) -> str:
+        """Returns a non-existing filename to back up the file, i.e. the
+        successor of the latest backup."""
+        numbers = self._numbers(filename)
+        next_filename = self._filename(filename, numbers[-1] + 1 if len(numbers) > 0 else 0)
+        if os.path.exists(next_filename):
+            # Created within the resolution of the folder's modification time
+            numbers = self._numbers(filename, force_refresh=True)
+            next_filename = self._filename(filename, numbers[-1] + 1)
+        return next_filename
+
+    def prune(self, filename: str, keep_latest: int = 0, keep_days: int = 0) -> List[str]:
+        """Deletes old backups of the file. A backup is kept if it is one of
+        the latest keep_latest backups or younger than keep_days (0 disables
+        the respective rule). The most recent backup is always kept.
+        :return: the deleted filenames
+        """
+        if keep_latest <= 0 and keep_days <= 0:
+            return list()
+        backups = self.backups(filename)
+        min_mtime = time.time() - keep_days * 86400
+        deleted = list()
+        for idx, bak in enumerate(backups[:-1]):
+            if keep_latest > 0 and idx >= len(backups) - keep_latest:
+                continue
+            if keep_days > 0 and os.path.getmtime(bak) >= min_mtime:
+                continue
+            os.remove(bak)
+            deleted.append(bak)
+        if len(deleted) > 0:
+            logging.getLogger(__name__).info(
+                f"Pruned {len(deleted)} backups of '{os.path.basename(filename)}' in '{self.folder}'")
+        return deleted
+
+
+_BACKUP_CATALOGS = dict()
+_BACKUP_CATALOGS_LOCK = threading.Lock()
+
+
+def backup_catalog(backup_folder: str) -> BackupCatalog:
+    """Returns the (shared) backup catalog of the given folder."""
+    folder = os.path.abspath(backup_folder)
+    with _BACKUP_CATALOGS_LOCK:
+        if folder not in _BACKUP_CATALOGS:
+            _BACKUP_CATALOGS[folder] = BackupCatalog(folder)
+        return _BACKUP_CATALOGS[folder]
 
 
 def next_backup_filename(filename: str, backup_folder: str) -> str:
     """Returns a non-existing filename to be used to back up the given file
     within the backup_folder"""
-    return _backup_filename(filename, backup_folder, False)
+    return backup_catalog(backup_folder).next_filename(filename)
 
 
 def latest_backup_filename(filename: str, backup_folder: str) -> str:
     """Returns the most recent backup of the original filename within
     the backup_folder"""
-    return _backup_filename(filename, backup_folder, True)
+    return backup_catalog(backup_folder).latest(filename)
+
+
+def prune_backups(filename: str, backup_folder: str, keep_latest: int = 0, keep_days: int = 0) -> List[str]:
+    """Deletes old backups of the given file, see BackupCatalog.prune()"""
+    return backup_catalog(backup_folder).prune(filename, keep_latest, keep_days)
+
+
+def connection_cache_filename() -> str:
+    """Returns the path to the cache which remembers the preferred host per
+    network."""
+    return os.path.join(appdirs.user_cache_dir(appname=APP_NAME), 'connections.json')
+
+
+def checksum_cache_filename() -> str:
+    """Returns the path to the cache of local file checksums."""
+    return os.path.join(appdirs.user_cache_dir(appname=APP_NAME), 'checksums.json')
 
 
 def abbreviate_user(path: str):
@@ -70,7 +177,9 @@ def setup_app_dir(folder: str) -> str:
         os.path.join(folder, 'templates'),
         os.path.join(folder, 'templates', 'backups'),
         os.path.join(folder, 'screens'),
-        os.path.join(folder, 'screens', 'backups')]
+        os.path.join(folder, 'screens', 'backups'),
+        os.path.join(folder, 'thumbnails'),
+        os.path.join(folder, 'snapshots')]
     for sf in subfolders:
         if not os.path.exists(sf):
             os.makedirs(sf)
@@ -122,7 +231,25 @@ class RemassConfig(object):
                 'keyfile': None,  # Path to the SSH private key
                 'password': None,  # If a keyfile is specified, pwd will be used to unlock it (otherwise, it will be used as the root's pwd)
                 'timeout': 1,  # SSH connection timeout in seconds
-                'port': 22  # If we ever need/want to adjust the connection port
+                'port': 22,  # If we ever need/want to adjust the connection port
+                'profile': 'auto',  # Transport tuning: 'usb', 'wifi', 'slow-link' or 'auto' (USB if host is 10.11.99.1, else Wi-Fi)
+                'keepalive': 5,  # Interval (in seconds) to send keepalive packets, 0 disables keepalives
+                'reconnect_attempts': 3,  # How often we try to reconnect if the connection drops during an operation
+                'reconnect_backoff': 1.0,  # Initial delay (in seconds) between reconnection attempts, doubled after each attempt
+                'metrics': False  # Collect per-operation metrics (latencies, transferred bytes, round trips)
+            },
+            'backups': {
+                'keep_latest': 0,  # Number of most recent backups (e.g. of templates.json) to keep, 0 keeps all
+                'keep_days': 0  # Backups younger than this (in days) will be kept, 0 disables this rule
+            },
+            'snapshots': {
+                'keep_daily': 90,  # Number of days for which we keep the latest snapshot of each day
+                'keep_weekly': 52,  # Number of weeks for which we keep the latest snapshot of each week
+                'keep_monthly': 24  # Number of months for which we keep the latest snapshot of each month
+            },
+            'fleet': {
+                'max_workers': 8,  # Maximum number of tablets to process concurrently
+                'devices': []  # List of tablets, each requires 'name' & 'host' (other connection parameters are optional)
             }
         }
         # Try to load from default (or overriden) config location:
@@ -151,6 +278,14 @@ class RemassConfig(object):
     def screen_backup_dir(self):
         return os.path.join(self.screen_dir, 'backups')
 
+    @property
+    def thumbnail_dir(self):
+        return os.path.join(self.app_dir, 'thumbnails')
+
+    @property
+    def snapshot_dir(self):
+        return os.path.join(self.app_dir, 'snapshots')
+
     def load(self, filename: str = None) -> None:
         dname, fname = config_filename(filename)
         ffn = os.path.join(dname, fname)
@@ -1,8 +1,16 @@
 import argparse
 import logging
+import os
+import tempfile
+import time
 from remass.tui import RATui
 from remass.tablet import TabletConnection
 from remass.config import RemassConfig
+from remass.filesystem import RCollection
+from remass.screens import FIT_MODES, convert_screens
+from remass.snapshots import SnapshotStore
+from remass.templates import generate_template_previews
+from remass.transport import TRANSPORT_PROFILES
 
 
 def parse_args():
@@ -18,6 +26,28 @@ def parse_args():
                         help='List all notebooks which contain "SEARCH" in their name.')
     parser.add_argument('--export', action='store', default=None, type=str, metavar='UUID',
                         help='Export the corresponding notebook.')
+    parser.add_argument('--benchmark', action='store', default=None, type=str, metavar='REMOTE_FILE',
+                        help='Measure the download throughput of REMOTE_FILE for each transport profile.')
+    parser.add_argument('--repeats', action='store', default=3, type=int,
+                        help='Number of downloads per profile for --benchmark.')
+    parser.add_argument('--backup', action='store', default=None, type=str, metavar='DST',
+                        help='Incrementally back up all documents (xochitl folder) into DST.')
+    parser.add_argument('--tar', action='store_true', default=False,
+                        help='For --backup: transfer all documents via a single tar stream. DST can also be a .tar/.tar.gz archive.')
+    parser.add_argument('--import', dest='import_files', action='store', nargs='+', default=None,
+                        type=str, metavar='FILE', help='Import the given PDF/EPUB files.')
+    parser.add_argument('--collection', action='store', default=None, type=str, metavar='NAME',
+                        help='For --import: name of the target collection (default: root).')
+    parser.add_argument('--snapshot', action='store_true', default=False,
+                        help='Create a deduplicated snapshot of all documents and prune old snapshots.')
+    parser.add_argument('--previews', action='store_true', default=False,
+                        help='Render missing/outdated PNG previews of the custom SVG templates.')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='For --previews: render all previews again.')
+    parser.add_argument('--screens', action='store', default=None, type=str, metavar='SRC',
+                        help='Convert all images within the folder SRC into splash screens (stored in the app\'s screens folder).')
+    parser.add_argument('--fit', action='store', default='letterbox', choices=FIT_MODES,
+                        help='For --screens: how to adjust the aspect ratio.')
     
     return parser.parse_args()
 
@@ -59,6 +89,88 @@ def export(args):
     connection.close()
 
 
+def benchmark_profiles(args):
+    """Downloads the given remote file via each transport profile and reports
+    the best observed throughput."""
+    cfg = RemassConfig(args)
+    print(f'Download throughput of "{args.benchmark}":')
+    print('--------------------')
+    for profile in TRANSPORT_PROFILES:
+        connection = TabletConnection({'connection': dict(cfg['connection'], profile=profile)})
+        connection.open()
+        durations = list()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_filename = os.path.join(temp_dir, 'benchmark')
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                connection.download_file(args.benchmark, local_filename, skip_identical=False)
+                durations.append(time.perf_counter() - start)
+            size_mb = os.path.getsize(local_filename) / 2**20
+        connection.close()
+        print(f'{profile:>10s}: {size_mb / min(durations):6.2f} MB/s '
+              f'(best of {args.repeats}, {size_mb:.1f} MB)')
+
+
+def backup(args):
+    def _print_progress(progress: float) -> None:
+        logging.info(f'Backed up {progress:.1f} %.')
+    cfg = RemassConfig(args)
+    connection = TabletConnection(cfg)
+    connection.open()
+    if args.tar:
+        connection.backup_xochitl_tar(args.backup)
+    else:
+        connection.backup_xochitl(args.backup, progress_cb=_print_progress)
+    connection.close()
+
+
+def import_files(args):
+    def _print_progress(progress: float) -> None:
+        logging.info(f'Imported {progress:.1f} %.')
+    cfg = RemassConfig(args)
+    connection = TabletConnection(cfg)
+    connection.open()
+    collection = None
+    if args.collection is not None:
+        _, _, dirent_dict = connection.get_filesystem()
+        matches = [d for d in dirent_dict.values()
+                   if isinstance(d, RCollection) and d.visible_name == args.collection]
+        if len(matches) == 0:
+            print(f'--> No such collection "{args.collection}"')
+            connection.close()
+            return
+        collection = matches[0]
+    uuids = connection.import_documents(args.import_files, collection, progress_cb=_print_progress)
+    print(f'Imported {len(uuids)} of {len(args.import_files)} documents (existing ones are skipped).')
+    connection.close()
+
+
+def snapshot(args):
+    cfg = RemassConfig(args)
+    store = SnapshotStore(cfg.snapshot_dir)
+    connection = TabletConnection(cfg)
+    connection.open()
+    connection.snapshot_xochitl(store)
+    connection.close()
+    deleted = store.prune(**cfg['snapshots'])
+    print(f'Snapshots in "{cfg.snapshot_dir}" (pruned {len(deleted)}):')
+    print('--------------------')
+    for s in store.list_snapshots():
+        print(f'{s.snapshot_id} {s.num_files:6d} files, {s.total_bytes / 2**20:8.1f} MB')
+
+
+def previews(args):
+    cfg = RemassConfig(args)
+    rendered = generate_template_previews(cfg.template_dir, force=args.force)
+    print(f'Rendered {len(rendered)} previews in "{cfg.template_dir}".')
+
+
+def screens(args):
+    cfg = RemassConfig(args)
+    converted = convert_screens(args.screens, cfg.screen_dir, fit=args.fit)
+    print(f'Converted {len(converted)} images into splash screens in "{cfg.screen_dir}".')
+
+
 if __name__ == '__main__':
     # Verbose logging heavily interferes with npyscreen. Thus, it is
     # restricted to warning/error levels in the main program. But in
@@ -69,3 +181,15 @@ if __name__ == '__main__':
         list_files(args, args.search)
     elif args.export is not None:
         export(args)
+    elif args.benchmark is not None:
+        benchmark_profiles(args)
+    elif args.backup is not None:
+        backup(args)
+    elif args.import_files is not None:
+        import_files(args)
+    elif args.snapshot:
+        snapshot(args)
+    elif args.previews:
+        previews(args)
+    elif args.screens is not None:
+        screens(args)
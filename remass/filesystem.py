@@ -4,11 +4,15 @@ Parses the xochitl files into a file system-like hierarchical data structure.
 For details on the tablet's file system, check the comprehensive summary on
 https://remarkablewiki.com/tech/filesystem
 """
+from collections import OrderedDict
 from dataclasses import dataclass, field
 import os
 import getpass
 import json
 import datetime
+import io
+import logging
+import tempfile
 from typing import Callable, ClassVar, Dict, List, Tuple, Type
 import paramiko
 from paramiko.util import ClosingContextManager
@@ -17,6 +21,8 @@ from pathlib import PurePosixPath
 from pdfrw.objects.pdfdict import IndirectPdfDict
 from rmrl import render
 from pdfrw import PdfReader, PdfWriter
+from pdf2image import convert_from_path
+from .pdfsubset import LazyPdfReader, resolve_page_selection
 
 
 REMOTE_XOCHITL_DIR = '/home/root/.local/share/remarkable/xochitl'
@@ -247,16 +253,13 @@ def load_local_filesystem(folder: str) -> Tuple[RCollection, RCollection, Dict[s
     return _filesystem_from_dirents(dirent_list)
 
 
-def load_remote_filesystem(client: paramiko.SSHClient) -> Tuple[RCollection, RCollection, Dict[str, RDirEntry]]:
-    """Loads the rM filesystem from the given remote connection.
+def load_remote_filesystem(sftp: paramiko.SFTPClient) -> Tuple[RCollection, RCollection, Dict[str, RDirEntry]]:
+    """Loads the rM filesystem via the given (open) SFTP session.
     
     :return: root, trash, and a dict{uuid: entry}
     """
-    sftp = client.open_sftp()
     dirent_list = _load_dirents_remote(sftp)
-    root, trash, dirent_dict = _filesystem_from_dirents(dirent_list)
-    sftp.close()
-    return root, trash, dirent_dict
+    return _filesystem_from_dirents(dirent_list)
 
 
 def is_rm_textfile(filename):
@@ -273,14 +276,35 @@ def is_rm_textfile(filename):
 
 
 class RemoteFile(ClosingContextManager):
-    def __init__(self, sftp_client, filename, mode, bufsize):
+    """Seekable, read-only view onto a remote (SFTP) file.
+
+    Instead of prefetching the whole file upon opening, we only fetch the
+    byte ranges which are actually requested. Data is transferred in blocks
+    of BLOCK_SIZE bytes (pipelined via SFTP readv) and kept in a small LRU
+    block cache, so that readers which seek back and forth (e.g. PDF readers
+    jumping between xref table and page objects) don't re-transfer data.
+    """
+    BLOCK_SIZE = 128 * 1024
+    # Maximum number of cached blocks, i.e. up to 32 MB per file
+    MAX_CACHED_BLOCKS = 256
+    # Number of blocks to read ahead if the file is accessed sequentially
+    READAHEAD_BLOCKS = 4
+
+    def __init__(self, sftp_client, filename, mode, bufsize, block_size: int = None):
+        """:block_size: overrides BLOCK_SIZE, smaller blocks reduce the
+                           overhead of scattered small reads"""
+        self.block_size = self.BLOCK_SIZE if block_size is None else block_size
         # We decode the byte streams only if the remote file is a known
         # (text-based) metadata/config/settings file
         self.decode = is_rm_textfile(filename)
         self.sftp_file = sftp_client.file(filename, mode, bufsize)
-        self.prefetch()
+        self._position = 0
+        self._size = None
+        self._blocks = OrderedDict()
+        self._last_read_end = None
 
     def close(self):
+        self._blocks.clear()
         self.sftp_file.close()
 
     def flush(self):
@@ -289,24 +313,130 @@ class RemoteFile(ClosingContextManager):
     def prefetch(self, file_size=None):
         self.sftp_file.prefetch(file_size)
 
+    @property
+    def size(self) -> int:
+        """Size of the remote file in bytes (queried once via stat)."""
+        if self._size is None:
+            self._size = self.sftp_file.stat().st_size
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self._position = position
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        """Reads up to len(buffer) bytes into the given writable buffer and
+        returns the number of bytes read."""
+        view = memoryview(buffer).cast('B')
+        data = self._read_range(self._position, len(view))
+        view[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
     def read(self, size=None):
-        # As of v1.0, we only needed to expose the read() interface to enable
-        # rendering the notebooks remotely (with correct template backgrounds).
-        # For the future, we might want to also override: 
-        # readable(), readinto(), readline(size=None), readlines(sizehint=None),
-        # readv(chunks) and seekable()
-        buf = self.sftp_file.read(size)
+        if size is None or size < 0:
+            size = max(0, self.size - self._position)
+        buf = self._read_range(self._position, size)
+        self._position += len(buf)
         if self.decode:
             return buf.decode('utf-8')
         else:
             return buf
 
+    def _read_range(self, offset: int, length: int) -> bytes:
+        """Returns the requested byte range, fetching missing blocks."""
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b''
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        if last - first + 1 > self.MAX_CACHED_BLOCKS:
+            # Large bulk read (e.g. a reader slurping the whole file), this
+            # would only thrash the cache. Thus, fetch it pipelined in one go.
+            self.sftp_file.seek(offset)
+            self.sftp_file.prefetch(offset + length)
+            self._last_read_end = offset + length
+            return self.sftp_file.read(length)
+        sequential = self._last_read_end == offset
+        self._last_read_end = offset + length
+        if sequential:
+            num_blocks = (self.size + self.block_size - 1) // self.block_size
+            self._fetch_blocks(range(first, min(num_blocks - 1, last + self.READAHEAD_BLOCKS) + 1))
+        else:
+            self._fetch_blocks(range(first, last + 1))
+        data = b''.join(self._blocks[idx] for idx in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + length]
+
+    def fetch_ranges(self, ranges: List[Tuple[int, int]]) -> None:
+        """Caches the given (offset, length) byte ranges. All missing blocks
+        are requested at once, i.e. pipelined instead of one round trip per
+        range."""
+        blocks = set()
+        for offset, length in ranges:
+            length = min(length, self.size - offset)
+            if length > 0:
+                blocks.update(range(offset // self.block_size,
+                                    (offset + length - 1) // self.block_size + 1))
+        self._fetch_blocks(sorted(blocks)[:self.MAX_CACHED_BLOCKS])
+
+    def _fetch_blocks(self, indices) -> None:
+        """Ensures that the given blocks are cached."""
+        missing = [idx for idx in indices if idx not in self._blocks]
+        for idx in indices:
+            if idx in self._blocks:
+                self._blocks.move_to_end(idx)
+        if len(missing) == 0:
+            return
+        chunks = [(idx * self.block_size,
+                   min(self.block_size, self.size - idx * self.block_size))
+                  for idx in missing]
+        for idx, data in zip(missing, self.sftp_file.readv(chunks)):
+            self._blocks[idx] = data
+        while len(self._blocks) > self.MAX_CACHED_BLOCKS:
+            self._blocks.popitem(last=False)
+
 
 class RemoteFileSystemSource(object):
-    def __init__(self, sftp_client, doc_id):
+    # Block size to read the base PDF, see _open_base_pdf
+    PDF_BLOCK_SIZE = 1024
+
+    def __init__(self, sftp_client, doc_id, page_selection=None):
+        """
+        :page_selection: if set, only the selected pages of the base PDF will
+                         be transferred (unselected pages are replaced by
+                         empty placeholders), see pdfsubset.py
+        """
         self.base_dir = PurePosixPath(REMOTE_XOCHITL_DIR)
         self.sftp_client = sftp_client
         self.doc_id = doc_id
+        # Selecting all pages (e.g. the export's default "*") needs no subset
+        if page_selection is not None and (1, -1) in page_selection:
+            page_selection = None
+        self.page_selection = page_selection
+        # Number of base PDF pages and (0-based) indices of the placeholders
+        self.num_pages = None
+        self.placeholder_pages = set()
+        self._pdf_subset = None
 
     def format_name(self, name):
         return str(self.base_dir / name.format(ID=self.doc_id))
@@ -315,8 +445,35 @@ class RemoteFileSystemSource(object):
         # Paramiko SFTPFile only returns bytes but rmrl requires strings for
         # text files. Thus, we use our RemoteFile wrapper
         # return self.sftp_client.file(self.format_name(fn), mode, bufsize)
+        if fn == '{ID}.pdf' and self.page_selection is not None:
+            return self._open_base_pdf(mode, bufsize)
         return RemoteFile(self.sftp_client, self.format_name(fn), mode, bufsize)
 
+    def _open_base_pdf(self, mode, bufsize):
+        """Returns the subset of the base PDF which contains only the
+        selected pages. Falls back to the (lazily read) full PDF if it cannot
+        be subset, e.g. if it's encrypted."""
+        if self._pdf_subset is not None:
+            return io.BytesIO(self._pdf_subset)
+        # Page objects are scattered across the file, thus we use small
+        # blocks to avoid transferring the content in between.
+        remote = RemoteFile(self.sftp_client, self.format_name('{ID}.pdf'), mode, bufsize,
+                            block_size=self.PDF_BLOCK_SIZE)
+        try:
+            reader = LazyPdfReader(remote, remote.size)
+            selected = resolve_page_selection(self.page_selection, reader.num_pages)
+            if len(selected) < reader.num_pages:
+                self._pdf_subset = reader.subset(selected)
+                self.num_pages = reader.num_pages
+                self.placeholder_pages = set(range(reader.num_pages)) - selected
+        except Exception as e:
+            logging.getLogger(__name__).warning(f'Cannot subset base PDF of {self.doc_id}, transferring the whole file: {e}')
+        if self._pdf_subset is None:
+            remote.seek(0)
+            return remote
+        remote.close()
+        return io.BytesIO(self._pdf_subset)
+
     def exists(self, fn):
         try:
             self.sftp_client.stat(self.format_name(fn))
@@ -326,28 +483,93 @@ class RemoteFileSystemSource(object):
 
 
 def render_remote(
-        client: paramiko.SSHClient, rm_file: RDocument, output_filename: str,
+        sftp: paramiko.SFTPClient, rm_file: RDocument, output_filename: str,
         progress_cb: Callable[[float], None], **kwargs) -> bool:
-    """Uses the SSH connection to render the given notebook remotely."""
+    """Uses the (open) SFTP session to render the given notebook remotely."""
+    # If there are no annotations, rmrl returns the (lazily read) remote
+    # base PDF. Thus, the SFTP session must still be open while rendering.
+    return render_source(
+        RemoteFileSystemSource(sftp, rm_file.uuid, kwargs.get('page_selection', None)),
+        rm_file, output_filename, progress_cb, **kwargs)
+
+
+def render_source(
+        src, rm_file: RDocument, output_filename: str,
+        progress_cb: Callable[[float], None], **kwargs) -> bool:
+    """Renders the given notebook from the rmrl source (which must provide
+    format_name, open and exists)."""
     if progress_cb is None:
         progress_cb = lambda x: None
-    sftp = client.open_sftp()
-    src = RemoteFileSystemSource(sftp, rm_file.uuid)
     render_output = render(src, progress_cb=progress_cb, **kwargs)
-    sftp.close()
     pdf_stream = PdfReader(render_output)
     if pdf_stream is not None:
-        pdf_stream.Info = IndirectPdfDict(
+        info = IndirectPdfDict(
             Title=rm_file.visible_name,
             Author=getpass.getuser(),
             Subject='Exported Notes',
             Creator='reMass')
-        PdfWriter(output_filename, trailer=pdf_stream).write()
+        placeholders = getattr(src, 'placeholder_pages', set())
+        if len(placeholders) > 0 and len(pdf_stream.pages) == src.num_pages:
+            # The output still contains the empty placeholders of the
+            # unselected base PDF pages (e.g. if rmrl returned the base PDF)
+            writer = PdfWriter(output_filename)
+            writer.addpages([page for idx, page in enumerate(pdf_stream.pages)
+                             if idx not in placeholders])
+            writer.trailer.Info = info
+            writer.write()
+        else:
+            pdf_stream.Info = info
+            PdfWriter(output_filename, trailer=pdf_stream).write()
         return True
     else:
         return False
 
 
+def download_thumbnail_remote(
+        sftp: paramiko.SFTPClient, rm_file: RDocument, output_basename: str,
+        dpi: int = 20) -> str:
+    """Stores a thumbnail of the given document's first page.
+
+    Uses the tablet's own thumbnail (from the "{uuid}.thumbnails" folder) if
+    available. Otherwise, the first page will be rendered at a low DPI.
+    :output_basename: filename without extension, the suffix will be chosen
+                      depending on the thumbnail's image format
+    :return: filename of the stored thumbnail or None if it couldn't be created
+    """
+    thumb_dir = PurePosixPath(REMOTE_XOCHITL_DIR, f'{rm_file.uuid}.thumbnails')
+    try:
+        available = sorted(sftp.listdir(str(thumb_dir)))
+    except IOError:
+        available = list()
+    if len(available) > 0:
+        # Thumbnails are named by page UUID, thus we need the .content
+        # file to look up which one belongs to the first page
+        thumb_fn = available[0]
+        try:
+            with RemoteFile(sftp, str(PurePosixPath(REMOTE_XOCHITL_DIR, f'{rm_file.uuid}.content')), 'r', -1) as cf:
+                pages = json.loads(cf.read()).get('pages', [])
+            if len(pages) > 0:
+                thumb_fn = next((fn for fn in available if os.path.splitext(fn)[0] == pages[0]), thumb_fn)
+        except (IOError, ValueError):
+            pass
+        output_filename = output_basename + os.path.splitext(thumb_fn)[1]
+        sftp.get(str(thumb_dir / thumb_fn), output_filename)
+        return output_filename
+    # The tablet has no thumbnails for this document (yet), fall back to
+    # rendering the first page.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_pdf = os.path.join(temp_dir, 'thumbnail.pdf')
+        if not render_remote(sftp, rm_file, temp_pdf, None,
+                             page_selection=[(1, 1)], expand_pages=False):
+            return None
+        images = convert_from_path(temp_pdf, dpi=dpi, first_page=1, last_page=1)
+        if len(images) == 0:
+            return None
+        output_filename = output_basename + '.jpg'
+        images[0].convert('RGB').save(output_filename, 'JPEG')
+        return output_filename
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
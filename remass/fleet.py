@@ -0,0 +1,221 @@
+"""Runs operations concurrently on multiple tablets."""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import PurePosixPath
+from typing import Any, Callable, Dict, List, Tuple, Union
+from remass.config import RemassConfig
+from remass.filesystem import REMOTE_XOCHITL_DIR, RCollection, RDocument
+from remass.tablet import DeviceStatus, SplashScreenUtil, TabletConnection
+from remass.templates import TemplateOrganizer
+from remass.utilities import safe_filename
+
+
+@dataclass
+class FleetResult(object):
+    """Outcome of an operation on a single device."""
+    device: str
+    host: str
+    result: Any = None
+    error: Exception = None
+    duration: float = 0.0  # Wall time in seconds, including connection setup
+
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+
+class TabletFleet(object):
+    """Manages the tablets listed in the configuration's [fleet] section.
+
+    Each [[fleet.devices]] entry requires a 'name' and a 'host'. All other
+    connection parameters (user, keyfile, password, timeout, port) default
+    to the values of the [connection] section and may be overridden per
+    device, e.g.:
+
+        [fleet]
+        max_workers = 8
+
+        [[fleet.devices]]
+        name = "classroom-01"
+        host = "192.168.1.101"
+    """
+    def __init__(self, cfg: RemassConfig, max_workers: int = None):
+        self._cfg = cfg
+        self._max_workers = cfg['fleet']['max_workers'] if max_workers is None else max_workers
+        self._devices = dict()
+        for entry in cfg['fleet']['devices']:
+            if 'name' not in entry or 'host' not in entry:
+                raise ValueError(f'Fleet device entries require a "name" and "host": {entry}')
+            if entry['name'] in self._devices:
+                raise ValueError(f"Duplicate fleet device name '{entry['name']}'")
+            self._devices[entry['name']] = entry
+
+    @property
+    def devices(self) -> List[str]:
+        return list(self._devices.keys())
+
+    def connection_config(self, device: str) -> dict:
+        """Returns the configuration dict (as expected by TabletConnection)
+        for the given device."""
+        connection = dict(self._cfg['connection'])
+        connection.update({k: v for k, v in self._devices[device].items() if k != 'name'})
+        # There is no fallback for fleet devices
+        connection['host_fallback'] = None
+        return {'connection': connection}
+
+    def run(
+            self, operation: Callable[[TabletConnection, str], Any],
+            devices: List[str] = None) -> Dict[str, FleetResult]:
+        """Invokes operation(connection, device_name) for each device.
+
+        At most max_workers devices are processed concurrently. Exceptions
+        are not propagated but reported within the corresponding FleetResult.
+        :devices: subset of device names, defaults to all devices
+        :return: dict{device name: FleetResult}
+        """
+        if devices is None:
+            devices = self.devices
+        with ThreadPoolExecutor(max_workers=max(1, self._max_workers)) as executor:
+            futures = {device: executor.submit(self._run_single, operation, device)
+                       for device in devices}
+            return {device: future.result() for device, future in futures.items()}
+
+    def _run_single(
+            self, operation: Callable[[TabletConnection, str], Any],
+            device: str) -> FleetResult:
+        cfg = self.connection_config(device)
+        res = FleetResult(device=device, host=cfg['connection']['host'])
+        start = time.perf_counter()
+        connection = TabletConnection(cfg)
+        try:
+            connection.open()
+            res.result = operation(connection, device)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Operation failed on '{device}': {e}")
+            res.error = e
+        finally:
+            connection.close()
+            res.duration = time.perf_counter() - start
+        return res
+
+    def get_status(self, devices: List[str] = None) -> Dict[str, FleetResult]:
+        """Queries the DeviceStatus of each tablet."""
+        def _status(connection: TabletConnection, _device: str) -> DeviceStatus:
+            return connection.get_device_status()
+        return self.run(_status, devices)
+
+    def synchronize_templates(
+            self, templates_to_add: List[Dict] = None,
+            replace_templates: bool = False,
+            templates_to_disable: list = None,
+            devices: List[str] = None) -> Dict[str, FleetResult]:
+        """Deploys/disables the given templates on each tablet, see
+        TemplateOrganizer.synchronize()."""
+        def _sync(connection: TabletConnection, _device: str) -> str:
+            return TemplateOrganizer(self._cfg, connection).synchronize(
+                templates_to_add=list() if templates_to_add is None else templates_to_add,
+                replace_templates=replace_templates,
+                templates_to_disable=list() if templates_to_disable is None else templates_to_disable,
+                backup_template_json=False)
+        return self.run(_sync, devices)
+
+    def upload_screen(
+            self, local_filename: str, screen: Union[Tuple[str, str], str],
+            restart_ui: bool = False,
+            devices: List[str] = None) -> Dict[str, FleetResult]:
+        """Uploads the custom splash screen to each tablet. Tablets which
+        already show this screen are skipped (and won't be restarted).
+        :return: per-device results contain whether the screen was uploaded
+        """
+        valid, msg = SplashScreenUtil.validate_custom_screen(local_filename)
+        if not valid:
+            raise ValueError(f"Invalid splash screen '{local_filename}': {msg}")
+        remote_filename = SplashScreenUtil.tablet_screen_filename(screen)
+
+        def _upload(connection: TabletConnection, _device: str) -> bool:
+            uploaded = connection.upload_file(local_filename, remote_filename)
+            if uploaded and restart_ui:
+                connection.restart_ui()
+            return uploaded
+        return self.run(_upload, devices)
+
+    def import_documents(
+            self, filenames: List[str], collection_name: str = None,
+            devices: List[str] = None) -> Dict[str, FleetResult]:
+        """Adds the PDF/EPUB files to each tablet (skipping documents which
+        already exist), see TabletConnection.import_documents().
+        :collection_name: visible name of the target collection (which must
+                 exist on each tablet), None for the root
+        :return: per-device results contain the UUIDs of the imported documents
+        """
+        def _import(connection: TabletConnection, _device: str) -> List[str]:
+            collection = None
+            if collection_name is not None:
+                _root, _trash, dirents = connection.get_filesystem()
+                matches = [d for d in dirents.values()
+                           if isinstance(d, RCollection) and d.visible_name == collection_name]
+                if len(matches) == 0:
+                    raise ValueError(f"No such collection '{collection_name}'")
+                collection = matches[0]
+            return connection.import_documents(filenames, collection)
+        return self.run(_import, devices)
+
+    def snapshot_metadata(
+            self, dst_folder: str,
+            devices: List[str] = None) -> Dict[str, FleetResult]:
+        """Downloads all .metadata and .content files of each tablet into
+        dst_folder/<device>. These folders can be parsed via
+        load_local_filesystem().
+        :return: per-device results contain the snapshot folder
+        """
+        def _snapshot(connection: TabletConnection, device: str) -> str:
+            folder = os.path.join(dst_folder, safe_filename(device))
+            os.makedirs(folder, exist_ok=True)
+            with connection.sftp_session() as sftp:
+                for fname in sftp.listdir(REMOTE_XOCHITL_DIR):
+                    if fname.endswith('.metadata') or fname.endswith('.content'):
+                        sftp.get(str(PurePosixPath(REMOTE_XOCHITL_DIR, fname)),
+                                 os.path.join(folder, fname))
+            return folder
+        return self.run(_snapshot, devices)
+
+    def export_documents(
+            self, dst_folder: str, uuids: List[str] = None,
+            devices: List[str] = None, **kwargs) -> Dict[str, FleetResult]:
+        """Renders documents of each tablet to dst_folder/<device>/<name>.pdf.
+
+        :uuids: documents to export. If None, all documents (except for the
+                trashed ones) will be exported.
+        :kwargs: will be passed to rmrl.render()
+        :return: per-device results contain the list of exported PDFs
+        """
+        def _export(connection: TabletConnection, device: str) -> List[str]:
+            folder = os.path.join(dst_folder, safe_filename(device))
+            os.makedirs(folder, exist_ok=True)
+            _root, trash, dirents = connection.get_filesystem()
+            if uuids is None:
+                documents = [d for d in dirents.values()
+                             if d.dirent_type == RDocument.dirent_type
+                             and not _is_trashed(d, trash.uuid)]
+            else:
+                documents = [dirents[uuid] for uuid in uuids if uuid in dirents]
+            exported = list()
+            for doc in documents:
+                fname = os.path.join(
+                    folder, f'{safe_filename(doc.visible_name)}-{doc.uuid[:8]}.pdf')
+                connection.render_document(doc, fname, None, **kwargs)
+                exported.append(fname)
+            return exported
+        return self.run(_export, devices)
+
+
+def _is_trashed(dirent, trash_uuid: str) -> bool:
+    node = dirent
+    while node is not None:
+        if node.uuid == trash_uuid:
+            return True
+        node = node.parent
+    return False
@@ -0,0 +1,128 @@
+"""Bulk import of PDF & EPUB documents into the tablet's xochitl folder."""
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+from remass import transfer
+from remass.filesystem import REMOTE_XOCHITL_DIR
+
+
+# Supported document types, i.e. file extension: xochitl's fileType
+IMPORT_FILE_TYPES = {
+    '.pdf': 'pdf',
+    '.epub': 'epub',
+}
+
+
+@dataclass
+class ImportDocument(object):
+    """A local document which should be added to the tablet."""
+    filename: str
+    visible_name: str
+    file_type: str
+    uuid: str
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.filename)
+
+
+def import_document(filename: str, visible_name: str = None) -> ImportDocument:
+    """Prepares the import of the given PDF/EPUB, using the filename (without
+    extension) as the visible name by default."""
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    if ext.lower() not in IMPORT_FILE_TYPES:
+        raise ValueError(
+            f"Unsupported document '{filename}', must be one of: {', '.join(IMPORT_FILE_TYPES.keys())}")
+    return ImportDocument(
+        filename=filename, visible_name=stem if visible_name is None else visible_name,
+        file_type=IMPORT_FILE_TYPES[ext.lower()], uuid=str(uuid.uuid4()))
+
+
+def document_metadata(doc: ImportDocument, parent_uuid: str = None) -> Dict:
+    """Returns the .metadata of a freshly imported document."""
+    return {
+        'deleted': False,
+        'lastModified': str(int(time.time() * 1000)),
+        'lastOpenedPage': 0,
+        'metadatamodified': False,
+        'modified': False,
+        'parent': '' if parent_uuid is None else parent_uuid,
+        'pinned': False,
+        'synced': False,
+        'type': 'DocumentType',
+        'version': 1,
+        'visibleName': doc.visible_name
+    }
+
+
+def document_content(doc: ImportDocument) -> Dict:
+    """Returns the .content of a freshly imported document. The pages will
+    be set up by xochitl once the document is opened."""
+    return {
+        'extraMetadata': {},
+        'fileType': doc.file_type,
+        'fontName': '',
+        'lastOpenedPage': 0,
+        'lineHeight': -1,
+        'margins': 100,
+        'orientation': 'portrait',
+        'pageCount': 0,
+        'textScale': 1,
+        'transform': {}
+    }
+
+
+def _write_json(sftp, remote_filename: str, data: Dict) -> None:
+    part_filename = remote_filename + '.part'
+    with sftp.open(part_filename, 'w') as f:
+        f.write(json.dumps(data, indent=4))
+    sftp.posix_rename(part_filename, remote_filename)
+
+
+def import_documents(
+        sftp_session: Callable[[], AbstractContextManager],
+        documents: List[ImportDocument], parent_uuid: str = None,
+        max_workers: int = 4,
+        progress_cb: Callable[[float], None] = None) -> List[str]:
+    """Uploads the documents into the given collection (None for the root),
+    using max_workers concurrent (pipelined) SFTP sessions. The .metadata
+    file is uploaded last, so xochitl never sees incomplete documents. The
+    UI must be restarted afterwards to show the new documents.
+    :sftp_session: returns a context manager which provides an SFTP session
+    :progress_cb: optional callback, invoked with the progress in percent
+    :return: UUIDs of the imported documents
+    """
+    total_bytes = sum(doc.size for doc in documents)
+    lock = threading.Lock()
+    transferred = [0]
+
+    def _upload(doc: ImportDocument) -> str:
+        base = posixpath.join(REMOTE_XOCHITL_DIR, doc.uuid)
+        with sftp_session() as sftp:
+            transfer.upload(sftp, doc.filename, f'{base}.{doc.file_type}')
+            _write_json(sftp, base + '.content', document_content(doc))
+            _write_json(sftp, base + '.metadata', document_metadata(doc, parent_uuid))
+        with lock:
+            transferred[0] += doc.size
+            if progress_cb is not None:
+                progress_cb(100.0 if total_bytes == 0 else 100.0 * transferred[0] / total_bytes)
+        return doc.uuid
+
+    # Start with the largest documents, so that the workers finish at
+    # roughly the same time
+    ordered = sorted(documents, key=lambda doc: doc.size, reverse=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_upload, doc) for doc in ordered]
+        uuids = [future.result() for future in futures]
+    logging.getLogger(__name__).info(
+        f'Imported {len(uuids)} documents ({total_bytes / 2**20:.1f} MB).')
+    return uuids
+
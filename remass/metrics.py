@@ -0,0 +1,197 @@
+"""Opt-in metrics of the operations performed via TabletConnection."""
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List
+
+
+# Upper bounds (in seconds) of the latency histogram buckets (same as the
+# Prometheus client defaults)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class OperationMetrics(object):
+    calls: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    # Number of calls per latency bucket (not cumulative), the last entry
+    # counts all calls slower than the largest LATENCY_BUCKETS bound
+    histogram: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    exec_round_trips: int = 0
+    sftp_round_trips: int = 0
+
+
+class _CallFrame(object):
+    """Counters of a single, currently running operation."""
+    def __init__(self):
+        self.exec_round_trips = 0
+        self.sftp_round_trips = 0
+
+
+class MetricsCollector(object):
+    """Collects call counts, latencies, transferred bytes and round trips per
+    TabletConnection method.
+
+    Counters of nested calls (e.g. upload_file querying get_free_space_kb)
+    are inclusive, i.e. they also count towards the outer call. Round trips
+    of worker threads are only attributed to an operation if the workers
+    attach() to its frames. Byte counts are measured on the SSH socket, thus
+    they're only exact if operations don't overlap (concurrent calls will
+    see each other's traffic).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = dict()
+        self._bytes_sent = 0
+        self._bytes_received = 0
+        self._frames = threading.local()
+
+    def _stack(self) -> List[_CallFrame]:
+        if not hasattr(self._frames, 'stack'):
+            self._frames.stack = list()
+        return self._frames.stack
+
+    def count_bytes(self, sent: int = 0, received: int = 0) -> None:
+        with self._lock:
+            self._bytes_sent += sent
+            self._bytes_received += received
+
+    def count_exec(self, num: int = 1) -> None:
+        with self._lock:
+            for frame in self._stack():
+                frame.exec_round_trips += num
+
+    def count_sftp(self, num: int = 1) -> None:
+        with self._lock:
+            for frame in self._stack():
+                frame.sftp_round_trips += num
+
+    def current_frames(self) -> List[_CallFrame]:
+        """Returns the operations which are currently running in the calling
+        thread, see attach()."""
+        return list(self._stack())
+
+    @contextmanager
+    def attach(self, frames: List[_CallFrame]):
+        """Attributes the round trips of the calling (worker) thread to the
+        given operations (obtained via current_frames() in the thread which
+        started them) while the context is active."""
+        stack = self._stack()
+        num = len(stack)
+        stack.extend(frames)
+        try:
+            yield
+        finally:
+            del stack[num:]
+
+    @contextmanager
+    def measure(self, operation: str):
+        """Records the wrapped call as the given operation."""
+        frame = _CallFrame()
+        stack = self._stack()
+        stack.append(frame)
+        with self._lock:
+            sent, received = self._bytes_sent, self._bytes_received
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                om = self._operations.setdefault(operation, OperationMetrics())
+                om.calls += 1
+                om.errors += 1 if failed else 0
+                om.total_seconds += duration
+                om.histogram[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+                om.bytes_sent += self._bytes_sent - sent
+                om.bytes_received += self._bytes_received - received
+                om.exec_round_trips += frame.exec_round_trips
+                om.sftp_round_trips += frame.sftp_round_trips
+
+    def reset(self) -> None:
+        with self._lock:
+            self._operations = dict()
+
+    def snapshot(self) -> Dict[str, OperationMetrics]:
+        """Returns a copy of the current metrics as dict{method: metrics}."""
+        with self._lock:
+            return {op: OperationMetrics(**asdict(om))
+                    for op, om in sorted(self._operations.items())}
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'latency_buckets': list(LATENCY_BUCKETS),
+            'operations': {op: asdict(om) for op, om in self.snapshot().items()}
+        }, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = list()
+
+        def _counter(name: str, help: str, attr: str) -> None:
+            lines.append(f'# HELP remass_{name} {help}')
+            lines.append(f'# TYPE remass_{name} counter')
+            for op, om in snapshot.items():
+                lines.append(f'remass_{name}{{method="{op}"}} {getattr(om, attr)}')
+
+        _counter('calls_total', 'Number of TabletConnection method calls.', 'calls')
+        _counter('errors_total', 'Number of calls which raised an exception.', 'errors')
+        _counter('bytes_sent_total', 'Bytes sent to the tablet.', 'bytes_sent')
+        _counter('bytes_received_total', 'Bytes received from the tablet.', 'bytes_received')
+        _counter('exec_round_trips_total', 'Remote command executions.', 'exec_round_trips')
+        _counter('sftp_round_trips_total', 'SFTP requests.', 'sftp_round_trips')
+        lines.append('# HELP remass_call_duration_seconds Latency of TabletConnection method calls.')
+        lines.append('# TYPE remass_call_duration_seconds histogram')
+        for op, om in snapshot.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), om.histogram):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound}'
+                lines.append(f'remass_call_duration_seconds_bucket{{method="{op}",le="{le}"}} {cumulative}')
+            lines.append(f'remass_call_duration_seconds_sum{{method="{op}"}} {om.total_seconds}')
+            lines.append(f'remass_call_duration_seconds_count{{method="{op}"}} {om.calls}')
+        return '\n'.join(lines) + '\n'
+
+
+class CountingSocket(object):
+    """Socket wrapper which reports the transferred bytes to the collector.
+    :collector: returns the current collector (or None if metrics are
+                disabled), so that metrics can be enabled at any time
+    """
+    def __init__(self, sock, collector: Callable[[], MetricsCollector]):
+        self._sock = sock
+        self._collector = collector
+
+    def _count(self, sent: int = 0, received: int = 0) -> None:
+        collector = self._collector()
+        if collector is not None:
+            collector.count_bytes(sent=sent, received=received)
+
+    def send(self, data) -> int:
+        num = self._sock.send(data)
+        self._count(sent=num)
+        return num
+
+    def sendall(self, data) -> None:
+        self._sock.sendall(data)
+        self._count(sent=len(data))
+
+    def recv(self, bufsize: int) -> bytes:
+        data = self._sock.recv(bufsize)
+        self._count(received=len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
@@ -0,0 +1,487 @@
+"""Lazy extraction of selected pages from a (remote) PDF.
+
+Exporting a few pages of an annotated PDF shouldn't require transferring
+the whole base PDF from the tablet. LazyPdfReader only reads the byte
+ranges it needs via a seekable file object (e.g. filesystem.RemoteFile):
+the cross-reference sections, the page tree and the objects which are
+reachable from the selected pages.
+"""
+import re
+import zlib
+from collections import namedtuple
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+
+class PdfSubsetError(Exception):
+    """Raised if the PDF cannot be subset lazily (e.g. it is encrypted or
+    its structure isn't supported), the caller should then fall back to
+    reading the whole file."""
+
+
+Ref = namedtuple('Ref', ['num', 'gen'])
+
+# Catalog entries which are copied into the subset, everything else (e.g.
+# outlines, structure tree, forms) may reference objects of all pages.
+_CATALOG_KEYS = (b'/Type', b'/Pages', b'/OCProperties', b'/Version')
+# Page entries which are kept for the placeholders of unselected pages, so
+# that page indices and geometries stay the same.
+_PLACEHOLDER_KEYS = (b'/Type', b'/Parent', b'/MediaBox', b'/CropBox', b'/BleedBox',
+                     b'/TrimBox', b'/ArtBox', b'/Rotate', b'/UserUnit')
+
+_TOKEN = re.compile(
+    rb'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*'  # Skip whitespace and comments
+    rb'(<<|>>|\[|\]|\(|<[0-9A-Fa-f\x00\t\n\x0c\r ]*>|/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*'
+    rb'|[^\x00\t\n\x0c\r ()<>\[\]{}/%]+)')
+_INTEGER = re.compile(rb'[+-]?\d+$')
+
+
+class _Incomplete(Exception):
+    """The parser reached the end of the currently loaded data."""
+
+
+class _Parser(object):
+    """Minimal PDF object parser. Atoms (names, numbers, strings, ...) are
+    kept as their raw bytes, so that objects can be written back verbatim."""
+    def __init__(self, data: bytes, complete: bool):
+        self.data = data
+        self.complete = complete
+        self.pos = 0
+
+    def token(self) -> bytes:
+        match = _TOKEN.match(self.data, self.pos)
+        if match is None:
+            if self.complete:
+                raise PdfSubsetError(f'Unexpected end of data at {self.pos}')
+            raise _Incomplete()
+        if match.end() >= len(self.data) and not self.complete:
+            # The token might be truncated
+            raise _Incomplete()
+        self.pos = match.end()
+        return match.group(1)
+
+    def value(self):
+        tok = self.token()
+        if tok == b'<<':
+            result = dict()
+            while True:
+                key = self.token()
+                if key == b'>>':
+                    return result
+                if not key.startswith(b'/'):
+                    raise PdfSubsetError(f'Invalid dictionary key {key!r}')
+                result[key] = self.value()
+        if tok == b'[':
+            result = list()
+            while True:
+                pos = self.pos
+                if self.token() == b']':
+                    return result
+                self.pos = pos
+                result.append(self.value())
+        if tok == b'(':
+            return self._literal_string(self.pos - 1)
+        if _INTEGER.match(tok):
+            # Could be the start of an indirect reference "num gen R"
+            pos = self.pos
+            try:
+                gen = self.token()
+                if _INTEGER.match(gen) and self.token() == b'R':
+                    return Ref(int(tok), int(gen))
+            except PdfSubsetError:
+                pass
+            self.pos = pos
+        return tok
+
+    def _literal_string(self, start: int) -> bytes:
+        depth = 0
+        pos = start
+        while pos < len(self.data):
+            char = self.data[pos:pos + 1]
+            if char == b'\\':
+                pos += 2
+                continue
+            if char == b'(':
+                depth += 1
+            elif char == b')':
+                depth -= 1
+                if depth == 0:
+                    self.pos = pos + 1
+                    return self.data[start:self.pos]
+            pos += 1
+        if self.complete:
+            raise PdfSubsetError('Unterminated string')
+        raise _Incomplete()
+
+    def skip_eol(self) -> None:
+        """Skips the end-of-line marker after the "stream" keyword."""
+        if self.data[self.pos:self.pos + 2] == b'\r\n':
+            self.pos += 2
+        elif self.data[self.pos:self.pos + 1] in (b'\n', b'\r'):
+            self.pos += 1
+        elif self.pos >= len(self.data) and not self.complete:
+            raise _Incomplete()
+
+
+def serialize(value) -> bytes:
+    """Returns the PDF representation of a parsed value."""
+    if isinstance(value, dict):
+        return b'<<' + b''.join(key + b' ' + serialize(val) + b' ' for key, val in value.items()) + b'>>'
+    if isinstance(value, list):
+        return b'[' + b' '.join(serialize(val) for val in value) + b']'
+    if isinstance(value, Ref):
+        return b'%d %d R' % (value.num, value.gen)
+    return value
+
+
+def _references(value, refs: List[Ref]) -> List[Ref]:
+    """Collects all indirect references within the (parsed) value."""
+    if isinstance(value, Ref):
+        refs.append(value)
+    elif isinstance(value, dict):
+        for val in value.values():
+            _references(val, refs)
+    elif isinstance(value, list):
+        for val in value:
+            _references(val, refs)
+    return refs
+
+
+def _png_unpredict(data: bytes, columns: int) -> bytes:
+    """Reverts the PNG predictors (as used by compressed xref streams)."""
+    row_len = columns + 1
+    previous = bytearray(columns)
+    output = bytearray()
+    for start in range(0, len(data) - row_len + 1, row_len):
+        kind = data[start]
+        row = bytearray(data[start + 1:start + row_len])
+        for idx in range(columns):
+            left = row[idx - 1] if idx > 0 else 0
+            up = previous[idx]
+            if kind == 1:
+                row[idx] = (row[idx] + left) & 0xFF
+            elif kind == 2:
+                row[idx] = (row[idx] + up) & 0xFF
+            elif kind == 3:
+                row[idx] = (row[idx] + (left + up) // 2) & 0xFF
+            elif kind == 4:
+                upleft = previous[idx - 1] if idx > 0 else 0
+                p = left + up - upleft
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+                pred = left if pa <= pb and pa <= pc else (up if pb <= pc else upleft)
+                row[idx] = (row[idx] + pred) & 0xFF
+            elif kind != 0:
+                raise PdfSubsetError(f'Unsupported PNG predictor {kind}')
+        output += row
+        previous = row
+    return bytes(output)
+
+
+def _decode_stream(stream_dict: dict, data: bytes) -> bytes:
+    """Decodes the (xref or object) stream data, only FlateDecode with
+    optional PNG predictors is supported."""
+    filters = stream_dict.get(b'/Filter', [])
+    params = stream_dict.get(b'/DecodeParms', None)
+    if not isinstance(filters, list):
+        filters = [filters]
+        params = [params]
+    if len(filters) > 1:
+        raise PdfSubsetError('Unsupported filter chain')
+    if len(filters) == 0:
+        return data
+    if filters[0] != b'/FlateDecode':
+        raise PdfSubsetError(f'Unsupported stream filter {filters[0]!r}')
+    data = zlib.decompress(data)
+    params = params[0] if isinstance(params, list) else params
+    if isinstance(params, dict):
+        predictor = int(params.get(b'/Predictor', b'1'))
+        if predictor >= 10:
+            data = _png_unpredict(data, int(params.get(b'/Columns', b'1')))
+        elif predictor != 1:
+            raise PdfSubsetError(f'Unsupported predictor {predictor}')
+    return data
+
+
+def resolve_page_selection(page_selection: Sequence[Tuple[int, int]], num_pages: int) -> Set[int]:
+    """Returns the (0-based) indices of the selected pages.
+    :page_selection: list of 1-based (start, end) ranges, end is inclusive,
+                     negative numbers count from the last page (-1)
+    """
+    if not page_selection:
+        return set(range(num_pages))
+    selected = set()
+    for start, end in page_selection:
+        start = start if start > 0 else num_pages + start + 1
+        end = end if end > 0 else num_pages + end + 1
+        selected.update(range(max(1, start) - 1, min(num_pages, end)))
+    return selected
+
+
+class LazyPdfReader(object):
+    """Reads the structure of a PDF via ranged reads from the given seekable
+    binary file object."""
+    # Initial size of a read request when parsing an object
+    CHUNK_SIZE = 1024
+
+    def __init__(self, stream, size: int):
+        self._stream = stream
+        self._size = size
+        self._xref = dict()
+        self._objects = dict()
+        self._object_streams = dict()
+        self.trailer = None
+        self.version = self._read_version()
+        self._load_xref()
+        if b'/Encrypt' in self.trailer:
+            raise PdfSubsetError('Encrypted PDFs are not supported')
+        self.page_refs = self._load_page_tree()
+
+    @property
+    def num_pages(self) -> int:
+        return len(self.page_refs)
+
+    def _read(self, offset: int, length: int) -> bytes:
+        self._stream.seek(offset)
+        return self._stream.read(min(length, self._size - offset))
+
+    def _read_version(self) -> bytes:
+        match = re.match(rb'%PDF-(\d\.\d)', self._read(0, 16))
+        if match is None:
+            raise PdfSubsetError('Missing PDF header')
+        return match[1]
+
+    def _parse_at(self, offset: int, parse):
+        """Invokes parse(parser) on data starting at the given offset and
+        reads more data until parse succeeds."""
+        length = self.CHUNK_SIZE
+        while True:
+            data = self._read(offset, length)
+            parser = _Parser(data, offset + len(data) >= self._size)
+            try:
+                return parse(parser)
+            except _Incomplete:
+                if parser.complete:
+                    raise PdfSubsetError(f'Truncated object at {offset}')
+                length *= 4
+
+    def _load_xref(self) -> None:
+        tail = self._read(max(0, self._size - 1024), 1024)
+        matches = re.findall(rb'startxref\s+(\d+)', tail)
+        if len(matches) == 0:
+            raise PdfSubsetError('Missing startxref')
+        offset = int(matches[-1])
+        visited = set()
+        while offset is not None and offset not in visited:
+            visited.add(offset)
+            trailer = self._load_xref_section(offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            if b'/XRefStm' in trailer:
+                # Hybrid file, the stream lists the compressed objects
+                self._load_xref_section(int(trailer[b'/XRefStm']))
+            offset = int(trailer[b'/Prev']) if b'/Prev' in trailer else None
+
+    def _load_xref_section(self, offset: int) -> dict:
+        """Parses the xref table or stream at the given offset. Newer
+        sections are loaded first, thus we never overwrite entries. Free
+        entries are ignored, as we only follow existing references."""
+        if self._read(offset, 4) == b'xref':
+            return self._parse_at(offset, self._parse_xref_table)
+        stream_dict, data = self._read_object(offset)
+        if not isinstance(stream_dict, dict) or stream_dict.get(b'/Type') != b'/XRef' or data is None:
+            raise PdfSubsetError(f'Invalid xref section at {offset}')
+        data = _decode_stream(stream_dict, data)
+        widths = [int(w) for w in stream_dict[b'/W']]
+        index = [int(i) for i in stream_dict.get(b'/Index', [b'0', stream_dict[b'/Size']])]
+        if len(data) < sum(widths) * sum(index[1::2]):
+            raise PdfSubsetError('Truncated xref stream')
+        pos = 0
+        for first, count in zip(index[::2], index[1::2]):
+            for num in range(first, first + count):
+                fields = list()
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos + width], 'big'))
+                    pos += width
+                kind = fields[0] if widths[0] > 0 else 1
+                if kind in (1, 2) and num not in self._xref:
+                    self._xref[num] = (kind, fields[1], fields[2])
+        return stream_dict
+
+    def _parse_xref_table(self, parser: _Parser) -> dict:
+        end = parser.data.find(b'trailer')
+        if end < 0:
+            raise _Incomplete()
+        tokens = parser.data[4:end].split()
+        pos = 0
+        while pos + 1 < len(tokens):
+            first, count = int(tokens[pos]), int(tokens[pos + 1])
+            pos += 2
+            for num in range(first, first + count):
+                offset, gen, kind = tokens[pos:pos + 3]
+                pos += 3
+                if kind == b'n' and num not in self._xref:
+                    self._xref[num] = (1, int(offset), int(gen))
+        parser.pos = end + len(b'trailer')
+        trailer = parser.value()
+        if not isinstance(trailer, dict):
+            raise PdfSubsetError('Invalid trailer')
+        return trailer
+
+    def _parse_object(self, parser: _Parser):
+        """Parses "num gen obj value [stream]" and returns the tuple (value,
+        start of the stream data relative to the object or None)."""
+        parser.token(), parser.token()
+        if parser.token() != b'obj':
+            raise PdfSubsetError('Invalid object header')
+        value = parser.value()
+        if not isinstance(value, dict):
+            return value, None
+        pos = parser.pos
+        if parser.token() != b'stream':
+            parser.pos = pos
+            return value, None
+        parser.skip_eol()
+        return value, parser.pos
+
+    def _read_object(self, offset: int):
+        """Returns the tuple (value, stream data or None) of the object at
+        the given offset. Stream data is read separately, as it can be huge
+        (e.g. images)."""
+        value, stream_start = self._parse_at(offset, self._parse_object)
+        if stream_start is None:
+            return value, None
+        length = self.resolve(value[b'/Length'])
+        return value, self._read(offset + stream_start, int(length))
+
+    def _load_object(self, ref: Ref):
+        """Returns the tuple (value, stream data or None) of the referenced
+        object, which are loaded on first access."""
+        if ref.num not in self._objects:
+            entry = self._xref.get(ref.num, None)
+            if entry is None:
+                self._objects[ref.num] = (b'null', None)
+            elif entry[0] == 1:
+                self._objects[ref.num] = self._read_object(entry[1])
+            else:
+                self._objects[ref.num] = (self._compressed_object(entry[1], entry[2]), None)
+        return self._objects[ref.num]
+
+    def _compressed_object(self, stream_num: int, index: int):
+        if stream_num not in self._object_streams:
+            stream_dict, data = self._load_object(Ref(stream_num, 0))
+            if data is None:
+                raise PdfSubsetError(f'Invalid object stream {stream_num}')
+            data = _decode_stream(stream_dict, data)
+            num_objects = int(stream_dict[b'/N'])
+            header = data[:int(stream_dict[b'/First'])].split()
+            offsets = [int(header[2 * idx + 1]) + int(stream_dict[b'/First'])
+                       for idx in range(num_objects)]
+            self._object_streams[stream_num] = (data, offsets)
+        data, offsets = self._object_streams[stream_num]
+        parser = _Parser(data, True)
+        parser.pos = offsets[index]
+        return parser.value()
+
+    def resolve(self, value):
+        """Returns the referenced value (or the value itself if it is a
+        direct object)."""
+        while isinstance(value, Ref):
+            value = self._load_object(value)[0]
+        return value
+
+    def _prefetch(self, refs: Iterable[Ref]) -> None:
+        """Requests the given objects at once if the stream supports it (see
+        RemoteFile.fetch_ranges), instead of one round trip per object."""
+        fetch_ranges = getattr(self._stream, 'fetch_ranges', None)
+        if fetch_ranges is None:
+            return
+        entries = [self._xref.get(ref.num, None) for ref in refs if ref.num not in self._objects]
+        fetch_ranges([(entry[1], self.CHUNK_SIZE) for entry in entries
+                      if entry is not None and entry[0] == 1])
+
+    def _load_page_tree(self) -> List[Ref]:
+        catalog = self.resolve(self.trailer.get(b'/Root'))
+        if not isinstance(catalog, dict) or not isinstance(catalog.get(b'/Pages'), Ref):
+            raise PdfSubsetError('Invalid document catalog')
+        # Breadth-first, so that we can request all nodes of a level at once
+        level = [catalog[b'/Pages']]
+        visited = set()
+        kids = dict()
+        while len(level) > 0:
+            self._prefetch(level)
+            next_level = list()
+            for ref in level:
+                if not isinstance(ref, Ref) or ref.num in visited:
+                    raise PdfSubsetError('Invalid page tree')
+                visited.add(ref.num)
+                node = self.resolve(ref)
+                if b'/Kids' in node:
+                    kids[ref.num] = self.resolve(node[b'/Kids'])
+                    next_level.extend(kids[ref.num])
+            level = next_level
+        pages = list()
+        stack = [catalog[b'/Pages']]
+        while len(stack) > 0:
+            ref = stack.pop()
+            if ref.num in kids:
+                stack.extend(reversed(kids[ref.num]))
+            else:
+                pages.append(ref)
+        return pages
+
+    def subset(self, selected: Iterable[int]) -> bytes:
+        """Returns a PDF which contains the same number of pages, but only
+        the (0-based) selected ones have content. The unselected ones are
+        empty placeholders with the original page geometry."""
+        selected = set(selected)
+        root_ref = self.trailer[b'/Root']
+        placeholders = set(ref.num for idx, ref in enumerate(self.page_refs) if idx not in selected)
+        empty_ref = Ref(max(max(self._xref.keys(), default=0), root_ref.num) + 1, 0)
+        catalog = self.resolve(root_ref)
+        objects = {
+            root_ref.num: (root_ref.gen, {k: v for k, v in catalog.items() if k in _CATALOG_KEYS}, None),
+            empty_ref.num: (0, {b'/Length': b'0'}, b'')
+        }
+        level = _references(objects[root_ref.num][1], list())
+        while len(level) > 0:
+            self._prefetch(level)
+            next_level = list()
+            for ref in level:
+                if ref.num in objects:
+                    continue
+                value, data = self._load_object(ref)
+                if ref.num in placeholders:
+                    value = {k: v for k, v in value.items() if k in _PLACEHOLDER_KEYS}
+                    value[b'/Resources'] = b'<<>>'
+                    value[b'/Contents'] = empty_ref
+                elif data is not None:
+                    value = dict(value)
+                    value[b'/Length'] = b'%d' % len(data)
+                objects[ref.num] = (ref.gen, value, data)
+                _references(value, next_level)
+            level = next_level
+        return self._write(objects, root_ref)
+
+    def _write(self, objects: Dict[int, tuple], root_ref: Ref) -> bytes:
+        chunks = [b'%PDF-' + self.version + b'\n%\xe2\xe3\xcf\xd3\n']
+        position = len(chunks[0])
+        offsets = dict()
+        for num in sorted(objects.keys()):
+            gen, value, data = objects[num]
+            obj = b'%d %d obj\n' % (num, gen) + serialize(value)
+            if data is not None:
+                obj += b'\nstream\n' + data + b'\nendstream'
+            obj += b'\nendobj\n'
+            offsets[num] = position
+            position += len(obj)
+            chunks.append(obj)
+        size = max(offsets.keys()) + 1
+        xref = [b'xref\n0 %d\n' % size, b'0000000000 65535 f \n']
+        for num in range(1, size):
+            if num in offsets:
+                xref.append(b'%010d %05d n \n' % (offsets[num], objects[num][0]))
+            else:
+                xref.append(b'0000000000 00000 f \n')
+        chunks.extend(xref)
+        chunks.append(b'trailer\n' + serialize({b'/Size': b'%d' % size, b'/Root': root_ref})
+                      + b'\nstartxref\n%d\n%%%%EOF\n' % position)
+        return b''.join(chunks)
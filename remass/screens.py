@@ -0,0 +1,175 @@
+"""Conversion of arbitrary images into custom splash screens."""
+import logging
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+import numpy as np
+from PIL import Image, ImageOps
+
+
+# Resolution (width, height) of the tablet's splash screens
+SCREEN_SIZE = (1404, 1872)
+
+# How to adjust images with a different aspect ratio:
+# * letterbox: scale to fit and pad with white borders
+# * crop: scale to fill and crop the center
+# * stretch: scale to the screen resolution (distorts the image)
+FIT_MODES = ('letterbox', 'crop', 'stretch')
+
+# Supported dithering methods, see dither()
+DITHER_METHODS = ('ordered', 'none')
+
+# The e-ink panel displays 16 shades of gray
+EINK_GRAY_LEVELS = 16
+
+# Images which can be converted (by file extension)
+SCREEN_IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG (bit depth, color type): mode of the image loaded by PIL
+PNG_MODES = {
+    (1, 0): '1', (2, 0): 'L', (4, 0): 'L', (8, 0): 'L', (16, 0): 'I;16',
+    (8, 2): 'RGB', (16, 2): 'RGB',
+    (1, 3): 'P', (2, 3): 'P', (4, 3): 'P', (8, 3): 'P',
+    (8, 4): 'LA', (16, 4): 'RGBA',
+    (8, 6): 'RGBA', (16, 6): 'RGBA',
+}
+
+
+@dataclass
+class PngHeader(object):
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+
+    @property
+    def mode(self) -> Optional[str]:
+        """Returns the mode which PIL would report for this image (None for
+        invalid bit depth/color type combinations)."""
+        return PNG_MODES.get((self.bit_depth, self.color_type), None)
+
+
+def read_png_header(filename: str) -> PngHeader:
+    """Reads the image properties from the PNG's IHDR chunk, i.e. only the
+    first 29 bytes of the file, without decoding the image."""
+    with open(filename, 'rb') as f:
+        data = f.read(29)
+    if len(data) < 29 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        raise ValueError(f'"{filename}" is not a PNG file')
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', data[16:26])
+    return PngHeader(width=width, height=height, bit_depth=bit_depth, color_type=color_type)
+
+
+def _bayer_matrix(order: int) -> np.ndarray:
+    """Returns the normalized Bayer threshold map of size 2^order x 2^order,
+    values are in (0, 1)."""
+    m = np.zeros((1, 1), dtype=np.float32)
+    for _ in range(order):
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size
+
+
+_BAYER_8x8 = _bayer_matrix(3)
+
+
+def dither(gray: np.ndarray, levels: int = EINK_GRAY_LEVELS, method: str = 'ordered') -> np.ndarray:
+    """Quantizes the 8bit grayscale image to the given number of gray levels.
+    Ordered (Bayer) dithering only needs element-wise operations (i.e. it is
+    fully vectorized) and, in contrast to error diffusion, produces a stable
+    pattern without "worm" artifacts, which suits e-ink displays and
+    compresses well.
+    :method: 'ordered' or 'none' (plain quantization)
+    """
+    if method not in DITHER_METHODS:
+        raise ValueError(f"Unsupported dithering '{method}', must be one of: {', '.join(DITHER_METHODS)}")
+    scaled = gray.astype(np.float32) * ((levels - 1) / 255.0)
+    if method == 'ordered':
+        height, width = scaled.shape
+        reps = (-(-height // _BAYER_8x8.shape[0]), -(-width // _BAYER_8x8.shape[1]))
+        quantized = np.floor(scaled + np.tile(_BAYER_8x8, reps)[:height, :width])
+    else:
+        quantized = np.round(scaled)
+    quantized = np.clip(quantized, 0, levels - 1)
+    return (quantized * (255.0 / (levels - 1)) + 0.5).astype(np.uint8)
+
+
+def fit_image(image: Image.Image, fit: str = 'letterbox') -> Image.Image:
+    """Converts the image to grayscale (alpha is composed onto white) and
+    adjusts it to the screen resolution."""
+    if fit not in FIT_MODES:
+        raise ValueError(f"Unsupported fit '{fit}', must be one of: {', '.join(FIT_MODES)}")
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, rgba)
+    gray = image.convert('L')
+    if fit == 'letterbox':
+        return ImageOps.pad(gray, SCREEN_SIZE, method=Image.LANCZOS, color=255)
+    if fit == 'crop':
+        return ImageOps.fit(gray, SCREEN_SIZE, method=Image.LANCZOS)
+    return gray.resize(SCREEN_SIZE, Image.LANCZOS)
+
+
+def convert_screen(
+        src_filename: str, dst_filename: str, fit: str = 'letterbox',
+        dithering: str = 'ordered', levels: int = EINK_GRAY_LEVELS) -> str:
+    """Converts an arbitrary image into a valid splash screen, i.e. an 8bit
+    grayscale PNG of 1404x1872 pixels (size-optimized).
+    :fit: 'letterbox', 'crop' or 'stretch', see FIT_MODES
+    :dithering: 'ordered' or 'none', see dither()
+    :return: dst_filename
+    """
+    with Image.open(src_filename) as image:
+        gray = fit_image(image, fit)
+    screen = Image.fromarray(dither(np.asarray(gray), levels, dithering), mode='L')
+    # Write via a temporary file, so we never leave a partial screen
+    tmp_filename = dst_filename + '.part'
+    screen.save(tmp_filename, format='PNG', optimize=True)
+    os.replace(tmp_filename, dst_filename)
+    return dst_filename
+
+
+def _convert_screen_task(
+        src_filename: str, dst_filename: str, kwargs: dict) -> Tuple[Optional[str], Optional[str]]:
+    # Runs in a worker process, so errors are reported back to the caller
+    # instead of being logged from within the worker.
+    try:
+        return convert_screen(src_filename, dst_filename, **kwargs), None
+    except Exception as e:
+        return None, f'Cannot convert "{src_filename}": {e}'
+
+
+def convert_screens(
+        src_folder: str, dst_folder: str, max_workers: int = None, **kwargs) -> List[str]:
+    """Converts all images within src_folder into splash screens (stored as
+    dst_folder/<name>.png), using a process pool. Images which cannot be
+    converted are skipped (and logged).
+    kwargs will be passed to convert_screen()
+    :return: filenames of the converted screens
+    """
+    os.makedirs(dst_folder, exist_ok=True)
+    tasks = list()
+    for fn in sorted(os.listdir(src_folder)):
+        stem, ext = os.path.splitext(fn)
+        if ext.lower() in SCREEN_IMAGE_TYPES:
+            tasks.append((os.path.join(src_folder, fn), os.path.join(dst_folder, stem + '.png')))
+    if len(tasks) == 0:
+        return list()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_convert_screen_task, src, dst, kwargs) for src, dst in tasks]
+        results = [future.result() for future in futures]
+    converted = list()
+    for fn, error in results:
+        if error is not None:
+            logging.getLogger(__name__).warning(error)
+        elif fn is not None:
+            converted.append(fn)
+    logging.getLogger(__name__).info(
+        f'Converted {len(converted)} of {len(tasks)} images into splash screens in "{dst_folder}".')
+    return converted
@@ -0,0 +1,336 @@
+"""Content-addressed, deduplicated snapshots of the tablet's documents.
+
+Each file is stored once (by its SHA-256 digest) within "objects/", while a
+snapshot is a lightweight manifest which maps the xochitl paths to their
+digests. Thus, daily snapshots only cost the disk space of the files which
+changed in between.
+"""
+import datetime
+import functools
+import json
+import logging
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+from remass import transfer
+from remass.backup import list_remote_tree
+from remass.filesystem import REMOTE_XOCHITL_DIR, RCollection, RDirEntry,\
+    RDocument, dirent_from_metadata, render_source, _filesystem_from_dirents
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Digest algorithm to address the stored objects
+OBJECT_ALGORITHM = 'sha256'
+
+
+@dataclass
+class Snapshot(object):
+    snapshot_id: str
+    created: datetime.datetime
+    num_files: int
+    total_bytes: int
+
+
+class SnapshotSource(object):
+    """rmrl source to render a document directly from a snapshot."""
+    def __init__(self, store: 'SnapshotStore', files: Dict[str, List], doc_id: str):
+        self.store = store
+        self.files = files
+        self.doc_id = doc_id
+
+    def format_name(self, name):
+        return name.format(ID=self.doc_id)
+
+    def open(self, fn, mode='r', bufsize=-1):
+        entry = self.files[self.format_name(fn)]
+        return open(self.store.object_filename(entry[0]), mode, bufsize)
+
+    def exists(self, fn):
+        return self.format_name(fn) in self.files
+
+
+def _locked_store(exclusive: bool = False):
+    """Decorator which holds the store's lock while the method runs, see
+    SnapshotStore._locked()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self._locked(exclusive):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SnapshotStore(object):
+    """Stores snapshots of the xochitl folder within the given folder, see
+    RemassConfig.snapshot_dir.
+
+    Snapshots and restores (which may run concurrently, also from different
+    processes) hold a shared lock on the store, whereas prune() requires an
+    exclusive lock. Otherwise, it would delete the objects of a snapshot in
+    progress (which aren't referenced by any manifest yet). On Windows, all
+    of these operations are serialized.
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        self._objects_dir = os.path.join(folder, 'objects')
+        self._manifests_dir = os.path.join(folder, 'manifests')
+        self._tmp_dir = os.path.join(folder, 'tmp')
+        self._lock_filename = os.path.join(folder, 'lock')
+        for d in (self._objects_dir, self._manifests_dir, self._tmp_dir):
+            os.makedirs(d, exist_ok=True)
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        """Holds the store's lock file (blocking until it is available)."""
+        with open(self._lock_filename, 'a+b') as fp:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            else:
+                # msvcrt only provides exclusive locks (and gives up after 10s)
+                while True:
+                    try:
+                        fp.seek(0)
+                        msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+                else:
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def object_filename(self, digest: str) -> str:
+        return os.path.join(self._objects_dir, digest[:2], digest[2:])
+
+    def _manifest_filename(self, snapshot_id: str) -> str:
+        return os.path.join(self._manifests_dir, snapshot_id + '.json')
+
+    def _add_object(self, filename: str, move: bool) -> str:
+        """Stores the file (if its content isn't known yet).
+        :return: digest
+        """
+        digest = transfer.local_checksum(filename, OBJECT_ALGORITHM)
+        object_filename = self.object_filename(digest)
+        if os.path.exists(object_filename):
+            if move:
+                os.remove(filename)
+            return digest
+        os.makedirs(os.path.dirname(object_filename), exist_ok=True)
+        if move:
+            os.replace(filename, object_filename)
+        else:
+            # Copy via a temporary file, so that we never store a partial object
+            with tempfile.NamedTemporaryFile(dir=self._tmp_dir, delete=False) as tmp:
+                with open(filename, 'rb') as src:
+                    shutil.copyfileobj(src, tmp)
+            os.replace(tmp.name, object_filename)
+        return digest
+
+    def load_manifest(self, snapshot_id: str) -> Dict[str, List]:
+        """Returns the snapshot's files as dict{xochitl path: [digest, size, mtime]}."""
+        with open(self._manifest_filename(snapshot_id), 'r') as fp:
+            return json.load(fp)['files']
+
+    def _save_manifest(self, files: Dict[str, List]) -> Snapshot:
+        created = datetime.datetime.now()
+        snapshot_id = created.strftime('%Y%m%d-%H%M%S')
+        # Avoid overwriting a snapshot taken within the same second
+        cnt = 1
+        while os.path.exists(self._manifest_filename(snapshot_id)):
+            snapshot_id = created.strftime('%Y%m%d-%H%M%S') + f'-{cnt}'
+            cnt += 1
+        tmp_filename = self._manifest_filename(snapshot_id) + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            json.dump({'created': created.isoformat(), 'files': files}, fp)
+        os.replace(tmp_filename, self._manifest_filename(snapshot_id))
+        return Snapshot(snapshot_id=snapshot_id, created=created, num_files=len(files),
+                        total_bytes=sum(entry[1] for entry in files.values()))
+
+    def list_snapshots(self) -> List[Snapshot]:
+        """Returns all snapshots, sorted from oldest to newest."""
+        snapshots = list()
+        for fn in os.listdir(self._manifests_dir):
+            if not fn.endswith('.json'):
+                continue
+            with open(os.path.join(self._manifests_dir, fn), 'r') as fp:
+                manifest = json.load(fp)
+            snapshots.append(Snapshot(
+                snapshot_id=fn[:-5],
+                created=datetime.datetime.fromisoformat(manifest['created']),
+                num_files=len(manifest['files']),
+                total_bytes=sum(entry[1] for entry in manifest['files'].values())))
+        return sorted(snapshots, key=lambda s: s.created)
+
+    def _unchanged_entry(self, previous: Dict[str, List], path: str, size: int, mtime: int) -> List:
+        """Returns the previous snapshot's entry if the file didn't change."""
+        entry = previous.get(path, None)
+        if entry is not None and entry[1] == size and entry[2] == mtime\
+                and os.path.exists(self.object_filename(entry[0])):
+            return entry
+        return None
+
+    def _latest_manifest(self) -> Dict[str, List]:
+        snapshots = self.list_snapshots()
+        return self.load_manifest(snapshots[-1].snapshot_id) if len(snapshots) > 0 else dict()
+
+    @_locked_store()
+    def snapshot_folder(self, folder: str) -> Snapshot:
+        """Creates a snapshot of a local xochitl folder (e.g. a backup created
+        via TabletConnection.backup_xochitl). Files with the same size &
+        modification time as in the latest snapshot won't be hashed again."""
+        previous = self._latest_manifest()
+        files = dict()
+        for dirpath, _dirnames, filenames in os.walk(folder):
+            for fn in filenames:
+                if transfer.partial_transfer_target(fn) is not None:
+                    continue
+                filename = os.path.join(dirpath, fn)
+                path = os.path.relpath(filename, folder).replace(os.sep, '/')
+                st = os.stat(filename)
+                entry = self._unchanged_entry(previous, path, st.st_size, int(st.st_mtime))
+                if entry is None:
+                    entry = [self._add_object(filename, move=False), st.st_size, int(st.st_mtime)]
+                files[path] = entry
+        return self._save_manifest(files)
+
+    @_locked_store()
+    def snapshot_remote(
+            self, sftp_session: Callable[[], AbstractContextManager],
+            max_workers: int = 4) -> Snapshot:
+        """Creates a snapshot of the tablet's xochitl folder. Only files which
+        changed (size/modification time) since the latest snapshot will be
+        downloaded, using max_workers concurrent SFTP sessions.
+        :sftp_session: returns a context manager which provides an SFTP session
+        """
+        previous = self._latest_manifest()
+        files = dict()
+        lock = threading.Lock()
+
+        def _download(path: str, attr) -> None:
+            with tempfile.NamedTemporaryFile(dir=self._tmp_dir, delete=False) as tmp:
+                tmp_filename = tmp.name
+            try:
+                with sftp_session() as sftp:
+                    transfer.download(sftp, posixpath.join(REMOTE_XOCHITL_DIR, path),
+                                      tmp_filename, attr=attr)
+                digest = self._add_object(tmp_filename, move=True)
+            finally:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+            with lock:
+                files[path] = [digest, attr.st_size, int(attr.st_mtime)]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            remote_files = list_remote_tree(sftp_session, REMOTE_XOCHITL_DIR, executor)
+            futures = list()
+            for path, attr in remote_files.items():
+                entry = self._unchanged_entry(previous, path, attr.st_size, int(attr.st_mtime))
+                if entry is None:
+                    futures.append(executor.submit(_download, path, attr))
+                else:
+                    files[path] = entry
+            for future in futures:
+                future.result()
+        snapshot = self._save_manifest(files)
+        logging.getLogger(__name__).info(
+            f'Created snapshot {snapshot.snapshot_id}: {snapshot.num_files} files, '
+            f'{len(futures)} new or changed.')
+        return snapshot
+
+    @_locked_store()
+    def restore_snapshot(self, snapshot_id: str, dst_folder: str) -> None:
+        """Restores the snapshot's files into dst_folder (which can then be
+        loaded via load_local_filesystem). Files which already exist with
+        the same size & modification time will be skipped."""
+        for path, (digest, size, mtime) in self.load_manifest(snapshot_id).items():
+            filename = os.path.join(dst_folder, *path.split('/'))
+            if os.path.exists(filename):
+                st = os.stat(filename)
+                if st.st_size == size and int(st.st_mtime) == mtime:
+                    continue
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            shutil.copyfile(self.object_filename(digest), filename)
+            os.utime(filename, (mtime, mtime))
+
+    def load_filesystem(self, snapshot_id: str) -> Tuple[RCollection, RCollection, Dict[str, RDirEntry]]:
+        """Loads the snapshot's file system representation (like
+        load_local_filesystem, but without extracting the snapshot).
+
+        :return: root, trash, and a dict{uuid: entry}
+        """
+        dirents = list()
+        for path, entry in self.load_manifest(snapshot_id).items():
+            if '/' in path or not path.endswith('.metadata'):
+                continue
+            with open(self.object_filename(entry[0]), 'r') as mfile:
+                dirents.append(dirent_from_metadata(path, mfile))
+        return _filesystem_from_dirents(dirents)
+
+    @_locked_store()
+    def render_document(
+            self, snapshot_id: str, rm_file: RDocument, output_filename: str,
+            progress_cb: Callable[[float], None], **kwargs) -> bool:
+        """Renders the document as stored within the snapshot.
+        kwargs will be passed to rmrl.render()"""
+        src = SnapshotSource(self, self.load_manifest(snapshot_id), rm_file.uuid)
+        return render_source(src, rm_file, output_filename, progress_cb, **kwargs)
+
+    @_locked_store(exclusive=True)
+    def prune(
+            self, keep_daily: int = 90, keep_weekly: int = 52,
+            keep_monthly: int = 24) -> List[str]:
+        """Deletes all snapshots which are not covered by the retention
+        policy, i.e. we keep the latest snapshot of each of the last
+        keep_daily days (keep_weekly weeks, keep_monthly months) which have
+        snapshots. The most recent snapshot is always kept. Objects which
+        are no longer referenced will be deleted.
+        :return: IDs of the deleted snapshots
+        """
+        snapshots = sorted(self.list_snapshots(), key=lambda s: s.created, reverse=True)
+        keep = set(s.snapshot_id for s in snapshots[:1])
+        for num_periods, period in (
+                (keep_daily, lambda d: d.date()),
+                (keep_weekly, lambda d: d.isocalendar()[:2]),
+                (keep_monthly, lambda d: (d.year, d.month))):
+            periods = set()
+            for snapshot in snapshots:
+                p = period(snapshot.created)
+                if p in periods:
+                    continue
+                if len(periods) >= num_periods:
+                    break
+                periods.add(p)
+                keep.add(snapshot.snapshot_id)
+        deleted = [s.snapshot_id for s in snapshots if s.snapshot_id not in keep]
+        for snapshot_id in deleted:
+            os.remove(self._manifest_filename(snapshot_id))
+        self._collect_garbage()
+        return deleted
+
+    def _collect_garbage(self) -> None:
+        """Removes all objects which aren't referenced by any snapshot."""
+        referenced = set()
+        for snapshot in self.list_snapshots():
+            referenced.update(entry[0] for entry in self.load_manifest(snapshot.snapshot_id).values())
+        for subdir in os.listdir(self._objects_dir):
+            for fn in os.listdir(os.path.join(self._objects_dir, subdir)):
+                if subdir + fn not in referenced:
+                    os.remove(os.path.join(self._objects_dir, subdir, fn))
+        for fn in os.listdir(self._tmp_dir):
+            os.remove(os.path.join(self._tmp_dir, fn))
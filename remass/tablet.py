@@ -1,15 +1,30 @@
 """Handles connection & device queries."""
+import functools
+import json
 import logging
 import os
-from typing import Callable, Dict, Tuple, Union
+import posixpath
+import queue
+import threading
+import time
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
 import paramiko
 import socket
 import re
-from PIL import Image
+import shlex
 from getpass import getpass
 from remass.filesystem import RCollection, RDirEntry, RDocument,\
-    load_remote_filesystem, render_remote
-from remass.config import next_backup_filename
+    load_remote_filesystem, render_remote, download_thumbnail_remote,\
+    REMOTE_XOCHITL_DIR
+from remass.config import next_backup_filename, connection_cache_filename,\
+    checksum_cache_filename
+from remass.transport import select_transport_profile
+from remass import backup, importer, transfer
+from remass.metrics import CountingSocket, MetricsCollector
+from remass.screens import read_png_header
+from remass.snapshots import Snapshot, SnapshotStore
 from pathlib import PurePosixPath
 
 
@@ -17,6 +32,25 @@ class NotEnoughDiskSpaceError(Exception):
     pass
 
 
+class RemoteCommandError(Exception):
+    pass
+
+
+class NotConnectedError(Exception):
+    pass
+
+
+# Errors which indicate that the connection to the tablet has been lost
+CONNECTION_ERRORS = (
+    EOFError, ConnectionError, socket.timeout, paramiko.SSHException,
+    paramiko.ssh_exception.NoValidConnectionsError)
+
+# Subclasses of the CONNECTION_ERRORS which reconnecting won't fix (i.e. bad
+# credentials or an unexpected host key), these must not be retried
+PERMANENT_CONNECTION_ERRORS = (
+    paramiko.AuthenticationException, paramiko.BadHostKeyException)
+
+
 class SplashScreenUtil(object):
     # Replacing the splash (dat/bmp - dat/png since at least 2.10 as it seems?) is
     # not supported yet (and I don't plan to change this any time soon)
@@ -53,14 +87,65 @@ class SplashScreenUtil(object):
         """
         if not filename.lower().endswith('.png'):
             return (False, 'File must be a PNG.')
-        image = Image.open(filename)
-        if image.mode not in ['L', 'LA', 'RGB', 'RGBA']:
+        # Only parse the header, there's no need to decode the image
+        try:
+            header = read_png_header(filename)
+        except (OSError, ValueError):
+            return (False, 'File must be a PNG.')
+        if header.mode not in ['L', 'LA', 'RGB', 'RGBA']:
             return (False, 'Image must be 8bit luminance/rgb (plus optional alpha).')
-        if image.size != (1404, 1872):
+        if (header.width, header.height) != (1404, 1872):
             return (False, 'Resolution must be 1404x1872.')
         return (True, '')
 
 
+# We can look up the version strings from ddvk's awesome remarkable-hacks:
+# https://github.com/ddvk/remarkable-hacks/blob/master/patch.sh
+FIRMWARE_VERSIONS = {
+    "20221026103859": "rM1 2.15.1.1189",
+    "20221026104022": "rM2 2.15.1.1189",
+    "20221003074737": "rM1 2.15.0.1067",
+    "20221003075633": "rM2 2.15.0.1067",
+    "20220921102803": "rM1 2.14.3.1047",
+    "20220921101206": "rM2 2.14.3.1047",
+    "20220907142424": "rM1 2.14.3.1005",
+    "20220907143405": "rM2 2.14.3.1005",
+    "20220825124750": "rM2 2.14.3.977",
+    "20220825122914": "rM1 2.14.3.977",
+    "20220617142418": "rM1 2.14.1.866",
+    "20220617143306": "rM2 2.14.1.866",
+    "20220615075543": "rM1 2.14.0.861",
+    "20220615074909": "rM2 2.14.0.861",
+    "20220519120030": "rM2 2.13.0.758",
+    "20220330134519": "rM2 2.12.3.606",
+    "20220330140034": "rM1 2.12.3.606",
+    "20220303120824": "rM2 2.12.2.573",
+    "20220303122245": "rM1 2.12.2.573",
+    "20220202133838": "rM2 2.12.1.527",
+    "20220202133055": "rM1 2.12.1.527",
+    "20211208075454": "rm2 v2.11.0.442",
+    "20211208080907": "rm1 v2.11.0.442",
+    "20211102143141": "rM2 v2.10.3.379",
+    "20211102142308": "rM1 v2.10.3.379",
+    "20211014151303": "rM2 v2.10.2.356",
+    "20211014150444": "rM1 v2.10.2.356",
+    "20210929140057": "rM2 v2.10.1.332",
+    "20210923144714": "rM2 v2.10.0.324",
+    "20210923152158": "rM1 v2.10.0.324",
+    "20210812195523": "rM2 v2.9.1.217",
+    "20210820111232": "rM1 v2.9.1.236",
+    "20210611153600": "rM2 v2.8.0.98",
+    "20210611154039": "rM1 v2.8.0.98",
+    "20210511153632": "rM2 v2.7.1.53",
+    "20210504114631": "rM2 v2.7.0.51",
+    "20210504114855": "rM1 v2.7.0.51",
+    "20210322075357": "rM2 v2.6.2.75",
+    "20210322075617": "rM1 v2.6.2.75",
+    "20210311194323": "rM2 v2.6.1.71",
+    "20210311193614": "rM1 v2.6.1.71"
+}
+
+
 def format_timedelta(
         days: int = 0, hours: int = 0, minutes: int = 0,
         seconds: int = 0) -> str:
@@ -138,213 +223,971 @@ def ssh_cmd_output(client: paramiko.SSHClient, cmd: str) -> str:
     return out.read().decode("utf-8").strip()
 
 
+def free_space_str_cmd(location: str) -> str:
+    """Returns the shell command to query the human readable free/total disk
+    space of the given location."""
+    return '/bin/df -h ' + f'"{location}"' + " | /usr/bin/tail -n1 | /usr/bin/awk '{print $4 \" / \" $2}'"
+
+
+@dataclass
+class DeviceStatus(object):
+    """Summary of the tablet's state, as shown on the main screen."""
+    hostname: str
+    model: str
+    firmware: str
+    free_space_root: str
+    free_space_home: str
+    uptime: str
+    battery_capacity: str
+    battery_health: str
+    battery_temperature: str
+
+
+# The status queries are concatenated into a single remote script, their
+# outputs are separated by this marker line.
+_STATUS_SEPARATOR = '--remass-status--'
+
+
+_STATUS_COMMANDS = (
+    '/bin/cat /etc/hostname',
+    '/bin/cat /sys/devices/soc0/machine',
+    '/bin/cat /etc/version',
+    free_space_str_cmd('/'),
+    free_space_str_cmd('/home'),
+    '/usr/bin/uptime',
+    '/bin/cat /sys/class/power_supply/*_battery/capacity',
+    '/bin/cat /sys/class/power_supply/*_battery/health',
+    '/bin/cat /sys/class/power_supply/*_battery/temp',
+)
+
+
+def device_status_script() -> str:
+    """Returns the shell script which queries all DeviceStatus fields at once."""
+    return f'; /bin/echo "{_STATUS_SEPARATOR}"; '.join(_STATUS_COMMANDS)
+
+
+def parse_device_status(output: str) -> DeviceStatus:
+    """Parses the output of the device_status_script()."""
+    values = [v.strip() for v in output.split(_STATUS_SEPARATOR)]
+    if len(values) != len(_STATUS_COMMANDS):
+        raise ValueError(
+            f'Expected {len(_STATUS_COMMANDS)} status values, got {len(values)}: "{output}"')
+    hostname, model, vstr, free_root, free_home, uptime, capacity, health, temp = values
+    return DeviceStatus(
+        hostname=hostname, model=model,
+        firmware=FIRMWARE_VERSIONS.get(vstr, vstr),
+        free_space_root=free_root, free_space_home=free_home,
+        uptime=format_uptime(uptime),
+        battery_capacity=f'{int(capacity):d}%', battery_health=health,
+        battery_temperature=f'{int(temp) / 10.0:.1f}°C')
+
+
+def network_identifier(hosts: List[str], port: int) -> str:
+    """Identifies the current network by the local addresses which would be
+    used to reach the given hosts (e.g. USB vs. home vs. office Wi-Fi)."""
+    addresses = list()
+    for host in hosts:
+        try:
+            # Connecting a UDP socket doesn't send any packets, it only
+            # selects the route/source address
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.connect((host, port))
+                addresses.append(sock.getsockname()[0])
+        except OSError:
+            addresses.append('-')
+    return ','.join(hosts) + '@' + ','.join(addresses)
+
+
+def load_preferred_host(network: str) -> str:
+    """Returns the host which connected first within the given network."""
+    try:
+        with open(connection_cache_filename(), 'r') as fp:
+            return json.load(fp).get(network, None)
+    except (IOError, ValueError):
+        return None
+
+
+def save_preferred_host(network: str, host: str) -> None:
+    filename = connection_cache_filename()
+    try:
+        with open(filename, 'r') as fp:
+            preferred = json.load(fp)
+    except (IOError, ValueError):
+        preferred = dict()
+    preferred[network] = host
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as fp:
+            json.dump(preferred, fp, indent=2)
+    except IOError as e:
+        logging.getLogger(__name__).warning(f"Cannot store preferred host: {e}")
+
+
+def _close_late_clients(results: queue.Queue, num_pending: int) -> None:
+    """Closes connections which have been established after the race has
+    already been decided."""
+    for _ in range(num_pending):
+        _idx, client, _error = results.get()
+        if client is not None:
+            client.close()
+
+
+def _existing_files(sftp: paramiko.SFTPClient, filenames: List[str]) -> set:
+    """Returns the subset of the remote filenames which exist, listing each
+    folder only once."""
+    existing = set()
+    for folder in set(posixpath.dirname(fn) for fn in filenames):
+        try:
+            existing.update(posixpath.join(folder, fn) for fn in sftp.listdir(folder))
+        except IOError:
+            pass
+    return existing.intersection(filenames)
+
+
+def _write_journal(sftp: paramiko.SFTPClient, filename: str, journal: list) -> None:
+    """Stores the deployment journal, the rename ensures that it is either
+    complete or missing."""
+    with sftp.open(filename + '.part', 'w') as f:
+        f.write(json.dumps(journal, indent=2))
+    sftp.posix_rename(filename + '.part', filename)
+
+
+def instrumented(func: Callable) -> Callable:
+    """Records the calls of the decorated TabletConnection method if metrics
+    collection has been enabled."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self._metrics is None:
+            return func(self, *args, **kwargs)
+        with self._metrics.measure(func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class TabletConnection(object):
+    # Maximum number of idle SFTP sessions kept open on the transport
+    MAX_IDLE_SFTP_SESSIONS = 4
+    # Head start (in seconds) of the preferred host when connecting
+    RACE_HEAD_START = 0.25
+    # Uploads must leave at least this much free space (in KB) on the partition
+    MIN_FREE_SPACE_KB = 1024
+    # Name of the deployment journal within the staging folder, see deploy_files
+    DEPLOY_JOURNAL = 'journal.json'
+
     def __init__(self, config):
         self._cfg = config['connection']
         self._client = None
+        self._pkey = None
+        self._sftp_pool = list()
+        self._sftp_lock = threading.Lock()
+        # Tracks whether the current thread is already within _retry()
+        self._retry_scope = threading.local()
+        self._checksums = None
+        # Remote files read via read_remote_file(): {path: (mtime, size, content)}
+        self._file_cache = dict()
+        self._metrics = None
+        if self._cfg['metrics']:
+            self.enable_metrics()
+
+    @property
+    def metrics(self) -> MetricsCollector:
+        """The metrics collector or None if metrics are disabled."""
+        return self._metrics
+
+    def enable_metrics(self, collector: MetricsCollector = None) -> MetricsCollector:
+        """Starts collecting per-method metrics (also for an already
+        established connection)."""
+        if collector is None:
+            collector = MetricsCollector() if self._metrics is None else self._metrics
+        self._metrics = collector
+        return collector
+
+    def disable_metrics(self) -> None:
+        self._metrics = None
     
-    def _connect(self, host) -> None:
-        self._client = paramiko.SSHClient()
-        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def _create_client(self, host: str, pkey: paramiko.RSAKey) -> paramiko.SSHClient:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-        pkey = self._check_key()
         password = None if pkey is not None else self._cfg['password']
         user = self._cfg['user']
-        self._client.connect(
-            host, username=user, password=password, pkey=pkey,
-            timeout=self._cfg['timeout'], port=self._cfg['port'],
-            look_for_keys=False)
-        logging.getLogger(__name__).info(f'Connected to {self.get_tablet_model()}')
+        profile = select_transport_profile(host, self._cfg['profile'])
+        sock = None
+        try:
+            # Always wrap the socket, so that the transferred bytes can be
+            # measured as soon as metrics are enabled
+            sock = CountingSocket(
+                socket.create_connection(
+                    (host, self._cfg['port']), timeout=self._cfg['timeout']),
+                lambda: self._metrics)
+            client.connect(
+                host, username=user, password=password, pkey=pkey,
+                timeout=self._cfg['timeout'], port=self._cfg['port'],
+                look_for_keys=False, compress=profile.compress, sock=sock)
+        except Exception:
+            client.close()
+            if sock is not None:
+                sock.close()
+            raise
+        profile.apply(client.get_transport())
+        if self._cfg['keepalive'] > 0:
+            client.get_transport().set_keepalive(self._cfg['keepalive'])
+        return client
+
+    def _race_hosts(self, hosts: List[str], pkey: paramiko.RSAKey) -> Tuple[str, paramiko.SSHClient]:
+        """Connects to the given hosts concurrently ("happy eyeballs") and
+        returns the first successfully connected one. Each host gets a head
+        start of RACE_HEAD_START seconds over the next one, unless its
+        connection attempt fails earlier."""
+        results = queue.Queue()
+        go = [threading.Event() for _ in hosts]
+        go[0].set()
+        decided = threading.Event()
+
+        def _attempt(idx: int) -> None:
+            go[idx].wait(idx * TabletConnection.RACE_HEAD_START)
+            if decided.is_set():
+                results.put((idx, None, None))
+                return
+            try:
+                client = self._create_client(hosts[idx], pkey)
+            except Exception as e:
+                if idx + 1 < len(go):
+                    go[idx + 1].set()
+                results.put((idx, None, e))
+                return
+            results.put((idx, client, None))
 
+        for idx in range(len(hosts)):
+            threading.Thread(target=_attempt, args=(idx,), daemon=True).start()
+        errors = dict()
+        for num_results in range(1, len(hosts) + 1):
+            idx, client, error = results.get()
+            if client is None:
+                errors[hosts[idx]] = error
+                continue
+            decided.set()
+            for g in go:
+                g.set()
+            # Close the connections of slower hosts once they're established
+            threading.Thread(
+                target=_close_late_clients,
+                args=(results, len(hosts) - num_results), daemon=True).start()
+            return hosts[idx], client
+        # All attempts failed, report the error of the primary host
+        raise errors.get(self._cfg['host'], next(iter(errors.values())))
+
+    @instrumented
     def open(self) -> None:
+        """Connects to the tablet. If a fallback host is configured, both
+        hosts are tried concurrently and the winner is remembered for the
+        current network, so that it gets a head start next time."""
         if self._client is not None:
             return
-        try:
-            self._connect(self._cfg['host'])
-        except socket.timeout as e:
-            if self._cfg['host_fallback'] is not None:
-                self._connect(self._cfg['host_fallback'])
-            else:
-                raise e
+        # We might connect to a different tablet now
+        self._file_cache = dict()
+        if self._pkey is None:
+            self._pkey = self._check_key()
+        hosts = [h for h in (self._cfg['host'], self._cfg['host_fallback'])
+                 if h is not None and len(h.strip()) > 0]
+        if len(hosts) == 1:
+            self._client = self._create_client(hosts[0], self._pkey)
+        else:
+            network = network_identifier(hosts, self._cfg['port'])
+            preferred = load_preferred_host(network)
+            if preferred in hosts:
+                hosts.remove(preferred)
+                hosts.insert(0, preferred)
+            host, self._client = self._race_hosts(hosts, self._pkey)
+            if host != preferred:
+                save_preferred_host(network, host)
+        logging.getLogger(__name__).info(f'Connected to {self.get_tablet_model()}')
     
+    @instrumented
     def close(self) -> None:
+        with self._sftp_lock:
+            self._clear_sftp_pool()
         if self._client is not None:
             self._client.close()
+            self._client = None
+
+    @instrumented
+    def reconnect(self) -> None:
+        """Drops the current (broken) connection and connects again."""
+        self.close()
+        self.open()
+
+    def _retry(self, operation: Callable[[], Any]) -> Any:
+        """Runs the operation. If the connection drops, we reconnect (with
+        exponential backoff) and run the operation again. Thus, operations
+        must be idempotent (or resumable)."""
+        if getattr(self._retry_scope, 'active', False):
+            # Nested call, the outermost _retry handles reconnects
+            return operation()
+        self._retry_scope.active = True
+        try:
+            attempts = self._cfg['reconnect_attempts']
+            for attempt in range(attempts + 1):
+                try:
+                    if attempt > 0:
+                        time.sleep(self._cfg['reconnect_backoff'] * 2**(attempt - 1))
+                        self.reconnect()
+                    return operation()
+                except PERMANENT_CONNECTION_ERRORS:
+                    raise
+                except CONNECTION_ERRORS as e:
+                    if attempt == attempts:
+                        raise
+                    logging.getLogger(__name__).warning(
+                        f'Connection lost ({e}), reconnecting (attempt {attempt + 1}/{attempts}).')
+        finally:
+            self._retry_scope.active = False
+
+    def _connected_client(self) -> paramiko.SSHClient:
+        """Returns the SSH client, raises a NotConnectedError if the
+        connection hasn't been opened (or has been closed)."""
+        client = self._client
+        if client is None:
+            raise NotConnectedError('Not connected to the tablet, the connection must be opened first.')
+        return client
+
+    def _exec(self, cmd: str) -> str:
+        """Executes the command on the tablet, reconnecting if needed."""
+        def _call():
+            if self._metrics is not None:
+                self._metrics.count_exec()
+            return ssh_cmd_output(self._connected_client(), cmd)
+        return self._retry(_call)
+
+    def _sftp_call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Runs func(sftp, *args, **kwargs) on a pooled SFTP session,
+        reconnecting if needed."""
+        def _call():
+            with self.sftp_session() as sftp:
+                return func(sftp, *args, **kwargs)
+        return self._retry(_call)
 
+    @contextmanager
+    def sftp_session(self) -> Iterator[paramiko.SFTPClient]:
+        """Borrows a long-lived SFTP session from the connection's pool.
+
+        Sessions are reused across calls to avoid the channel setup & SFTP
+        version negotiation per operation. A borrowed session is used
+        exclusively by the caller, so this is safe to use from multiple
+        threads. Sessions which fail with a connection error are discarded.
+        """
+        sftp = self._acquire_sftp()
+        healthy = True
+        num_requests = sftp.request_number
+        try:
+            yield sftp
+        except CONNECTION_ERRORS:
+            healthy = False
+            raise
+        finally:
+            if self._metrics is not None:
+                self._metrics.count_sftp(sftp.request_number - num_requests)
+            self._release_sftp(sftp, healthy)
+
+    def _worker_sftp_session(self) -> Callable[[], AbstractContextManager]:
+        """Returns the sftp_session factory for worker threads. If metrics are
+        enabled, their round trips count towards the operations which are
+        currently running in the calling thread."""
+        if self._metrics is None:
+            return self.sftp_session
+        metrics = self._metrics
+        frames = metrics.current_frames()
+
+        @contextmanager
+        def _session() -> Iterator[paramiko.SFTPClient]:
+            with metrics.attach(frames), self.sftp_session() as sftp:
+                yield sftp
+        return _session
+
+    def _acquire_sftp(self) -> paramiko.SFTPClient:
+        with self._sftp_lock:
+            client = self._connected_client()
+            if not self.is_connected():
+                # The transport is gone, so are all of its channels
+                self._clear_sftp_pool()
+            while len(self._sftp_pool) > 0:
+                sftp = self._sftp_pool.pop()
+                if not sftp.get_channel().closed:
+                    return sftp
+                sftp.close()
+        return client.open_sftp()
+
+    def _release_sftp(self, sftp: paramiko.SFTPClient, healthy: bool) -> None:
+        with self._sftp_lock:
+            if healthy and not sftp.get_channel().closed\
+                    and len(self._sftp_pool) < TabletConnection.MAX_IDLE_SFTP_SESSIONS:
+                self._sftp_pool.append(sftp)
+                return
+        sftp.close()
+
+    def _clear_sftp_pool(self) -> None:
+        """Closes all idle SFTP sessions (caller must hold the pool lock)."""
+        for sftp in self._sftp_pool:
+            sftp.close()
+        self._sftp_pool = list()
+
+    @instrumented
     def restart_ui(self) -> None:
-        ssh_cmd_output(self._client, '/bin/systemctl restart xochitl')
+        self._exec('/bin/systemctl restart xochitl')
 
+    @instrumented
     def reboot_tablet(self) -> None:
-        ssh_cmd_output(self._client, '/sbin/reboot')
+        # Rebooting drops the connection, this must not trigger a reconnect
+        if self._metrics is not None:
+            self._metrics.count_exec()
+        ssh_cmd_output(self._connected_client(), '/sbin/reboot')
 
+    @instrumented
     def get_tablet_model(self) -> str:
-        return ssh_cmd_output(self._client, "/bin/cat /sys/devices/soc0/machine")
+        return self._exec("/bin/cat /sys/devices/soc0/machine")
     
+    @instrumented
     def get_firmware_version(self) -> str:
-        # We can look up the version strings from ddvk's awesome
-        # remarkable-hacks:
-        # https://github.com/ddvk/remarkable-hacks/blob/master/patch.sh
-        version_map = {
-            "20221026103859": "rM1 2.15.1.1189",
-            "20221026104022": "rM2 2.15.1.1189",
-            "20221003074737": "rM1 2.15.0.1067",
-            "20221003075633": "rM2 2.15.0.1067",
-            "20220921102803": "rM1 2.14.3.1047",
-            "20220921101206": "rM2 2.14.3.1047",
-            "20220907142424": "rM1 2.14.3.1005",
-            "20220907143405": "rM2 2.14.3.1005",
-            "20220825124750": "rM2 2.14.3.977",
-            "20220825122914": "rM1 2.14.3.977",
-            "20220617142418": "rM1 2.14.1.866",
-            "20220617143306": "rM2 2.14.1.866",
-            "20220615075543": "rM1 2.14.0.861",
-            "20220615074909": "rM2 2.14.0.861",
-            "20220519120030": "rM2 2.13.0.758",
-            "20220330134519": "rM2 2.12.3.606",
-            "20220330140034": "rM1 2.12.3.606",
-            "20220303120824": "rM2 2.12.2.573",
-            "20220303122245": "rM1 2.12.2.573",
-            "20220202133838": "rM2 2.12.1.527",
-            "20220202133055": "rM1 2.12.1.527",
-            "20211208075454": "rm2 v2.11.0.442",
-            "20211208080907": "rm1 v2.11.0.442",
-            "20211102143141": "rM2 v2.10.3.379",
-            "20211102142308": "rM1 v2.10.3.379",
-            "20211014151303": "rM2 v2.10.2.356",
-            "20211014150444": "rM1 v2.10.2.356",
-            "20210929140057": "rM2 v2.10.1.332",
-            "20210923144714": "rM2 v2.10.0.324",
-            "20210923152158": "rM1 v2.10.0.324",
-            "20210812195523": "rM2 v2.9.1.217",
-            "20210820111232": "rM1 v2.9.1.236",
-            "20210611153600": "rM2 v2.8.0.98",
-            "20210611154039": "rM1 v2.8.0.98",
-            "20210511153632": "rM2 v2.7.1.53",
-            "20210504114631": "rM2 v2.7.0.51",
-            "20210504114855": "rM1 v2.7.0.51",
-            "20210322075357": "rM2 v2.6.2.75",
-            "20210322075617": "rM1 v2.6.2.75",
-            "20210311194323": "rM2 v2.6.1.71",
-            "20210311193614": "rM1 v2.6.1.71"
-        }
-        vstr = ssh_cmd_output(self._client, "/bin/cat /etc/version")
-        return version_map.get(vstr, vstr)
+        vstr = self._exec("/bin/cat /etc/version")
+        return FIRMWARE_VERSIONS.get(vstr, vstr)
 
+    @instrumented
     def get_hostname(self) -> str:
-        return ssh_cmd_output(self._client, "/bin/cat /etc/hostname")
+        return self._exec("/bin/cat /etc/hostname")
 
+    @instrumented
     def set_hostname(self, hostname: str) -> bool:
         hostname = hostname.strip()
         if not is_valid_hostname(hostname):
             return False
-        ssh_cmd_output(
-            self._client,
-             f'/usr/bin/hostnamectl set-hostname "{hostname}"')
+        self._exec(f'/usr/bin/hostnamectl set-hostname "{hostname}"')
         return True
 
+    @instrumented
     def get_free_space_str(self, location: str = '/') -> str:
-        return ssh_cmd_output(
-            self._client,
-            '/bin/df -h ' + f'"{location}"' + " | /usr/bin/tail -n1 | /usr/bin/awk '{print $4 \" / \" $2}'")
+        return self._exec(free_space_str_cmd(location))
 
+    @instrumented
     def get_free_space_kb(self, location: str) -> int:
         try:
             # Use dirname on the remote (because the target file location may
             # not exist, which would cause df to not find the corresponding
             # mounting point)
             return int(
-                ssh_cmd_output(
-                    self._client,
-                    f"/bin/df $(dirname \"{location}\") | /usr/bin/tail -n1 | /usr/bin/awk '{{print $4}}'"))
+                self._exec(f"/bin/df $(dirname \"{location}\") | /usr/bin/tail -n1 | /usr/bin/awk '{{print $4}}'"))
         except ValueError:
             raise NotEnoughDiskSpaceError(
                 f'Cannot determine free space for location "{location}"')
 
+    @instrumented
     def get_uptime(self) -> str:
-        return format_uptime(ssh_cmd_output(self._client, '/usr/bin/uptime'))
+        return format_uptime(self._exec('/usr/bin/uptime'))
 
+    @instrumented
     def get_battery_info(self) -> Tuple[str, str, str]:
         capacity = int(
-            ssh_cmd_output(
-                self._client,
-                "/bin/cat /sys/class/power_supply/*_battery/capacity"))
-        health = ssh_cmd_output(
-            self._client,
-            "/bin/cat /sys/class/power_supply/*_battery/health")
+            self._exec("/bin/cat /sys/class/power_supply/*_battery/capacity"))
+        health = self._exec("/bin/cat /sys/class/power_supply/*_battery/health")
         temp = int(
-            ssh_cmd_output(
-                self._client,
-                "/bin/cat /sys/class/power_supply/*_battery/temp")) / 10.0
+            self._exec("/bin/cat /sys/class/power_supply/*_battery/temp")) / 10.0
         return (f'{capacity:d}%', health, f'{temp:.1f}°C')
 
+    @instrumented
+    def get_device_status(self) -> DeviceStatus:
+        """Queries hostname, model, firmware, free space, uptime and battery
+        information within a single remote command execution."""
+        return parse_device_status(
+            self._exec(device_status_script()))
+
+    @instrumented
     def get_filesystem(
             self) -> Tuple[RCollection, RCollection, Dict[str, RDirEntry]]:
-        return load_remote_filesystem(self._client)
+        return self._sftp_call(load_remote_filesystem)
 
+    @instrumented
     def render_document_by_uuid(
             self, uuid: str, output_filename: str,
             progress_cb: Callable[[float], None], **kwargs) -> None:
-        _root, _trash, dirents = load_remote_filesystem(self._client)
+        _root, _trash, dirents = self.get_filesystem()
         self.render_document(
             dirents[uuid], output_filename, progress_cb, **kwargs)
 
+    @instrumented
     def render_document(
             self, rm_file: RDocument, output_filename: str,
             progress_cb: Callable[[float], None], **kwargs) -> None:
         """kwargs will be passed to rmrl.render()"""
-        render_remote(
-            self._client, rm_file, output_filename, progress_cb, **kwargs)
+        self._sftp_call(
+            render_remote, rm_file, output_filename, progress_cb, **kwargs)
 
-    def download_file(self, remote_filename: str, local_filename: str):
-        """Downloads a file from the tablet to your local disk."""
-        sftp = self._client.open_sftp()
-        sftp.get(remote_filename, local_filename)
-        sftp.close()
+    @instrumented
+    def download_thumbnail(
+            self, rm_file: RDocument, output_basename: str,
+            dpi: int = 20) -> str:
+        """Stores a low-resolution preview of the document's first page at
+        output_basename (the file extension will be appended).
+        :return: filename of the thumbnail or None if it couldn't be created
+        """
+        return self._sftp_call(
+            download_thumbnail_remote, rm_file, output_basename, dpi)
+
+    @instrumented
+    def get_remote_checksum(self, remote_filename: str, algorithm: str = 'md5') -> str:
+        """Returns the hex digest of the remote file (computed on the tablet)."""
+        return transfer.parse_checksum_output(
+            self._exec(transfer.remote_checksum_cmd(remote_filename, algorithm)))
+
+    @instrumented
+    def get_remote_checksums(
+            self, remote_filenames: List[str],
+            algorithm: str = 'md5') -> Dict[str, str]:
+        """Computes the checksums of all given remote files via a single
+        command.
+        :return: dict{remote filename: hex digest}, missing files are omitted
+        """
+        if len(remote_filenames) == 0:
+            return dict()
+        return transfer.parse_checksums_output(
+            self._exec(transfer.remote_checksums_cmd(remote_filenames, algorithm)))
+
+    def _local_checksum(self, local_filename: str, algorithm: str) -> str:
+        if self._checksums is None:
+            self._checksums = transfer.ChecksumCache(checksum_cache_filename())
+        return self._checksums.checksum(local_filename, algorithm)
+
+    @instrumented
+    def identical_files(
+            self, files: List[Tuple[str, str]],
+            algorithm: str = 'md5') -> List[Tuple[str, str]]:
+        """Returns the (local filename, remote filename) pairs for which the
+        tablet already holds the identical file (querying the remote checksums
+        via a single command)."""
+        files = [(lf, rf) for lf, rf in files if os.path.exists(lf)]
+        remote_checksums = self.get_remote_checksums([rf for _, rf in files], algorithm)
+        identical = [(lf, rf) for lf, rf in files
+                     if rf in remote_checksums
+                     and remote_checksums[rf] == self._local_checksum(lf, algorithm)]
+        if self._checksums is not None:
+            self._checksums.save()
+        return identical
+
+    def _verify_checksum(
+            self, local_filename: str, remote_filename: str,
+            algorithm: str) -> bool:
+        return self._local_checksum(local_filename, algorithm) ==\
+            self.get_remote_checksum(remote_filename, algorithm)
+
+    @instrumented
+    def download_file(
+            self, remote_filename: str, local_filename: str,
+            progress_cb: Callable[[float], None] = None,
+            verify: bool = False, algorithm: str = 'md5',
+            skip_identical: bool = True) -> bool:
+        """Downloads a file from the tablet to your local disk. Interrupted
+        downloads will be resumed.
+        :progress_cb: optional callback, invoked with the progress in percent
+        :verify: if True, the checksums of the local & remote file must match.
+                 Otherwise, we download the file again (because the partial
+                 file we resumed from may have been outdated) and raise a
+                 ChecksumMismatchError if this doesn't fix it.
+        :skip_identical: if True and the local file already exists, the
+                 download is skipped if both files have the same checksum
+        :return: True if the file has been downloaded, False if it was skipped
+        """
+        if skip_identical and os.path.exists(local_filename)\
+                and len(self.identical_files([(local_filename, remote_filename)], algorithm)) > 0:
+            return False
+        self._sftp_call(transfer.download, remote_filename, local_filename, progress_cb)
+        if verify and not self._verify_checksum(local_filename, remote_filename, algorithm):
+            self._sftp_call(transfer.download, remote_filename, local_filename, progress_cb)
+            if not self._verify_checksum(local_filename, remote_filename, algorithm):
+                raise transfer.ChecksumMismatchError(
+                    f'Checksum of "{local_filename}" does not match "{remote_filename}".')
+        return True
 
+    @instrumented
+    def read_remote_file(self, remote_filename: str, force: bool = False) -> bytes:
+        """Returns the content of a (small) remote file, e.g. a configuration.
+        The content is cached in memory and only read again if the file's
+        modification time or size changed, which costs a single stat.
+        :force: if True, the file will be read even if it didn't change
+        """
+        def _read(sftp: paramiko.SFTPClient) -> bytes:
+            attr = sftp.stat(remote_filename)
+            cached = self._file_cache.get(remote_filename, None)
+            if not force and cached is not None\
+                    and cached[0] == attr.st_mtime and cached[1] == attr.st_size:
+                return cached[2]
+            with sftp.open(remote_filename, 'rb') as f:
+                f.prefetch(attr.st_size)
+                content = f.read()
+            self._file_cache[remote_filename] = (attr.st_mtime, attr.st_size, content)
+            return content
+        return self._sftp_call(_read)
+
+    @instrumented
     def download_templates(self, dst_folder: str):
         """Downloads all SVG templates, their PNG thumbnails and the
-        templates.json configuration from the tablet to the given dst_folder."""
-        sftp = self._client.open_sftp()
+        templates.json configuration from the tablet to the given dst_folder.
+        Files which have already been downloaded (same size & modification
+        time) will be skipped, so an interrupted download can be resumed.
+        Existing local files with a different modification time are skipped
+        too, if their checksum matches the remote one."""
         rm_template_dir = '/usr/share/remarkable/templates'
-        for fname in sftp.listdir(rm_template_dir):
-            if not (fname.lower().endswith('.svg') or fname.lower().endswith('.png')):
-                continue
-            sftp.get(
-                str(PurePosixPath(rm_template_dir, fname)),
-                os.path.join(dst_folder, fname))
-        # Also back up the configuration JSON
-        cfg_backup = next_backup_filename('templates.json', dst_folder)
-        sftp.get(
-            str(PurePosixPath(rm_template_dir, 'templates.json')), cfg_backup)
-        sftp.close()
 
-    def upload_file(self, local_filename: str, remote_filename: str):
-        """We allow uploading only if there are is at least 1MB free space available."""
-        min_free_space = 1024  # Size in KB
-        # First, check available space (as rM's root partition is quite limited)
-        upload_bytes = os.path.getsize(local_filename) / 1024  # in KB
-        free_space = self.get_free_space_kb(remote_filename)
-        if upload_bytes + min_free_space >= free_space:
+        def _download(sftp: paramiko.SFTPClient) -> None:
+            pending = list()
+            for attr in sftp.listdir_attr(rm_template_dir):
+                fname = attr.filename
+                if not (fname.lower().endswith('.svg') or fname.lower().endswith('.png')):
+                    continue
+                local_filename = os.path.join(dst_folder, fname)
+                if not transfer.is_transferred(local_filename, attr):
+                    pending.append((local_filename, str(PurePosixPath(rm_template_dir, fname)), attr))
+            identical = self.identical_files([(lf, rf) for lf, rf, _ in pending], 'md5')
+            for local_filename, remote_filename, attr in pending:
+                if (local_filename, remote_filename) in identical:
+                    # Adjust the timestamp, so that the cheaper size &
+                    # modification time check succeeds next time
+                    os.utime(local_filename, (attr.st_atime, attr.st_mtime))
+                    continue
+                transfer.download(sftp, remote_filename, local_filename)
+            # Also back up the configuration JSON
+            cfg_backup = next_backup_filename('templates.json', dst_folder)
+            transfer.download(
+                sftp, str(PurePosixPath(rm_template_dir, 'templates.json')), cfg_backup)
+        self._sftp_call(_download)
+
+    @instrumented
+    def backup_xochitl(
+            self, dst_folder: str, max_workers: int = None, delete: bool = True,
+            progress_cb: Callable[[float], None] = None) -> backup.BackupStats:
+        """Incrementally backs up all documents (the xochitl folder) into
+        dst_folder, which can then be loaded via load_local_filesystem().
+        Only new or changed files (size/modification time) will be
+        transferred, using up to max_workers concurrent SFTP sessions.
+        :delete: if True, local files which have been removed from the
+                 tablet will be deleted from dst_folder
+        :progress_cb: optional callback, invoked with the progress in percent
+        """
+        if max_workers is None:
+            max_workers = TabletConnection.MAX_IDLE_SFTP_SESSIONS
+        # If the connection drops, we simply start over (which skips all
+        # files that have already been transferred)
+        return self._retry(lambda: backup.backup_xochitl(
+            self._worker_sftp_session(), dst_folder, max_workers, delete, progress_cb))
+
+    def _stream_compression(self, compression: str) -> str:
+        """Resolves 'auto' to the stream compression of the current link."""
+        if compression != 'auto':
+            return compression
+        host = self._connected_client().get_transport().getpeername()[0]
+        return select_transport_profile(host, self._cfg['profile']).stream_compression
+
+    @instrumented
+    def backup_xochitl_tar(self, dst: str, compression: str = 'auto') -> int:
+        """Backs up all documents via a single tar stream, which avoids the
+        per-file overhead of SFTP (thus, it is much faster than
+        backup_xochitl for a first full backup, but always transfers all
+        files).
+        :dst: folder to extract the stream into, or the filename of an
+              archive (.tar, .tar.gz or .tgz, the extension determines the
+              compression)
+        :compression: 'gzip', 'none' or 'auto' (chosen by the transport profile)
+        :return: number of transferred bytes
+        """
+        def _call():
+            comp = backup.archive_compression(dst) or self._stream_compression(compression)
+            if self._metrics is not None:
+                self._metrics.count_exec()
+            _in, out, err = self._connected_client().exec_command(backup.tar_backup_cmd(comp))
+            num_bytes = backup.receive_tar_stream(out, dst, comp)
+            if out.channel.recv_exit_status() != 0:
+                raise RemoteCommandError(
+                    f'Creating the tar stream failed: {err.read().decode("utf-8").strip()}')
+            return num_bytes
+        return self._retry(_call)
+
+    @instrumented
+    def restore_xochitl_tar(self, src: str, compression: str = 'auto') -> None:
+        """Restores the documents from a backup folder or archive (see
+        backup_xochitl_tar) via a single tar stream and restarts the UI.
+        Files on the tablet which are not part of the backup are kept.
+        :compression: 'gzip', 'none' or 'auto' (chosen by the transport
+              profile), ignored for archives
+        """
+        def _call():
+            comp = backup.archive_compression(src) or self._stream_compression(compression)
+            if self._metrics is not None:
+                self._metrics.count_exec()
+            stdin, out, err = self._connected_client().exec_command(backup.tar_restore_cmd(comp))
+            backup.send_tar_stream(src, stdin, comp)
+            stdin.channel.shutdown_write()
+            if out.channel.recv_exit_status() != 0:
+                raise RemoteCommandError(
+                    f'Extracting the tar stream failed: {err.read().decode("utf-8").strip()}')
+        self._retry(_call)
+        self.restart_ui()
+
+    @instrumented
+    def import_documents(
+            self, filenames: List[str], collection: RCollection = None,
+            skip_existing: bool = True, max_workers: int = None,
+            progress_cb: Callable[[float], None] = None,
+            restart_ui: bool = True) -> List[str]:
+        """Adds the given PDF/EPUB files to the tablet, using up to
+        max_workers concurrent SFTP sessions. The free space is checked once
+        for all documents and the UI is restarted only once at the end.
+        :collection: target collection, None for the root ("My Files")
+        :skip_existing: if True, documents with the same visible name as an
+                 existing document in the target collection will be skipped
+        :progress_cb: optional callback, invoked with the progress in percent
+        :return: UUIDs of the imported documents
+        """
+        parent_uuid = None if collection is None or collection.uuid == 'root' else collection.uuid
+        documents = [importer.import_document(fn) for fn in filenames]
+        if skip_existing:
+            _root, _trash, dirents = self.get_filesystem()
+            # The file system representation assigns top-level entries to 'root'
+            target_uuid = 'root' if parent_uuid is None else parent_uuid
+            existing = set(d.visible_name for d in dirents.values()
+                           if isinstance(d, RDocument) and (d.parent_uuid or 'root') == target_uuid)
+            documents = [doc for doc in documents if doc.visible_name not in existing]
+        if len(documents) == 0:
+            return list()
+        upload_kb = sum(doc.size for doc in documents) / 1024
+        free_space = self.get_free_space_kb(REMOTE_XOCHITL_DIR)
+        if upload_kb + TabletConnection.MIN_FREE_SPACE_KB >= free_space:
             raise NotEnoughDiskSpaceError(
-                f'Upload of "{local_filename}" ({upload_bytes} KB) '
-                f'to "{remote_filename}" '
-                f'would lead to less than {min_free_space} KB on '
+                f'Importing {len(documents)} documents ({upload_kb:.0f} KB) would lead '
+                f'to less than {TabletConnection.MIN_FREE_SPACE_KB} KB on '
                 f'partition (free: {free_space} KB).')
+        if max_workers is None:
+            max_workers = TabletConnection.MAX_IDLE_SFTP_SESSIONS
+        uuids = self._retry(lambda: importer.import_documents(
+            self._worker_sftp_session(), documents, parent_uuid, max_workers, progress_cb))
+        if restart_ui:
+            self.restart_ui()
+        return uuids
+
+    @instrumented
+    def snapshot_xochitl(
+            self, store: SnapshotStore, max_workers: int = None) -> Snapshot:
+        """Creates a deduplicated snapshot of all documents within the given
+        store. Only files which changed since the store's latest snapshot
+        will be transferred, using up to max_workers concurrent SFTP sessions."""
+        if max_workers is None:
+            max_workers = TabletConnection.MAX_IDLE_SFTP_SESSIONS
+        return self._retry(lambda: store.snapshot_remote(self._worker_sftp_session(), max_workers))
+
+    @instrumented
+    def upload_file(
+            self, local_filename: str, remote_filename: str,
+            progress_cb: Callable[[float], None] = None,
+            verify: bool = False, algorithm: str = 'md5',
+            skip_identical: bool = True) -> bool:
+        """We allow uploading only if there are is at least 1MB free space available.
+        Interrupted uploads will be resumed.
+        :progress_cb: optional callback, invoked with the progress in percent
+        :verify: if True, the checksums of the local & remote file must match.
+                 Otherwise, we upload the file again and raise a
+                 ChecksumMismatchError if this doesn't fix it.
+        :skip_identical: if True, the upload is skipped if the tablet already
+                 holds a file with the same checksum
+        :return: True if the file has been uploaded, False if it was skipped
+        """
+        if skip_identical\
+                and len(self.identical_files([(local_filename, remote_filename)], algorithm)) > 0:
+            return False
+        self._retry(lambda: self._upload_file(local_filename, remote_filename, progress_cb))
+        if verify and not self._verify_checksum(local_filename, remote_filename, algorithm):
+            self._retry(lambda: self._upload_file(local_filename, remote_filename, progress_cb))
+            if not self._verify_checksum(local_filename, remote_filename, algorithm):
+                raise transfer.ChecksumMismatchError(
+                    f'Checksum of "{remote_filename}" does not match "{local_filename}".')
+        return True
+
+    @instrumented
+    def upload_files(
+            self, files: List[Tuple[str, str]], verify: bool = False,
+            algorithm: str = 'md5', skip_identical: bool = True,
+            progress_cb: Callable[[float], None] = None) -> List[str]:
+        """Uploads multiple files over a single SFTP session (pipelined across
+        files). The free space is checked once per affected partition for the
+        total payload.
+        :files: list of (local filename, remote filename) pairs
+        :verify: if True, the checksums of all uploaded files are compared
+                 (via a single command), raises a ChecksumMismatchError
+        :skip_identical: if True, files which the tablet already holds are
+                 skipped, the remote checksums are queried via a single command
+        :progress_cb: optional callback, invoked with the progress in percent
+        :return: list of the remote filenames which have been uploaded
+        """
+        if skip_identical:
+            identical = self.identical_files(files, algorithm)
+            files = [f for f in files if f not in identical]
+        if len(files) == 0:
+            return list()
+        self.check_free_space(files)
+        for _, rf in files:
+            self._file_cache.pop(rf, None)
+        self._sftp_call(transfer.upload_batch, files, progress_cb)
+        if verify:
+            identical = self.identical_files(files, algorithm)
+            mismatches = [rf for lf, rf in files if (lf, rf) not in identical]
+            if len(mismatches) > 0:
+                raise transfer.ChecksumMismatchError(
+                    f'Checksums of {", ".join(mismatches)} do not match the local files.')
+        return [rf for _, rf in files]
+
+    @instrumented
+    def deploy_files(
+            self, files: List[Tuple[str, str]], staging_dir: str,
+            algorithm: str = 'md5',
+            progress_cb: Callable[[float], None] = None) -> None:
+        """Uploads the (local filename, remote filename) pairs into the
+        staging_dir first, verifies their checksums and only then moves them
+        to their destinations via renames. Thus, an interrupted transfer
+        never leaves the tablet with a partially updated set of files.
+
+        Before the files are moved, the originals are hard-linked into the
+        staging_dir and a journal is stored. If moving fails, the originals
+        are restored immediately. If the swap is interrupted (e.g. the SSH
+        session drops), the journal remains and the next deployment (or
+        recover_deployment) rolls back. Removing the journal commits the
+        deployment.
+        The staging_dir must be on the same partition as the destinations
+        (renames and hard links only work within a file system).
+        :progress_cb: optional callback, invoked with the upload progress in percent
+        """
+        if len(files) == 0:
+            return
+        self.recover_deployment(staging_dir)
+        # Prefix the staged files to avoid collisions of equal basenames
+        staged = [(lf, posixpath.join(staging_dir, f'{idx:04d}-{posixpath.basename(rf)}'))
+                  for idx, (lf, rf) in enumerate(files)]
+        self._exec_checked(
+            f'/bin/rm -rf {shlex.quote(staging_dir)} && /bin/mkdir -p {shlex.quote(staging_dir)}',
+            f'Cannot create staging folder "{staging_dir}"')
+        self.check_free_space(staged)
+        self._sftp_call(transfer.upload_batch, staged, progress_cb)
+        identical = self.identical_files(staged, algorithm)
+        mismatches = [rf for lf, rf in staged if (lf, rf) not in identical]
+        if len(mismatches) > 0:
+            raise transfer.ChecksumMismatchError(
+                f'Checksums of the staged files {", ".join(mismatches)} do not match the local files.')
+        # Keep the originals (hard links cost neither time nor space)
+        existing = self._sftp_call(_existing_files, [rf for _, rf in files])
+        journal = [{'staged': sf, 'destination': rf,
+                    'original': sf + '.orig' if rf in existing else None}
+                   for (_, sf), (_, rf) in zip(staged, files)]
+        links = [f'/bin/ln -f {shlex.quote(entry["destination"])} {shlex.quote(entry["original"])}'
+                 for entry in journal if entry['original'] is not None]
+        if len(links) > 0:
+            self._exec_checked(' && '.join(links), f'Cannot back up the original files into "{staging_dir}"')
+        self._sftp_call(_write_journal, posixpath.join(staging_dir, self.DEPLOY_JOURNAL), journal)
+        for _, rf in files:
+            self._file_cache.pop(rf, None)
+        moves = [f'/bin/mv -f {shlex.quote(entry["staged"])} {shlex.quote(entry["destination"])}'
+                 for entry in journal]
+        try:
+            self._exec_checked(' && '.join(moves), f'Moving the staged files from "{staging_dir}" failed')
+        except Exception:
+            logging.getLogger(__name__).error(
+                f'Deployment via "{staging_dir}" failed, restoring the original files.')
+            self.recover_deployment(staging_dir)
+            raise
+        # Removing the journal commits the deployment
+        self._exec_checked(
+            f'/bin/rm -f {shlex.quote(posixpath.join(staging_dir, self.DEPLOY_JOURNAL))}'
+            f' && /bin/rm -rf {shlex.quote(staging_dir)}',
+            f'Cannot remove staging folder "{staging_dir}"')
+        logging.getLogger(__name__).info(
+            f'Deployed {len(files)} files via staging folder "{staging_dir}".')
+
+    @instrumented
+    def recover_deployment(self, staging_dir: str) -> bool:
+        """Rolls back an incomplete deployment, i.e. restores the original
+        files if the staging_dir still contains a journal, see deploy_files.
+        :return: True if a deployment has been rolled back
+        """
+        journal_fn = posixpath.join(staging_dir, self.DEPLOY_JOURNAL)
+        try:
+            journal = json.loads(self.read_remote_file(journal_fn, force=True))
+        except IOError:
+            return False
+        restores = [f'/bin/mv -f {shlex.quote(entry["original"])} {shlex.quote(entry["destination"])}'
+                    if entry['original'] is not None else f'/bin/rm -f {shlex.quote(entry["destination"])}'
+                    for entry in journal]
+        self._exec_checked(' && '.join(restores + [f'/bin/rm -f {shlex.quote(journal_fn)}']),
+                           f'Cannot restore the original files from "{staging_dir}"')
+        self._file_cache.pop(journal_fn, None)
+        for entry in journal:
+            self._file_cache.pop(entry['destination'], None)
+        logging.getLogger(__name__).warning(
+            f'Rolled back the incomplete deployment of {len(journal)} files via "{staging_dir}".')
+        return True
+
+    def _exec_checked(self, cmd: str, error_msg: str) -> None:
+        """Executes the command on the tablet, raises a RemoteCommandError
+        if it fails."""
+        output = self._exec(cmd + ' && /bin/echo success')
+        if not output.endswith('success'):
+            raise RemoteCommandError(error_msg + ('' if len(output) == 0 else f': {output}'))
+
+    @instrumented
+    def check_free_space(self, files: List[Tuple[str, str]]) -> None:
+        """Ensures that uploading the (local filename, remote filename) pairs
+        leaves at least MIN_FREE_SPACE_KB on each affected partition (as
+        rM's root partition is quite limited). All partitions are queried via
+        a single command."""
+        folders = sorted(set(posixpath.dirname(rf) for _, rf in files))
+        # POSIX output format, i.e. one line per location (otherwise, long
+        # device names are wrapped onto a separate line)
+        output = self._exec('/bin/df -P ' + ' '.join(shlex.quote(folder) for folder in folders))
+        # Skip the header, each line is: filesystem, blocks, used, available, use%, mount point
+        lines = [line.split(None, 5) for line in output.splitlines()[1:]]
+        if len(lines) != len(folders) or any(len(tokens) < 6 for tokens in lines):
+            raise NotEnoughDiskSpaceError(
+                f'Cannot determine free space for locations: {", ".join(folders)}')
+        free_space = dict()
+        partitions = dict()
+        for folder, tokens in zip(folders, lines):
+            free_space[tokens[5]] = int(tokens[3])
+            partitions[folder] = tokens[5]
+        upload_kb = dict()
+        for lf, rf in files:
+            partition = partitions[posixpath.dirname(rf)]
+            upload_kb[partition] = upload_kb.get(partition, 0) + os.path.getsize(lf) / 1024
+        for partition, required in upload_kb.items():
+            if required + TabletConnection.MIN_FREE_SPACE_KB >= free_space[partition]:
+                raise NotEnoughDiskSpaceError(
+                    f'Uploading {required:.0f} KB would lead to less than '
+                    f'{TabletConnection.MIN_FREE_SPACE_KB} KB on partition "{partition}" '
+                    f'(free: {free_space[partition]} KB).')
+
+    def _upload_file(
+            self, local_filename: str, remote_filename: str,
+            progress_cb: Callable[[float], None]):
+        # First, check available space (as rM's root partition is quite limited)
+        self.check_free_space([(local_filename, remote_filename)])
         # Now it's safe to upload the file
-        sftp = self._client.open_sftp()
-        sftp.put(local_filename, remote_filename)
-        sftp.close()
+        self._file_cache.pop(remote_filename, None)
+        with self.sftp_session() as sftp:
+            transfer.upload(sftp, local_filename, remote_filename, progress_cb)
 
+    @instrumented
     def get_remote_time(self) -> str:
         """Returns a string representation of the tablet's current date & time."""
-        return ssh_cmd_output(self._client, '/bin/date +"%Y-%m-%d %H:%M %Z"')
+        return self._exec('/bin/date +"%Y-%m-%d %H:%M %Z"')
 
+    @instrumented
     def set_remote_timezone(self, tz: str) -> None:
         """Changes the tablet's timezone to the given 'tz' string, e.g. 'UTC', 
         'CET', etc. You have to ensure that you provide the non-DST timezone,
         i.e. 'CET' instead of 'CEST'!
         """
-        ssh_cmd_output(self._client, f'/usr/bin/timedatectl set-timezone "{tz}"')
+        self._exec(f'/usr/bin/timedatectl set-timezone "{tz}"')
 
     def is_connected(self) -> bool:
         # Returns True if the client is still connected and the session is
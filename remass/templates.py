@@ -1,11 +1,19 @@
+import copy
+import functools
 import json
+import logging
 import os
 import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import PurePosixPath
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
+from PIL import Image
+from reportlab.graphics import renderPM
+from svglib.svglib import svg2rlg
 from remass.config import RemassConfig, latest_backup_filename,\
-    next_backup_filename
+    next_backup_filename, prune_backups
 from remass.tablet import TabletConnection
 
 
@@ -15,6 +23,94 @@ RM_TEMPLATE_PATH = '/usr/share/remarkable/templates'
 RM_TEMPLATE_JSON_PATH = '/usr/share/remarkable/templates/templates.json'
 
 
+# Template deployments are staged within this folder (on the same partition
+# as the templates, so that files can be moved atomically)
+RM_TEMPLATE_STAGING_PATH = '/usr/share/remarkable/.templates-staging'
+
+
+# Size (width, height) of the tablet's (portrait) template images
+TEMPLATE_PREVIEW_SIZE = (1404, 1872)
+
+
+def render_template_preview(svg_filename: str, png_filename: str) -> str:
+    """Rasterizes the SVG template into a grayscale PNG, as used by the
+    tablet. The drawing is scaled (and centered) to fit the screen.
+    :return: png_filename
+    """
+    drawing = svg2rlg(svg_filename)
+    if drawing is None or drawing.width <= 0 or drawing.height <= 0:
+        raise ValueError(f'Cannot parse SVG template "{svg_filename}"')
+    width, height = TEMPLATE_PREVIEW_SIZE if drawing.width <= drawing.height\
+        else TEMPLATE_PREVIEW_SIZE[::-1]
+    scale = min(width / drawing.width, height / drawing.height)
+    img = renderPM.drawToPIL(drawing, dpi=72 * scale, bg=0xffffff).convert('L')
+    if img.size != (width, height):
+        canvas = Image.new('L', (width, height), 255)
+        canvas.paste(img.crop((0, 0, min(width, img.width), min(height, img.height))),
+                     ((width - min(width, img.width)) // 2, (height - min(height, img.height)) // 2))
+        img = canvas
+    # Write via a temporary file, so we never leave a partial preview
+    tmp_filename = png_filename + '.part'
+    img.save(tmp_filename, format='PNG', optimize=True)
+    os.replace(tmp_filename, png_filename)
+    return png_filename
+
+
+def is_preview_stale(svg_filename: str, png_filename: str) -> bool:
+    """Returns True if the PNG preview doesn't exist or is older than the SVG."""
+    return not os.path.exists(png_filename)\
+        or os.path.getmtime(png_filename) < os.path.getmtime(svg_filename)
+
+
+def _render_preview_task(svg_filename: str, png_filename: str) -> Tuple[Optional[str], Optional[str]]:
+    # Runs in a worker process, so errors are reported back to the caller
+    # instead of being logged from within the worker.
+    try:
+        return render_template_preview(svg_filename, png_filename), None
+    except Exception as e:
+        return None, f'Cannot render preview of "{svg_filename}": {e}'
+
+
+def generate_template_previews(
+        folder: str, max_workers: int = None, force: bool = False) -> List[str]:
+    """Renders the PNG previews of all SVG templates within the folder which
+    are missing or outdated (i.e. older than the SVG), using a process pool.
+    SVGs which cannot be rendered are skipped (and logged).
+    :force: if True, all previews will be rendered again
+    :return: filenames of the rendered previews
+    """
+    tasks = list()
+    for fn in sorted(os.listdir(folder)):
+        stem, ext = os.path.splitext(fn)
+        if ext.lower() != '.svg':
+            continue
+        svg_filename = os.path.join(folder, fn)
+        png_filename = os.path.join(folder, stem + '.png')
+        if force or is_preview_stale(svg_filename, png_filename):
+            tasks.append((svg_filename, png_filename))
+    if len(tasks) == 0:
+        return list()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_render_preview_task, *task) for task in tasks]
+        results = [future.result() for future in futures]
+    rendered = list()
+    for fn, error in results:
+        if error is not None:
+            logging.getLogger(__name__).warning(error)
+        elif fn is not None:
+            rendered.append(fn)
+    logging.getLogger(__name__).info(
+        f'Rendered {len(rendered)} template previews in "{folder}".')
+    return rendered
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_template_config(tpl_json: str) -> Dict:
+    """Parses the content of a templates.json file (callers must not modify
+    the cached result)."""
+    return json.loads(tpl_json)
+
+
 def template_name(tpl: dict) -> str:
     """Returns a displayable name for the given template configuration"""
     if 'landscape' in tpl:
@@ -22,22 +118,135 @@ def template_name(tpl: dict) -> str:
     return tpl['name']
 
 
-def _exists_custom_template(custom: dict, tablet_config: dict) -> bool:
-    """Checks if the given template entry already exists within the
-    tablet's configuration."""
-    for t in tablet_config['templates']:
-        if _equal_template(custom, t):
-            return True
-    return False
+def template_key(tpl: dict) -> Tuple[str, bool]:
+    """Returns the unique key of a template configuration, i.e. two entries
+    with the same name & orientation refer to the same template."""
+    return tpl['name'], tpl.get('landscape', False)
+
+
+class TemplateCatalog(object):
+    """Collection of template configurations (i.e. templates.json entries),
+    indexed by key (name & orientation), filename and category.
+
+    templates.json may contain several entries with the same key (e.g. stock
+    and third-party entries). These are kept as they are, until a template
+    with this key is added or removed."""
+    def __init__(self, templates: List[Dict] = list()):
+        # Insertion-ordered: {entry id: template}
+        self._entries = dict()
+        self._next_id = 0
+        # {key: [entry id]}
+        self._by_key = dict()
+        # {filename: {entry id: template}}
+        self._by_filename = dict()
+        # {category: {entry id: template}}
+        self._by_category = dict()
+        for tpl in templates:
+            self._append(tpl)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter(self._entries.values())
+
+    def __contains__(self, tpl: Dict) -> bool:
+        return template_key(tpl) in self._by_key
 
+    @property
+    def templates(self) -> List[Dict]:
+        """All templates in insertion order (as in templates.json)."""
+        return list(self._entries.values())
 
-def _equal_template(tpl_a: dict, tpl_b: dict) -> bool:
-    """Checks if the two template configs are the same"""
-    if tpl_a['name'] == tpl_b['name']:
-        al = tpl_a['landscape'] if 'landscape' in tpl_a else False
-        bl = tpl_b['landscape'] if 'landscape' in tpl_b else False
-        return al == bl
-    return False
+    def sorted(self) -> List[Dict]:
+        """All templates sorted by their displayable name."""
+        return sorted(self._entries.values(), key=lambda e: template_name(e))
+
+    def get(self, name: str, landscape: bool = False) -> Optional[Dict]:
+        """Returns the (last listed) template with the given key or None."""
+        ids = self._by_key.get((name, landscape), None)
+        return None if ids is None else self._entries[ids[-1]]
+
+    def by_filename(self, filename: str) -> List[Dict]:
+        """Returns all templates which use the given SVG/PNG filename (without
+        extension)."""
+        return list(self._by_filename.get(filename, dict()).values())
+
+    def by_category(self, category: str) -> List[Dict]:
+        return list(self._by_category.get(category, dict()).values())
+
+    def categories(self) -> List[str]:
+        return sorted(self._by_category.keys())
+
+    def add(self, tpl: Dict) -> List[Dict]:
+        """Adds the template. All existing templates with the same key will be
+        replaced, i.e. the new one will be listed last.
+        :return: the replaced templates
+        """
+        key = template_key(tpl)
+        ids = self._by_key.get(key, list())
+        if len(ids) == 1 and self._entries[ids[0]] == tpl:
+            # Unchanged, keep its position
+            return [self._entries[ids[0]]]
+        replaced = self.remove(tpl)
+        self._append(tpl)
+        return replaced
+
+    def remove(self, tpl: Dict) -> List[Dict]:
+        """Removes all templates with the same key.
+        :return: the removed templates
+        """
+        removed = list()
+        for entry_id in self._by_key.pop(template_key(tpl), list()):
+            existing = self._entries.pop(entry_id)
+            _remove_from_index(self._by_filename, existing.get('filename'), entry_id)
+            for category in existing.get('categories', list()):
+                _remove_from_index(self._by_category, category, entry_id)
+            removed.append(existing)
+        return removed
+
+    def _append(self, tpl: Dict) -> None:
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = tpl
+        self._by_key.setdefault(template_key(tpl), list()).append(entry_id)
+        self._by_filename.setdefault(tpl.get('filename'), dict())[entry_id] = tpl
+        for category in tpl.get('categories', list()):
+            self._by_category.setdefault(category, dict())[entry_id] = tpl
+
+
+def _remove_from_index(index: Dict[str, Dict], value: str, entry_id: int) -> None:
+    entries = index.get(value, None)
+    if entries is not None:
+        entries.pop(entry_id, None)
+        if len(entries) == 0:
+            del index[value]
+
+
+@dataclass
+class TemplateSyncPlan(object):
+    """Delta between the requested template configuration and the tablet,
+    see TemplateOrganizer.plan_synchronization()."""
+    # Tablet's original templates.json (as is)
+    original_json: str
+    # Tablet's template configuration after the synchronization
+    tablet_config: Dict
+    # Templates which will be added or replaced
+    added_templates: List[Dict]
+    # (local, remote) files which differ from the tablet's files
+    uploads: List[Tuple[str, str]]
+    # (local, remote) files which the tablet already holds
+    unchanged: List[Tuple[str, str]]
+    # Whether templates.json must be updated
+    config_changed: bool
+
+    @property
+    def upload_bytes(self) -> int:
+        return sum(os.path.getsize(lf) for lf, _ in self.uploads)
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self.uploads) == 0 and not self.config_changed
 
 
 class TemplateOrganizer(object):
@@ -46,16 +255,28 @@ class TemplateOrganizer(object):
         self._connection = connection
         self.local_template_config = None
 
-    def load_remote_templates(self):
-        """Loads the template configuration from the tablet."""
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download the tablet's templates.json
-            temp_tpljson = os.path.join(temp_dir, 'templates.json')
-            self._connection.download_file(RM_TEMPLATE_JSON_PATH, temp_tpljson)
-            # Load the tablet's templates.json
-            with open(temp_tpljson, 'r') as jf:
-                tablet_config = json.load(jf)
-                return sorted(tablet_config['templates'], key=lambda e: template_name(e))
+    def _load_tablet_config(self, force: bool = False) -> Tuple[str, Dict]:
+        """Returns the tablet's templates.json as is and as (a private copy
+        of the) parsed configuration."""
+        tpl_json = self._connection.read_remote_file(RM_TEMPLATE_JSON_PATH, force).decode('utf-8')
+        return tpl_json, copy.deepcopy(_parse_template_config(tpl_json))
+
+    def get_remote_catalog(self, force: bool = False) -> TemplateCatalog:
+        """Returns the catalog of templates configured on the tablet. The
+        configuration is cached (per connection) and will only be downloaded
+        again if the tablet's templates.json changed.
+        :force: if True, the configuration will be downloaded in any case
+        """
+        _, tablet_config = self._load_tablet_config(force)
+        return TemplateCatalog(tablet_config['templates'])
+
+    def get_remote_templates(self, force: bool = False) -> List[Dict]:
+        """Returns the templates configured on the tablet, see get_remote_catalog()."""
+        return self.get_remote_catalog(force).sorted()
+
+    def load_remote_templates(self) -> List[Dict]:
+        """Loads the template configuration from the tablet, see get_remote_templates()."""
+        return self.get_remote_templates()
 
     def load_backedup_templates(self):
         """Loads the templates from the latest backed up 'templates.json' file."""
@@ -66,6 +287,11 @@ class TemplateOrganizer(object):
             tcfg = json.load(jf)
             return sorted(tcfg['templates'], key=lambda e: template_name(e))
 
+    def generate_previews(self, max_workers: int = None, force: bool = False) -> List[str]:
+        """Renders missing or outdated PNG previews of the custom templates,
+        see generate_template_previews()."""
+        return generate_template_previews(self._cfg.template_dir, max_workers, force)
+
     def load_uploadable_templates(self):
         """Loads all custom templates which are uploadable, i.e. there must be:
         * a "name".inc.json configuration
@@ -86,6 +312,51 @@ class TemplateOrganizer(object):
                         tpls.append(e)
         return sorted(tpls, key=lambda e: template_name(e))
 
+    def plan_synchronization(
+            self, templates_to_add: List[Dict] = list(), replace_templates: bool = False,
+            templates_to_disable: list = list()) -> TemplateSyncPlan:
+        """Computes the full delta against the tablet without changing
+        anything, i.e. the adjusted templates.json and the SVG/PNG files
+        which must be uploaded. The tablet's checksums are queried via a
+        single command. See synchronize() for the parameters.
+        """
+        original_json, tablet_config = self._load_tablet_config()
+        catalog = TemplateCatalog(tablet_config['templates'])
+
+        # Collect files to upload and adjust the tablet's config for the
+        # requested uploads:
+        added = list()
+        candidates = list()
+        for tpl in templates_to_add:
+            # Sanity check: the local files must exist
+            src_svg = os.path.join(self._cfg.template_dir, tpl['filename'] + '.svg')
+            src_png = os.path.join(self._cfg.template_dir, tpl['filename'] + '.png')
+            if not os.path.exists(src_svg) or not os.path.exists(src_png):
+                continue
+            # Do we want to overwrite (e.g. changing the icon or whatever)?
+            if tpl in catalog and not replace_templates:
+                continue
+            catalog.add(tpl)
+            added.append(tpl)
+            candidates.append((src_svg, str(PurePosixPath(RM_TEMPLATE_PATH, tpl['filename'] + '.svg'))))
+            candidates.append((src_png, str(PurePosixPath(RM_TEMPLATE_PATH, tpl['filename'] + '.png'))))
+
+        # Remove the disabled templates from the tablet's config
+        for tpl in templates_to_disable:
+            catalog.remove(tpl)
+
+        # Skip files which are already on the tablet (templates often share
+        # the same files, e.g. portrait & landscape variants)
+        candidates = list(dict.fromkeys(candidates))
+        unchanged = self._connection.identical_files(candidates) if len(candidates) > 0 else list()
+        uploads = [f for f in candidates if f not in unchanged]
+        original_templates = tablet_config['templates']
+        tablet_config['templates'] = catalog.templates
+        return TemplateSyncPlan(
+            original_json=original_json, tablet_config=tablet_config,
+            added_templates=added, uploads=uploads, unchanged=unchanged,
+            config_changed=(tablet_config['templates'] != original_templates))
+
     def synchronize(self, templates_to_add: List[Dict] = list(), replace_templates: bool = False,
                     templates_to_disable: list = list(), backup_template_json: bool = True):
         """
@@ -106,59 +377,43 @@ class TemplateOrganizer(object):
         """
         if len(templates_to_add) == 0 and len(templates_to_disable) == 0:
             return None
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download the tablet's templates.json
-            temp_tpljson = os.path.join(temp_dir, 'templates.json')
-            self._connection.download_file(RM_TEMPLATE_JSON_PATH, temp_tpljson)
-            # Load the tablet's templates.json
-            with open(temp_tpljson, 'r') as jf:
-                tablet_config = json.load(jf)
-            tpl_fn_backup = None
-            if backup_template_json:
-                # Store the downloaded templates.json into the remass backup
-                # folder, in case we need/want to restore it later on
-                tpl_fn_backup = next_backup_filename('templates.json', self._cfg.template_backup_dir)
-                shutil.copyfile(temp_tpljson, tpl_fn_backup)
-
-            # Collect files to upload and adjust the tablet's config for the
-            # requested uploads:
-            upload_files = list()
-            for tpl in templates_to_add:
-                # Sanity check: the local files must exist
-                src_svg = os.path.join(self._cfg.template_dir, tpl['filename'] + '.svg')
-                src_png = os.path.join(self._cfg.template_dir, tpl['filename'] + '.png')
-                if os.path.exists(src_svg) and os.path.exists(src_png):
-                    dst_svg = str(PurePosixPath(RM_TEMPLATE_PATH, tpl['filename'] + '.svg'))
-                    dst_png = str(PurePosixPath(RM_TEMPLATE_PATH, tpl['filename'] + '.png'))
-                    add = False
-                    # Update the tablet's config:
-                    if _exists_custom_template(tpl, tablet_config):
-                        # Do we want to overwrite (e.g. changing the icon or whatever)?
-                        if replace_templates:
-                            tablet_config['templates'] = [e for e in tablet_config['templates'] if not _equal_template(tpl, e)]
-                            tablet_config['templates'].append(tpl)
-                            add = True
-                    else:
-                        tablet_config['templates'].append(tpl)
-                        add = True
-                    if add:
-                        upload_files.append((src_svg, dst_svg))
-                        upload_files.append((src_png, dst_png))
-                        # Also copy the SVG file to our local backup location,
-                        # so it is available for future exports:
-                        shutil.copyfile(src_svg,
-                                        os.path.join(self._cfg.template_backup_dir, tpl['filename'] + '.svg'))
-
-            # Remove the disabled templates from the tablet's config
-            for tpl in templates_to_disable:
-                tablet_config['templates'] = [e for e in tablet_config['templates'] if not _equal_template(tpl, e)]
-            # Save modified templates.json (locally)
-            with open(temp_tpljson, 'w') as jf:
-                json.dump(tablet_config, jf, indent=2)
-            upload_files.append((temp_tpljson, RM_TEMPLATE_JSON_PATH))
-            # Upload files
-            for src, dst in upload_files:
-                self._connection.upload_file(src, dst)
-            # Restart tablet UI to force reloading the changed templates
-            self._connection.restart_ui()
+        # Roll back an interrupted deployment first, so that we plan (and
+        # back up) a consistent configuration
+        self._connection.recover_deployment(RM_TEMPLATE_STAGING_PATH)
+        plan = self.plan_synchronization(templates_to_add, replace_templates, templates_to_disable)
+        tpl_fn_backup = None
+        if backup_template_json:
+            # Store the tablet's templates.json into the remass backup
+            # folder, in case we need/want to restore it later on
+            tpl_fn_backup = next_backup_filename('templates.json', self._cfg.template_backup_dir)
+            with open(tpl_fn_backup, 'w') as jf:
+                jf.write(plan.original_json)
+            prune_backups('templates.json', self._cfg.template_backup_dir, **self._cfg['backups'])
+        # Also copy the SVG files to our local backup location, so they are
+        # available for future exports:
+        for tpl in plan.added_templates:
+            shutil.copyfile(os.path.join(self._cfg.template_dir, tpl['filename'] + '.svg'),
+                            os.path.join(self._cfg.template_backup_dir, tpl['filename'] + '.svg'))
+        if plan.is_empty:
+            logging.getLogger(__name__).info('Templates are already up-to-date.')
             return tpl_fn_backup
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            upload_files = list(plan.uploads)
+            if plan.config_changed:
+                # Save modified templates.json (locally)
+                temp_tpljson = os.path.join(temp_dir, 'templates.json')
+                with open(temp_tpljson, 'w') as jf:
+                    json.dump(plan.tablet_config, jf, indent=2)
+                # Move the configuration last, so the UI never refers to
+                # missing files
+                upload_files.append((temp_tpljson, RM_TEMPLATE_JSON_PATH))
+            # Stage all files (single free space check & pipelined upload
+            # over one session), verify them and move them into place
+            self._connection.deploy_files(upload_files, RM_TEMPLATE_STAGING_PATH)
+        logging.getLogger(__name__).info(
+            f'Uploaded {len(upload_files)} template files ({plan.upload_bytes / 1024:.0f} KB), '
+            f'{len(plan.unchanged)} unchanged.')
+        # Restart tablet UI to force reloading the changed templates
+        self._connection.restart_ui()
+        return tpl_fn_backup
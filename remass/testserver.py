@@ -0,0 +1,916 @@
+"""Local stand-in for the tablet's SSH/SFTP server.
+
+Serves a directory tree which is laid out like the tablet's file system
+(xochitl documents, /usr/share/remarkable, device info files), emulates the
+handful of shell commands remass executes on the device and optionally
+injects latency & bandwidth limits. This allows developing and benchmarking
+all remote code paths without a tablet:
+
+    python -m remass.testserver --latency 0.02 --bandwidth 2000000 --benchmark
+"""
+import argparse
+import datetime
+import glob
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import queue
+import re
+import shlex
+import shutil
+import socket
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Tuple
+import paramiko
+from PIL import Image
+from reportlab.pdfgen import canvas
+from remass.filesystem import REMOTE_XOCHITL_DIR, RDocument
+
+
+# Fixed namespace, so that generated trees always contain the same UUIDs
+_UUID_NAMESPACE = uuid.UUID('5d3b1a4e-8f2c-4e6b-9a0d-1c7e2f3a4b5c')
+
+
+def _uuid(name: str) -> str:
+    return str(uuid.uuid5(_UUID_NAMESPACE, name))
+
+
+def _local(root: str, remote_path: str) -> str:
+    """Maps the absolute remote path into the served root folder."""
+    return os.path.join(root, posixpath.normpath('/' + remote_path).lstrip('/'))
+
+
+def _write(root: str, remote_path: str, data) -> str:
+    filename = _local(root, remote_path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    return filename
+
+
+def _write_image(root: str, remote_path: str, size: Tuple[int, int], color: int) -> str:
+    filename = _local(root, remote_path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    Image.new('L', size, color).save(filename)
+    return filename
+
+
+def _rm_lines(num_strokes: int, seed: int) -> bytes:
+    """Returns a .rm page (lines format v5) with some zig-zag strokes."""
+    data = b'reMarkable .lines file, version=5          '
+    data += struct.pack('<BBH', 1, 0, 0) + struct.pack('<I', num_strokes)
+    for s in range(num_strokes):
+        num_segments = 20
+        # pen 2: ballpoint, color 0: black
+        data += struct.pack('<IIIfII', 2, 0, 0, 2.0, 0, num_segments)
+        y = 100 + ((seed * 7 + s) % 30) * 55
+        for i in range(num_segments):
+            data += struct.pack('<ffffff', 150 + i * 55, y + (i % 2) * 20, 0.1, 0.0, 2.0, 0.8)
+    return data
+
+
+def _metadata(name: str, dirent_type: str, parent: str = '') -> str:
+    data = {
+        'deleted': False,
+        'lastModified': '1640995200000',
+        'metadatamodified': False,
+        'modified': False,
+        'parent': parent,
+        'pinned': False,
+        'synced': True,
+        'type': dirent_type,
+        'version': 1,
+        'visibleName': name
+    }
+    if dirent_type == 'DocumentType':
+        data['lastOpenedPage'] = 0
+    return json.dumps(data, indent=4)
+
+
+def _add_document(
+        root: str, name: str, parent: str, file_type: str,
+        num_pages: int, num_strokes: int) -> str:
+    doc_id = _uuid(name)
+    base = posixpath.join(REMOTE_XOCHITL_DIR, doc_id)
+    page_ids = [_uuid(f'{name}/page{p}') for p in range(num_pages)]
+    _write(root, base + '.metadata', _metadata(name, 'DocumentType', parent))
+    _write(root, base + '.content', json.dumps(
+        {'fileType': file_type, 'pageCount': num_pages, 'pages': page_ids}, indent=4))
+    _write(root, base + '.pagedata', 'Blank\n' * num_pages)
+    if file_type == 'pdf':
+        pdf = canvas.Canvas(_local(root, base + '.pdf'), pagesize=(445, 594))
+        for p in range(num_pages):
+            pdf.drawString(72, 500, f'{name} - page {p + 1}')
+            pdf.showPage()
+        pdf.save()
+    os.makedirs(_local(root, base), exist_ok=True)
+    for p, pid in enumerate(page_ids):
+        if file_type == 'notebook' or p == 0:
+            _write(root, posixpath.join(base, pid + '.rm'), _rm_lines(num_strokes, p))
+        _write_image(root, posixpath.join(base + '.thumbnails', pid + '.jpg'),
+                     (280, 374), 255 - 10 * (p % 10))
+    return doc_id
+
+
+def create_tablet_tree(
+        root: str, num_notebooks: int = 5, num_pages: int = 5,
+        num_strokes: int = 50, num_pdfs: int = 2, num_templates: int = 5) -> str:
+    """Populates the root folder with a (reproducible) tablet file system:
+    device info files, xochitl documents (notebooks, annotated PDFs, a
+    collection and a trashed notebook), templates and splash screens.
+    :return: root
+    """
+    _write(root, '/etc/hostname', 'reMarkable\n')
+    _write(root, '/etc/version', '20210311194323\n')
+    _write(root, '/sys/devices/soc0/machine', 'reMarkable 2.0\n')
+    battery = '/sys/class/power_supply/max77818_battery'
+    _write(root, battery + '/capacity', '87\n')
+    _write(root, battery + '/health', 'Good\n')
+    _write(root, battery + '/temp', '245\n')
+
+    collection = _uuid('Collection')
+    _write(root, posixpath.join(REMOTE_XOCHITL_DIR, collection + '.metadata'),
+           _metadata('Meetings', 'CollectionType'))
+    _write(root, posixpath.join(REMOTE_XOCHITL_DIR, collection + '.content'), '{}')
+    for n in range(num_notebooks):
+        _add_document(root, f'Notebook {n + 1}', collection if n % 2 else '',
+                      'notebook', num_pages, num_strokes)
+    for n in range(num_pdfs):
+        _add_document(root, f'Paper {n + 1}', '', 'pdf', num_pages, num_strokes)
+    _add_document(root, 'Deleted Notebook', 'trash', 'notebook', 1, num_strokes)
+
+    tpl_dir = '/usr/share/remarkable/templates'
+    templates = list()
+    for t in range(num_templates):
+        filename = f'P Template {t + 1}'
+        templates.append({'name': f'Template {t + 1}', 'filename': filename,
+                          'iconCode': '', 'categories': ['Lines']})
+        _write(root, posixpath.join(tpl_dir, filename + '.svg'),
+               '<svg xmlns="http://www.w3.org/2000/svg" width="1404" height="1872">'
+               + ''.join(f'<line x1="0" y1="{y}" x2="1404" y2="{y}" stroke="black"/>'
+                         for y in range(100 + 10 * t, 1872, 80))
+               + '</svg>\n')
+        _write_image(root, posixpath.join(tpl_dir, filename + '.png'), (1404, 1872), 255)
+    _write(root, posixpath.join(tpl_dir, 'templates.json'),
+           json.dumps({'templates': templates}, indent=4))
+    for screen in ('suspended', 'starting', 'rebooting', 'poweroff'):
+        _write_image(root, f'/usr/share/remarkable/{screen}.png', (1404, 1872), 255)
+    return root
+
+
+def _human_readable(kb: int) -> str:
+    """Formats the size like `df -h` (input in KB)."""
+    size = float(kb)
+    for unit in ('K', 'M', 'G', 'T'):
+        if size < 1024:
+            return f'{size:.1f}{unit}' if size < 10 else f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}P'
+
+
+class ShellEmulator(object):
+    """Emulates the subset of the tablet's busybox shell used by remass.
+
+    Supports command sequences (;, &&), pipes and $(dirname "...") for the
+    following commands: awk (print only), cat, date, df, dirname, echo,
+    gzip, head, hostnamectl, ln, md5sum, mkdir, mv, reboot, rm, rmdir,
+    sha256sum, systemctl, tail, tar, timedatectl & uptime. All paths refer to the served root folder.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.started = time.time()
+        self.timezone = 'UTC'
+        self._commands = {
+            name[5:]: getattr(self, name) for name in dir(self) if name.startswith('_cmd_')}
+
+    def local_path(self, remote_path: str) -> str:
+        return _local(self.root, remote_path)
+
+    def _expand(self, remote_path: str) -> List[str]:
+        """Expands wildcards (like the shell, unmatched patterns are kept)."""
+        if not glob.has_magic(remote_path):
+            return [remote_path]
+        matches = sorted(glob.glob(self.local_path(remote_path)))
+        if len(matches) == 0:
+            return [remote_path]
+        return ['/' + os.path.relpath(m, self.root).replace(os.sep, '/') for m in matches]
+
+    @staticmethod
+    def reads_stdin(cmd: str) -> bool:
+        """Returns True if the command consumes stdin (until EOF)."""
+        return re.search(r'(^|\|)\s*\S*(tar\s+-x|gzip\s+-d)', cmd) is not None
+
+    def run(self, cmd: str, stdin: bytes = b'') -> Tuple[bytes, bytes, int]:
+        """Executes the command line.
+        :return: stdout, stderr, exit status
+        """
+        cmd = re.sub(r'\$\(dirname\s+"([^"]*)"\)',
+                     lambda m: shlex.quote(posixpath.dirname(m.group(1))), cmd)
+        lexer = shlex.shlex(cmd, posix=True, punctuation_chars=';&|')
+        lexer.whitespace_split = True
+        tokens = list(lexer)
+        out, err, status = b'', b'', 0
+        skip = False
+        statement = list()
+        for token in tokens + [';']:
+            if token in (';', '&&'):
+                if not skip and len(statement) > 0:
+                    o, e, status = self._pipeline(statement, stdin)
+                    out += o
+                    err += e
+                skip = token == '&&' and status != 0
+                statement = list()
+            else:
+                statement.append(token)
+        return out, err, status
+
+    def _pipeline(self, tokens: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        commands = [list()]
+        for token in tokens:
+            if token == '|':
+                commands.append(list())
+            else:
+                commands[-1].append(token)
+        data, err, status = stdin, b'', 0
+        for args in commands:
+            name = posixpath.basename(args[0])
+            if name not in self._commands:
+                return b'', err + f'sh: {args[0]}: not found\n'.encode(), 127
+            data, e, status = self._commands[name](args[1:], data)
+            err += e
+        return data, err, status
+
+    def _cmd_awk(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        match = re.fullmatch(r'\s*\{\s*print\s+(.*)\}\s*', args[0])
+        if match is None:
+            return b'', f'awk: unsupported program {args[0]}\n'.encode(), 1
+        items = re.findall(r'\$\d+|"[^"]*"|,', match.group(1))
+        lines = list()
+        for line in stdin.decode().splitlines():
+            fields = [line] + line.split()
+            values = list()
+            for item in items:
+                if item == ',':
+                    values.append(' ')
+                elif item.startswith('$'):
+                    idx = int(item[1:])
+                    values.append(fields[idx] if idx < len(fields) else '')
+                else:
+                    values.append(item[1:-1])
+            lines.append(''.join(values))
+        return ''.join(line + '\n' for line in lines).encode(), b'', 0
+
+    def _cmd_cat(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        if len(args) == 0:
+            return stdin, b'', 0
+        out, err, status = b'', b'', 0
+        for pattern in args:
+            for path in self._expand(pattern):
+                try:
+                    with open(self.local_path(path), 'rb') as f:
+                        out += f.read()
+                except IOError:
+                    err += f'cat: can\'t open \'{path}\': No such file or directory\n'.encode()
+                    status = 1
+        return out, err, status
+
+    def _cmd_date(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        fmt = args[0][1:] if len(args) > 0 and args[0].startswith('+') else '%a %b %e %H:%M:%S %Z %Y'
+        return (time.strftime(fmt.replace('%Z', self.timezone), time.gmtime()) + '\n').encode(), b'', 0
+
+    def _cmd_df(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        human = '-h' in args
+        locations = [a for a in args if not a.startswith('-')]
+        if len(locations) == 0:
+            locations = ['/']
+        usage = shutil.disk_usage(self.root)
+        total, used, free = usage.total // 1024, usage.used // 1024, usage.free // 1024
+        fmt = _human_readable if human else str
+        out = 'Filesystem                Size      Used Available Use% Mounted on\n' if human\
+            else 'Filesystem           1K-blocks      Used Available Use% Mounted on\n'
+        err, status = b'', 0
+        for location in locations:
+            if not os.path.exists(self.local_path(location)):
+                err += f"df: {location}: can't find mount point\n".encode()
+                status = 1
+                continue
+            mount = '/home' if posixpath.normpath('/' + location).startswith('/home') else '/'
+            out += f'/dev/root {fmt(total):>19s} {fmt(used):>9s} {fmt(free):>9s} '\
+                   f'{100 * used // max(1, total):>3d}% {mount}\n'
+        return out.encode(), err, status
+
+    def _cmd_dirname(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        return (posixpath.dirname(args[0]) + '\n').encode(), b'', 0
+
+    def _cmd_echo(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        if len(args) > 0 and args[0] == '-n':
+            return ' '.join(args[1:]).encode(), b'', 0
+        return (' '.join(args) + '\n').encode(), b'', 0
+
+    def _cmd_gzip(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        if '-d' in args:
+            try:
+                return gzip.decompress(stdin), b'', 0
+            except (OSError, EOFError) as e:
+                return b'', f'gzip: {e}\n'.encode(), 1
+        return gzip.compress(stdin), b'', 0
+
+    def _lines_arg(self, args: List[str]) -> int:
+        for idx, arg in enumerate(args):
+            if arg == '-n':
+                return int(args[idx + 1])
+            if arg.startswith('-n'):
+                return int(arg[2:])
+        return 10
+
+    def _cmd_head(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        lines = stdin.decode().splitlines(keepends=True)
+        return ''.join(lines[:self._lines_arg(args)]).encode(), b'', 0
+
+    def _cmd_hostnamectl(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        if len(args) == 2 and args[0] == 'set-hostname':
+            _write(self.root, '/etc/hostname', args[1] + '\n')
+        return b'', b'', 0
+
+    def _checksum(self, algorithm: str, args: List[str]) -> Tuple[bytes, bytes, int]:
+        out, err, status = b'', b'', 0
+        for path in args:
+            try:
+                digest = hashlib.new(algorithm)
+                with open(self.local_path(path), 'rb') as f:
+                    for chunk in iter(lambda: f.read(2**20), b''):
+                        digest.update(chunk)
+                out += f'{digest.hexdigest()}  {path}\n'.encode()
+            except IOError:
+                err += f'{algorithm}sum: can\'t open \'{path}\': No such file or directory\n'.encode()
+                status = 1
+        return out, err, status
+
+    def _cmd_ln(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        force = any(a.startswith('-') and 'f' in a for a in args)
+        paths = [a for a in args if not a.startswith('-')]
+        try:
+            if force and os.path.exists(self.local_path(paths[1])):
+                os.remove(self.local_path(paths[1]))
+            os.link(self.local_path(paths[0]), self.local_path(paths[1]))
+        except OSError as e:
+            return b'', f"ln: {paths[1]}: {e.strerror}\n".encode(), 1
+        return b'', b'', 0
+
+    def _cmd_md5sum(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        return self._checksum('md5', args)
+
+    def _cmd_mkdir(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        parents = '-p' in args
+        for path in [a for a in args if not a.startswith('-')]:
+            try:
+                if parents:
+                    os.makedirs(self.local_path(path), exist_ok=True)
+                else:
+                    os.mkdir(self.local_path(path))
+            except OSError as e:
+                return b'', f"mkdir: can't create directory '{path}': {e.strerror}\n".encode(), 1
+        return b'', b'', 0
+
+    def _cmd_mv(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        paths = [a for a in args if not a.startswith('-')]
+        try:
+            os.replace(self.local_path(paths[0]), self.local_path(paths[1]))
+        except OSError as e:
+            return b'', f"mv: can't rename '{paths[0]}': {e.strerror}\n".encode(), 1
+        return b'', b'', 0
+
+    def _cmd_reboot(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        return b'', b'', 0
+
+    def _cmd_rm(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        recursive = any(a.startswith('-') and 'r' in a for a in args)
+        force = any(a.startswith('-') and 'f' in a for a in args)
+        for path in [a for a in args if not a.startswith('-')]:
+            local_path = self.local_path(path)
+            try:
+                if recursive and os.path.isdir(local_path):
+                    shutil.rmtree(local_path)
+                else:
+                    os.remove(local_path)
+            except FileNotFoundError:
+                if not force:
+                    return b'', f"rm: can't remove '{path}': No such file or directory\n".encode(), 1
+            except OSError as e:
+                return b'', f"rm: can't remove '{path}': {e.strerror}\n".encode(), 1
+        return b'', b'', 0
+
+    def _cmd_rmdir(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        for path in args:
+            try:
+                os.rmdir(self.local_path(path))
+            except OSError as e:
+                return b'', f"rmdir: '{path}': {e.strerror}\n".encode(), 1
+        return b'', b'', 0
+
+    def _cmd_sha256sum(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        return self._checksum('sha256', args)
+
+    def _cmd_systemctl(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        return b'', b'', 0
+
+    def _cmd_tail(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        lines = stdin.decode().splitlines(keepends=True)
+        return ''.join(lines[-self._lines_arg(args):]).encode(), b'', 0
+
+    def _cmd_tar(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        # Only supports streaming (-f -) archives
+        directory, members, create = '/', list(), '-c' in args
+        idx = 0
+        while idx < len(args):
+            if args[idx] == '-C':
+                directory = args[idx + 1]
+                idx += 1
+            elif args[idx] == '-f':
+                idx += 1
+            elif not args[idx].startswith('-'):
+                members.append(args[idx])
+            idx += 1
+        try:
+            if create:
+                buffer = io.BytesIO()
+                with tarfile.open(fileobj=buffer, mode='w') as tar:
+                    for member in members:
+                        tar.add(self.local_path(posixpath.join(directory, member)), arcname=member)
+                return buffer.getvalue(), b'', 0
+            with tarfile.open(fileobj=io.BytesIO(stdin), mode='r') as tar:
+                tar.extractall(self.local_path(directory))
+            return b'', b'', 0
+        except (OSError, tarfile.TarError) as e:
+            return b'', f'tar: {e}\n'.encode(), 1
+
+    def _cmd_timedatectl(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        if len(args) == 2 and args[0] == 'set-timezone':
+            self.timezone = args[1]
+        return b'', b'', 0
+
+    def _cmd_uptime(self, args: List[str], stdin: bytes) -> Tuple[bytes, bytes, int]:
+        up = int(time.time() - self.started)
+        days, hours, minutes = up // 86400, (up % 86400) // 3600, (up % 3600) // 60
+        now = datetime.datetime.utcnow().strftime('%H:%M:%S')
+        since = f'{days} day{"s" if days != 1 else ""}, ' if days > 0 else ''
+        return (f' {now} up {since}{hours:2d}:{minutes:02d},  0 users,  '
+                'load average: 0.00, 0.00, 0.00\n').encode(), b'', 0
+
+
+class _RootedSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _RootedSFTPServer(paramiko.SFTPServerInterface):
+    """Serves the root folder as the remote file system."""
+    def __init__(self, server, root: str, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self._root = root
+
+    def _local(self, path: str) -> str:
+        return _local(self._root, self.canonicalize(path))
+
+    def list_folder(self, path):
+        local = self._local(path)
+        try:
+            entries = list()
+            for fn in os.listdir(local):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local, fn)))
+                attr.filename = fn
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local = self._local(path)
+        try:
+            binary_flag = getattr(os, 'O_BINARY', 0)
+            fd = os.open(local, flags | binary_flag, getattr(attr, 'st_mode', None) or 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if (flags & os.O_CREAT) and (attr is not None):
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            paramiko.SFTPServer.set_file_attr(local, attr)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        try:
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _RootedSFTPHandle(flags)
+        handle.filename = local
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._local(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(self._local(oldpath), self._local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._local(path))
+            if attr is not None:
+                paramiko.SFTPServer.set_file_attr(self._local(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self._local(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server: 'TabletServer'):
+        self._server = server
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if self._server.password is None or password == self._server.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self._server._exec, args=(channel, command.decode('utf-8')),
+            daemon=True).start()
+        return True
+
+
+def _relay(src: socket.socket, dst: socket.socket, delay: float, bandwidth: float) -> None:
+    """Forwards data from src to dst. Each chunk is delivered after the
+    one-way delay, plus its transmission time at the given bandwidth (bytes
+    per second, None for unlimited). Pipelined traffic is thus only slowed
+    down by the bandwidth, not by the latency (as on a real link)."""
+    pending = queue.Queue()
+
+    def _receive():
+        link_free = time.monotonic()
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b''
+            arrival = time.monotonic()
+            if bandwidth is not None and len(data) > 0:
+                link_free = max(link_free, arrival) + len(data) / bandwidth
+                arrival = link_free
+            pending.put((arrival + delay, data))
+            if len(data) == 0:
+                return
+
+    threading.Thread(target=_receive, daemon=True).start()
+    while True:
+        due, data = pending.get()
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            if len(data) == 0:
+                dst.shutdown(socket.SHUT_WR)
+                return
+            dst.sendall(data)
+        except OSError:
+            return
+
+
+class TabletServer(object):
+    """SSH/SFTP server which mimics the tablet, serving the root folder.
+
+    :root: folder laid out like the tablet's file system, see create_tablet_tree()
+    :port: 0 selects a free port, check the address property
+    :password: if None, any password will be accepted (as will any public key)
+    :latency: round trip time in seconds which is added to the link
+    :bandwidth: throughput limit of each direction in bytes per second, None
+                for unlimited
+    """
+    def __init__(
+            self, root: str, host: str = '127.0.0.1', port: int = 0,
+            password: str = None, latency: float = 0.0, bandwidth: float = None,
+            host_key: paramiko.PKey = None):
+        self.root = root
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.shell = ShellEmulator(root)
+        # All executed command lines, e.g. to count UI restarts
+        self.commands = list()
+        self._host_key = host_key
+        self._bind = (host, port)
+        self._sock = None
+        self._transports = list()
+        self._lock = threading.Lock()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._sock.getsockname()[:2]
+
+    def connection_config(self) -> Dict:
+        """Returns the 'connection' configuration to connect a
+        TabletConnection to this server."""
+        host, port = self.address
+        return {
+            'host': host, 'host_fallback': None, 'user': 'root', 'keyfile': None,
+            'password': self.password if self.password is not None else 'remass',
+            'timeout': 5, 'port': port, 'profile': 'usb', 'keepalive': 0,
+            'reconnect_attempts': 3, 'reconnect_backoff': 0.1, 'metrics': False
+        }
+
+    def start(self) -> 'TabletServer':
+        if self._host_key is None:
+            self._host_key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self._bind)
+        self._sock.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+        logging.getLogger(__name__).info(
+            f'Serving "{self.root}" at {self.address[0]}:{self.address[1]}')
+        return self
+
+    def stop(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        with self._lock:
+            for transport in self._transports:
+                transport.close()
+            self._transports = list()
+
+    def __enter__(self) -> 'TabletServer':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except (OSError, AttributeError):
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client: socket.socket) -> None:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.latency > 0 or self.bandwidth is not None:
+            # Route the traffic through an emulated link
+            client_end, server_end = socket.socketpair()
+            for src, dst in ((client, client_end), (client_end, client)):
+                threading.Thread(
+                    target=_relay, args=(src, dst, self.latency / 2, self.bandwidth),
+                    daemon=True).start()
+            client = server_end
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self._host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _RootedSFTPServer, self.root)
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_ServerInterface(self))
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            logging.getLogger(__name__).warning(f'SSH negotiation failed: {e}')
+
+    def _exec(self, channel: paramiko.Channel, cmd: str) -> None:
+        with self._lock:
+            self.commands.append(cmd)
+        stdin = b''
+        if self.shell.reads_stdin(cmd):
+            chunks = list()
+            while True:
+                chunk = channel.recv(65536)
+                if len(chunk) == 0:
+                    break
+                chunks.append(chunk)
+            stdin = b''.join(chunks)
+        try:
+            out, err, status = self.shell.run(cmd, stdin)
+        except Exception as e:
+            # Report unsupported/malformed command lines instead of leaving
+            # the client waiting for an exit status
+            out, err, status = b'', f'sh: {e}\n'.encode(), 1
+        try:
+            channel.sendall(out)
+            channel.sendall_stderr(err)
+            channel.send_exit_status(status)
+            channel.shutdown_write()
+            # Wait until the client is done (closing the channel right away
+            # could overtake the reply to the exec request)
+            channel.settimeout(30)
+            while len(channel.recv(1024)) > 0:
+                pass
+        except (OSError, socket.timeout, paramiko.SSHException):
+            pass
+        channel.close()
+
+
+def _remove_remote_files(connection, filenames: List[str]) -> None:
+    if len(filenames) == 0:
+        return
+    with connection.sftp_session() as sftp:
+        for fn in filenames:
+            try:
+                sftp.remove(fn)
+            except IOError:
+                pass
+
+
+def benchmark(
+        connection_config: Dict, repeats: int = 3,
+        report: Callable[[str, float], None] = None) -> Dict[str, float]:
+    """Measures the (median) duration of the remote operations against the
+    server (or tablet) specified by connection_config. The uploaded payload
+    and the imported document are removed afterwards.
+    :report: optional callback, invoked with the operation name and duration
+    :return: dict{operation: seconds}
+    """
+    from remass.tablet import TabletConnection
+    from remass.templates import TemplateOrganizer
+    connection = TabletConnection({'connection': connection_config})
+    results = dict()
+
+    def _measure(name: str, operation: Callable[[], None]) -> None:
+        durations = list()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            operation()
+            durations.append(time.perf_counter() - start)
+        results[name] = sorted(durations)[len(durations) // 2]
+        if report is not None:
+            report(name, results[name])
+
+    created = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            _measure('open', lambda: (connection.close(), connection.open()))
+            _measure('get_device_status', connection.get_device_status)
+            _measure('get_free_space_kb', lambda: connection.get_free_space_kb('/home/root'))
+            _measure('get_filesystem', connection.get_filesystem)
+            _root, _trash, dirents = connection.get_filesystem()
+            documents = sorted([d for d in dirents.values()
+                                if isinstance(d, RDocument) and d.parent_uuid != 'trash'],
+                               key=lambda d: d.visible_name)
+            for doc in documents[:1] + [d for d in documents if d.visible_name.startswith('Paper')][:1]:
+                _measure(f'render_document ({doc.visible_name})',
+                         lambda: connection.render_document(
+                             doc, os.path.join(tmp_dir, 'export.pdf'), None))
+                _measure(f'download_thumbnail ({doc.visible_name})',
+                         lambda: connection.download_thumbnail(doc, os.path.join(tmp_dir, 'thumb')))
+            organizer = TemplateOrganizer(None, connection)
+            _measure('get_remote_templates', lambda: organizer.get_remote_templates(force=True))
+
+            def _download_templates():
+                # Start from scratch, as already downloaded files would be skipped
+                tpl_dir = os.path.join(tmp_dir, 'templates')
+                shutil.rmtree(tpl_dir, ignore_errors=True)
+                os.makedirs(tpl_dir)
+                connection.download_templates(tpl_dir)
+            _measure('download_templates', _download_templates)
+            payload = os.path.join(tmp_dir, 'payload.bin')
+            created.append('/home/root/payload.bin')
+            with open(payload, 'wb') as f:
+                f.write(os.urandom(4 * 2**20))
+            _measure('upload_file (4 MB)',
+                     lambda: connection.upload_file(payload, '/home/root/payload.bin',
+                                                    skip_identical=False))
+            _measure('download_file (4 MB)',
+                     lambda: connection.download_file('/home/root/payload.bin',
+                                                      os.path.join(tmp_dir, 'download.bin'),
+                                                      skip_identical=False))
+            # Re-importing the same document only checks the existing documents
+            document = os.path.join(tmp_dir, 'Benchmark Import.pdf')
+            pdf = canvas.Canvas(document)
+            pdf.drawString(72, 720, 'Benchmark Import')
+            pdf.save()
+
+            def _import():
+                for doc_uuid in connection.import_documents([document], restart_ui=False):
+                    # Remove the .metadata first, so xochitl never sees an incomplete document
+                    created.extend(posixpath.join(REMOTE_XOCHITL_DIR, f'{doc_uuid}.{ext}')
+                                   for ext in ('metadata', 'content', 'pdf'))
+            _import()
+            _measure('import_documents (re-import)', _import)
+        finally:
+            _remove_remote_files(connection, created)
+    connection.close()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Local SSH/SFTP server which mimics a reMarkable tablet.')
+    parser.add_argument('root', type=str, nargs='?', default=None,
+                        help='Folder to serve. If omitted, a temporary tablet file system will be generated.')
+    parser.add_argument('--port', type=int, default=2222,
+                        help='Port to listen on (0 selects a free port).')
+    parser.add_argument('--password', type=str, default=None,
+                        help='Require this password (by default, any password/key is accepted).')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Round trip time in seconds to add to the link.')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='Throughput limit per direction in bytes per second.')
+    parser.add_argument('--populate', action='store_true', default=False,
+                        help='Generate the tablet file system within ROOT.')
+    parser.add_argument('--benchmark', action='store_true', default=False,
+                        help='Run the benchmark of all remote operations and exit.')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of runs per operation for --benchmark.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = tmp_dir if args.root is None else args.root
+        if args.root is None or args.populate:
+            create_tablet_tree(root)
+        with TabletServer(root, port=args.port, password=args.password,
+                          latency=args.latency, bandwidth=args.bandwidth) as server:
+            if args.benchmark:
+                benchmark(server.connection_config(), args.repeats,
+                          lambda name, duration: print(f'{name:<40s} {1000 * duration:8.1f} ms'))
+            else:
+                host, port = server.address
+                print('Add the following to your remass configuration (Ctrl+C to stop):\n'
+                      f'[connection]\nhost = "{host}"\nport = {port}\nprofile = "usb"\n')
+                try:
+                    while True:
+                        time.sleep(1)
+                except KeyboardInterrupt:
+                    pass
@@ -0,0 +1,142 @@
+"""Low-resolution thumbnail cache for quick visual identification of notebooks."""
+import glob
+import logging
+import os
+import queue
+import threading
+from typing import Dict, List
+from remass.config import RemassConfig
+from remass.filesystem import RCollection, RDirEntry, RDocument
+from remass.tablet import TabletConnection
+
+
+THUMBNAIL_EXTENSIONS = ('.jpg', '.png')
+
+
+def _thumbnail_basename(folder: str, rm_file: RDocument) -> str:
+    """Thumbnails are keyed by UUID and version, so that they become stale
+    as soon as the document is changed on the tablet."""
+    return os.path.join(folder, f'{rm_file.uuid}.{rm_file.version}')
+
+
+class ThumbnailCache(object):
+    """Caches the first-page thumbnails of the tablet's documents within the
+    application's data directory.
+
+    Thumbnails can be queried for single documents, or in bulk for all
+    documents of a collection. The latter can also be prefetched by a
+    background worker (e.g. while the user is browsing the file selector).
+    """
+    def __init__(self, cfg: RemassConfig, connection: TabletConnection, dpi: int = 20):
+        self._folder = cfg.thumbnail_dir
+        self._connection = connection
+        self._dpi = dpi
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = set()
+        # Thumbnails which are currently being downloaded: {uuid: Event}
+        self._in_flight = dict()
+        self._worker = None
+
+    def cached_filename(self, rm_file: RDocument) -> str:
+        """Returns the cached thumbnail of the document or None if there is
+        no (up-to-date) thumbnail yet."""
+        basename = _thumbnail_basename(self._folder, rm_file)
+        for ext in THUMBNAIL_EXTENSIONS:
+            if os.path.exists(basename + ext):
+                return basename + ext
+        return None
+
+    def get(self, rm_file: RDocument) -> str:
+        """Returns the filename of the document's thumbnail, fetching it from
+        the tablet if needed (blocking). Concurrent requests for the same
+        document wait for the pending download instead of starting another
+        one, whereas other documents can be fetched in the meantime."""
+        if rm_file.dirent_type != RDocument.dirent_type:
+            return None
+        with self._lock:
+            fname = self.cached_filename(rm_file)
+            if fname is not None:
+                return fname
+            in_flight = self._in_flight.get(rm_file.uuid, None)
+            downloading = in_flight is None
+            if downloading:
+                in_flight = threading.Event()
+                self._in_flight[rm_file.uuid] = in_flight
+        if not downloading:
+            # Another thread is fetching this thumbnail (None if it failed)
+            in_flight.wait()
+            return self.cached_filename(rm_file)
+        try:
+            fname = self._connection.download_thumbnail(
+                rm_file, _thumbnail_basename(self._folder, rm_file),
+                dpi=self._dpi)
+            self._remove_stale(rm_file)
+            return fname
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                f"Cannot create thumbnail for '{rm_file.uuid}': {e}")
+            return None
+        finally:
+            with self._lock:
+                del self._in_flight[rm_file.uuid]
+            in_flight.set()
+
+    def get_collection(self, collection: RCollection, recursive: bool = False) -> Dict[str, str]:
+        """Returns the thumbnails of all documents within the given collection
+        as dict{uuid: filename}."""
+        thumbnails = dict()
+        for doc in self._documents(collection, recursive):
+            fname = self.get(doc)
+            if fname is not None:
+                thumbnails[doc.uuid] = fname
+        return thumbnails
+
+    def prefetch(self, collection: RCollection, recursive: bool = False) -> None:
+        """Schedules all (not yet cached) thumbnails of the collection to be
+        fetched by the background worker."""
+        docs = self._documents(collection, recursive)
+        with self._lock:
+            for doc in docs:
+                if doc.uuid in self._pending or self.cached_filename(doc) is not None:
+                    continue
+                self._pending.add(doc.uuid)
+                self._queue.put(doc)
+            if self._worker is None and not self._queue.empty():
+                self._worker = threading.Thread(target=self._prefetch_worker, daemon=True)
+                self._worker.start()
+
+    def _prefetch_worker(self) -> None:
+        while True:
+            try:
+                doc = self._queue.get(timeout=1)
+            except queue.Empty:
+                # Only quit if prefetch() didn't enqueue documents in the
+                # meantime (it starts a new worker once we're done)
+                with self._lock:
+                    if self._queue.empty():
+                        self._worker = None
+                        return
+                continue
+            if self._connection.is_connected():
+                self.get(doc)
+            with self._lock:
+                self._pending.discard(doc.uuid)
+            self._queue.task_done()
+
+    def _documents(self, collection: RCollection, recursive: bool) -> List[RDocument]:
+        docs = list()
+        for child in collection.children:
+            if child.dirent_type == RDocument.dirent_type:
+                docs.append(child)
+            elif recursive and child.dirent_type == RCollection.dirent_type:
+                docs.extend(self._documents(child, recursive))
+        return docs
+
+    def _remove_stale(self, rm_file: RDirEntry) -> None:
+        """Removes thumbnails of previous document versions."""
+        current = _thumbnail_basename(self._folder, rm_file)
+        for fn in glob.glob(os.path.join(self._folder, rm_file.uuid + '.*')):
+            stem, ext = os.path.splitext(fn)
+            if ext in THUMBNAIL_EXTENSIONS and stem != current:
+                os.remove(fn)
@@ -0,0 +1,295 @@
+"""Chunked, resumable and verifiable file transfers via SFTP."""
+import collections
+import hashlib
+import json
+import logging
+import os
+import shlex
+import threading
+from typing import Callable, Dict, List, Tuple
+import paramiko
+
+
+# Block size for reading/writing while transferring files. Paramiko splits
+# these into (pipelined) SFTP requests of at most 32 KB.
+TRANSFER_CHUNK_SIZE = 256 * 1024
+
+
+# Maximum number of files which upload_batch() writes concurrently
+MAX_OPEN_FILES = 32
+
+
+# Suffix of the file next to a ".part" file, which describes the source of
+# the partial transfer (size & modification time). A partial file is only
+# resumed if its source didn't change since the interruption.
+PART_SOURCE_SUFFIX = '.source'
+
+
+# Supported checksum algorithms and the corresponding (busybox) commands on
+# the tablet
+CHECKSUM_COMMANDS = {
+    'md5': '/usr/bin/md5sum',
+    'sha256': '/usr/bin/sha256sum',
+}
+
+
+class ChecksumMismatchError(Exception):
+    pass
+
+
+def _report_progress(
+        progress_cb: Callable[[float], None], transferred: int,
+        total: int) -> None:
+    if progress_cb is not None:
+        progress_cb(100.0 if total == 0 else 100.0 * transferred / total)
+
+
+def local_checksum(filename: str, algorithm: str = 'md5') -> str:
+    """Returns the hex digest of the local file."""
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(TRANSFER_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remote_checksum_cmd(filename: str, algorithm: str = 'md5') -> str:
+    """Returns the shell command to compute the checksum of the remote file."""
+    if algorithm not in CHECKSUM_COMMANDS:
+        raise ValueError(
+            f"Unsupported checksum algorithm '{algorithm}', "
+            f"must be one of: {', '.join(CHECKSUM_COMMANDS.keys())}")
+    return f'{CHECKSUM_COMMANDS[algorithm]} {shlex.quote(filename)}'
+
+
+def parse_checksum_output(output: str) -> str:
+    """Extracts the digest from the output of md5sum/sha256sum."""
+    tokens = output.split()
+    return tokens[0].lower() if len(tokens) > 0 else None
+
+
+def remote_checksums_cmd(filenames: List[str], algorithm: str = 'md5') -> str:
+    """Returns the shell command to compute the checksums of all given remote
+    files at once. Missing files will be reported on stderr only."""
+    if algorithm not in CHECKSUM_COMMANDS:
+        raise ValueError(
+            f"Unsupported checksum algorithm '{algorithm}', "
+            f"must be one of: {', '.join(CHECKSUM_COMMANDS.keys())}")
+    return CHECKSUM_COMMANDS[algorithm] + ''.join(f' {shlex.quote(fn)}' for fn in filenames)
+
+
+def parse_checksums_output(output: str) -> Dict[str, str]:
+    """Parses the output of md5sum/sha256sum for multiple files.
+    :return: dict{filename: digest}
+    """
+    checksums = dict()
+    for line in output.splitlines():
+        tokens = line.split(None, 1)
+        if len(tokens) == 2:
+            checksums[tokens[1]] = tokens[0].lower()
+    return checksums
+
+
+class ChecksumCache(object):
+    """Caches the checksums of local files, so that unchanged files (same
+    size & modification time) don't need to be hashed again. The cache can
+    be persisted as JSON."""
+    def __init__(self, filename: str = None):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._modified = False
+        self._entries = dict()
+        if filename is not None:
+            try:
+                with open(filename, 'r') as fp:
+                    self._entries = json.load(fp)
+            except (IOError, ValueError):
+                pass
+
+    def checksum(self, filename: str, algorithm: str = 'md5') -> str:
+        """Returns the (cached) hex digest of the local file."""
+        key = os.path.abspath(filename)
+        st = os.stat(filename)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+                entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digests': dict()}
+                self._entries[key] = entry
+            if algorithm in entry['digests']:
+                return entry['digests'][algorithm]
+        digest = local_checksum(filename, algorithm)
+        with self._lock:
+            entry['digests'][algorithm] = digest
+            self._modified = True
+        return digest
+
+    def save(self) -> None:
+        """Stores the cache (if it has been modified), skipping entries of
+        files which no longer exist."""
+        with self._lock:
+            if self._filename is None or not self._modified:
+                return
+            self._entries = {k: v for k, v in self._entries.items() if os.path.exists(k)}
+            tmp_filename = self._filename + '.tmp'
+            try:
+                os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+                with open(tmp_filename, 'w') as fp:
+                    json.dump(self._entries, fp)
+                os.replace(tmp_filename, self._filename)
+                self._modified = False
+            except IOError as e:
+                logging.getLogger(__name__).warning(f'Cannot store checksum cache: {e}')
+
+
+def partial_transfer_target(filename: str) -> str:
+    """Returns the target filename if the given file belongs to an interrupted
+    transfer (i.e. it is a ".part" file or its source description), otherwise
+    None."""
+    for suffix in ('.part', '.part' + PART_SOURCE_SUFFIX):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return None
+
+
+def _load_part_source(fp) -> Dict:
+    try:
+        return json.loads(fp.read())
+    except ValueError:
+        return None
+
+
+def download(
+        sftp: paramiko.SFTPClient, remote_filename: str, local_filename: str,
+        progress_cb: Callable[[float], None] = None,
+        attr: paramiko.SFTPAttributes = None) -> None:
+    """Downloads the file via a temporary "local_filename.part" file. If such a
+    partial file exists from an interrupted download and the remote file is
+    unchanged (same size & modification time), we continue at its byte
+    offset. Otherwise, the stale partial file is discarded. All read
+    requests are pipelined. The local file gets the remote file's
+    modification time.
+    :progress_cb: will be called with the progress in percent
+    :attr: the remote file's attributes, if already known (saves a request)
+    """
+    if attr is None:
+        attr = sftp.stat(remote_filename)
+    part_filename = local_filename + '.part'
+    source_filename = part_filename + PART_SOURCE_SUFFIX
+    source = {'size': attr.st_size, 'mtime': int(attr.st_mtime)}
+    offset = 0
+    if os.path.exists(part_filename):
+        try:
+            with open(source_filename, 'r') as fp:
+                if _load_part_source(fp) == source:
+                    offset = os.path.getsize(part_filename)
+        except IOError:
+            pass
+    if offset > attr.st_size:
+        offset = 0
+    if offset == 0:
+        with open(source_filename, 'w') as fp:
+            json.dump(source, fp)
+    transferred = offset
+    _report_progress(progress_cb, transferred, attr.st_size)
+    with sftp.open(remote_filename, 'rb') as rf,\
+            open(part_filename, 'ab' if offset > 0 else 'wb') as lf:
+        rf.seek(offset)
+        rf.prefetch(attr.st_size)
+        while True:
+            chunk = rf.read(TRANSFER_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            lf.write(chunk)
+            transferred += len(chunk)
+            _report_progress(progress_cb, transferred, attr.st_size)
+    os.replace(part_filename, local_filename)
+    os.remove(source_filename)
+    os.utime(local_filename, (attr.st_atime, attr.st_mtime))
+
+
+def upload(
+        sftp: paramiko.SFTPClient, local_filename: str, remote_filename: str,
+        progress_cb: Callable[[float], None] = None) -> None:
+    """Uploads the file via a temporary "remote_filename.part" file, which is
+    renamed once the upload is complete. If such a partial file exists from
+    an interrupted upload and the local file is unchanged (same size &
+    modification time), we continue at its byte offset. Otherwise, the
+    stale partial file is overwritten. All write requests are pipelined.
+    :progress_cb: will be called with the progress in percent
+    """
+    st = os.stat(local_filename)
+    size = st.st_size
+    part_filename = remote_filename + '.part'
+    source_filename = part_filename + PART_SOURCE_SUFFIX
+    source = {'size': size, 'mtime': st.st_mtime_ns}
+    try:
+        offset = sftp.stat(part_filename).st_size
+        with sftp.open(source_filename, 'r') as fp:
+            if _load_part_source(fp) != source:
+                offset = 0
+    except IOError:
+        offset = 0
+    if offset > size:
+        offset = 0
+    if offset == 0:
+        with sftp.open(source_filename, 'w') as fp:
+            fp.write(json.dumps(source))
+    transferred = offset
+    _report_progress(progress_cb, transferred, size)
+    with open(local_filename, 'rb') as lf,\
+            sftp.open(part_filename, 'r+' if offset > 0 else 'w') as rf:
+        rf.set_pipelined(True)
+        lf.seek(offset)
+        rf.seek(offset)
+        while True:
+            chunk = lf.read(TRANSFER_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            rf.write(chunk)
+            transferred += len(chunk)
+            _report_progress(progress_cb, transferred, size)
+    sftp.posix_rename(part_filename, remote_filename)
+    sftp.remove(source_filename)
+
+
+def upload_batch(
+        sftp: paramiko.SFTPClient, files: List[Tuple[str, str]],
+        progress_cb: Callable[[float], None] = None) -> None:
+    """Uploads multiple (local filename, remote filename) pairs over a single
+    SFTP session. Writes are pipelined across files, i.e. we only wait for
+    the acknowledgements of a file when closing it, while the following
+    files are already being sent (at most MAX_OPEN_FILES at once). As in
+    upload(), each file is written to a temporary ".part" file first.
+    :progress_cb: will be called with the progress in percent
+    """
+    total = sum(os.path.getsize(lf) for lf, _ in files)
+    transferred = 0
+    in_flight = collections.deque()
+
+    def _finish(remote_filename: str, remote_file: paramiko.SFTPFile) -> None:
+        remote_file.close()
+        sftp.posix_rename(remote_filename + '.part', remote_filename)
+
+    _report_progress(progress_cb, transferred, total)
+    for local_filename, remote_filename in files:
+        remote_file = sftp.open(remote_filename + '.part', 'w')
+        remote_file.set_pipelined(True)
+        with open(local_filename, 'rb') as lf:
+            for chunk in iter(lambda: lf.read(TRANSFER_CHUNK_SIZE), b''):
+                remote_file.write(chunk)
+                transferred += len(chunk)
+                _report_progress(progress_cb, transferred, total)
+        in_flight.append((remote_filename, remote_file))
+        if len(in_flight) >= MAX_OPEN_FILES:
+            _finish(*in_flight.popleft())
+    while len(in_flight) > 0:
+        _finish(*in_flight.popleft())
+
+
+def is_transferred(local_filename: str, attr: paramiko.SFTPAttributes) -> bool:
+    """Returns True if the local file has the same size and modification time
+    as the remote file (i.e. it has been downloaded via download())."""
+    if not os.path.exists(local_filename):
+        return False
+    st = os.stat(local_filename)
+    return st.st_size == attr.st_size and int(st.st_mtime) == int(attr.st_mtime)
@@ -0,0 +1,52 @@
+"""SSH transport tuning profiles for the different ways to reach the tablet."""
+from dataclasses import dataclass
+import paramiko
+
+
+# The tablet's (fixed) address if connected via USB
+USB_HOST = '10.11.99.1'
+
+
+@dataclass(frozen=True)
+class TransportProfile(object):
+    name: str
+    compress: bool
+    # Receive window of all channels (exec & SFTP), paramiko's default is 2 MB
+    window_size: int
+    # Compression of streamed archives (tar backups): 'gzip' or 'none'
+    stream_compression: str = 'none'
+
+    def apply(self, transport: paramiko.Transport) -> None:
+        """Adjusts the channel parameters of an established transport. These
+        will be used for all subsequently opened channels (exec & SFTP)."""
+        transport.default_window_size = self.window_size
+
+
+# Ciphers and packet sizes are left to paramiko: its preferred cipher
+# (aes128-ctr) already is the cheapest one it offers for the tablet's ARM CPU
+# and the SFTP requests are limited to 32 KB anyways. The profiles differ in:
+# * usb: the fast link is CPU-bound, thus no compression at all. The large
+#   window keeps the pipelined SFTP requests flowing.
+# * wifi: a larger window than the default hides the higher latency and
+#   streamed archives are gzipped.
+# * slow-link: SSH compression (of mostly textual .rm/.json data and SVGs)
+#   pays off despite the CPU load. As it already covers all traffic, archives
+#   aren't gzipped additionally.
+TRANSPORT_PROFILES = {
+    'usb': TransportProfile(name='usb', compress=False, window_size=8 * 2**20),
+    'wifi': TransportProfile(
+        name='wifi', compress=False, window_size=4 * 2**20, stream_compression='gzip'),
+    'slow-link': TransportProfile(name='slow-link', compress=True, window_size=2 * 2**20),
+}
+
+
+def select_transport_profile(host: str, profile: str = 'auto') -> TransportProfile:
+    """Returns the requested transport profile. If profile is 'auto' (or not
+    set), we choose based on whether the host is the tablet's USB address."""
+    if profile is None or profile == 'auto':
+        profile = 'usb' if host == USB_HOST else 'wifi'
+    if profile not in TRANSPORT_PROFILES:
+        raise ValueError(
+            f"Unknown transport profile '{profile}', "
+            f"must be one of: auto, {', '.join(TRANSPORT_PROFILES.keys())}")
+    return TRANSPORT_PROFILES[profile]
@@ -3,6 +3,7 @@ from typing import List
 import npyscreen as nps
 import curses
 from remass.filesystem import RCollection, RDirEntry, RDocument, _RLink
+from remass.tui.utilities import open_with_default_application
 
 
 class RFileGrid(nps.SimpleGrid):
@@ -15,6 +16,7 @@ class RFileGrid(nps.SimpleGrid):
             curses.ascii.CR:    self.h_select_file,
             curses.ascii.SP:    self.h_select_file,
             curses.ascii.ESC:   self.abort_selection,
+            ord('p'):           self.h_preview_file,
         })
     
     def display_value(self, vl):
@@ -61,6 +63,16 @@ class RFileGrid(nps.SimpleGrid):
         else:
             self.change_dir(dirent)
 
+    def h_preview_file(self, *args, **keywords):
+        """Opens the thumbnail of the highlighted document (if available)."""
+        if self.parent.thumbnails is None:
+            return
+        dirent = self.values[self.edit_cell[0]][self.edit_cell[1]]
+        if dirent.dirent_type == RDocument.dirent_type:
+            fname = self.parent.thumbnails.get(dirent)
+            if fname is not None:
+                open_with_default_application(fname)
+
     def abort_selection(self, _input):
         self.parent.selected_file = None
         self.h_exit_down(None)
@@ -96,8 +108,9 @@ class RFileSelector(nps.FormBaseNew):
                  rm_dirents, 
                  starting_value: RDirEntry = None,  # Pre-select the starting file node (will switch to the parent container if it's a document)
                  select_dir: bool = True,  # Select a directory if True, otherwise select a file
-                 *args, **keywords):
+                 *args, thumbnails=None, **keywords):
         self.rm_dirents = rm_dirents
+        self.thumbnails = thumbnails  # Optional ThumbnailCache to preview documents
         self.select_dir = select_dir
         self.selected_folder = None
         self.selected_file = None
@@ -133,10 +146,14 @@ class RFileSelector(nps.FormBaseNew):
         if isinstance(self.selected_folder, _RLink) and self.selected_folder.uuid is None:
             self.selected_folder = None
         if self.selected_folder is None:
+            # Top-level view, the user will most likely open "My Files" next
+            dirent = self.rm_dirents['root']
             file_list = [self.rm_dirents['root'], self.rm_dirents['trash']]
         else:
             dirent = self.rm_dirents[self.selected_folder.uuid]
             file_list = [_RLink(dirent.parent_uuid, '..', dirent.version, None)] + dirent.children
+        if self.thumbnails is not None:
+            self.thumbnails.prefetch(dirent)
         self.wMain.set_grid_values(file_list, reset_cursor=False, max_cols=3)
         self.display()
 
@@ -144,8 +161,8 @@ class RFileSelector(nps.FormBaseNew):
         self.update_grid()
 
 
-def selectRFile(rm_dirents, starting_value=None, select_dir=False, *args, **keywords):
-    F = RFileSelector(rm_dirents, starting_value, *args, **keywords)
+def selectRFile(rm_dirents, starting_value=None, select_dir=False, *args, thumbnails=None, **keywords):
+    F = RFileSelector(rm_dirents, starting_value, *args, thumbnails=thumbnails, **keywords)
     F.update_grid()
     F.display()
     F.edit()    
@@ -155,9 +172,11 @@ def selectRFile(rm_dirents, starting_value=None, select_dir=False, *args, **keyw
 class RFilenameCombo(nps.ComboBox):
     """You can EITHER select a notebook/document OR a folder, depending on how
     you set select_dir"""
-    def __init__(self, screen, rm_dirents: List[RDirEntry], select_dir: bool, *args, when_value_edited_cb=None, **keywords):
+    def __init__(self, screen, rm_dirents: List[RDirEntry], select_dir: bool, *args, when_value_edited_cb=None,
+                 thumbnails=None, **keywords):
         self.select_dir = select_dir
         self.rm_dirents = rm_dirents
+        self.thumbnails = thumbnails
         self.when_value_edited_cb = when_value_edited_cb
         super(RFilenameCombo, self).__init__(screen, *args, **keywords)
 
@@ -182,7 +201,8 @@ class RFilenameCombo(nps.ComboBox):
         self.value = selectRFile(
             rm_dirents = self.rm_dirents,
             starting_value = self.value,
-            select_dir = self.select_dir)
+            select_dir = self.select_dir,
+            thumbnails = self.thumbnails)
         self.display()
 
 
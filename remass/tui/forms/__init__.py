@@ -3,3 +3,4 @@ from remass.tui.forms.export import ExportForm
 from remass.tui.forms.screens import ScreenCustomizationForm
 from remass.tui.forms.templates import TemplateSynchronizationForm, TemplateRemovalForm
 from remass.tui.forms.device import DeviceSettingsForm
+from remass.tui.forms.metrics import MetricsForm
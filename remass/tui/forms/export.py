@@ -12,6 +12,7 @@ from remass.tui.fileselect import TitleRFilenameCombo
 from remass.tablet import TabletConnection
 from remass.config import RemassConfig, abbreviate_user
 from remass.filesystem import RDocument
+from remass.thumbnails import ThumbnailCache
 
 
 class ExportForm(nps.ActionFormMinimal):
@@ -20,6 +21,7 @@ class ExportForm(nps.ActionFormMinimal):
         self._cfg = cfg
         self._connection = connection
         self.fs_root, self.fs_trash, self.fs_dirents = self._connection.get_filesystem()
+        self.thumbnails = ThumbnailCache(cfg, connection)
         self.export_thread = None
         self.is_exporting = False
         # As long as the user has not manually set a local output file name, we
@@ -45,7 +47,7 @@ class ExportForm(nps.ActionFormMinimal):
             TitleRFilenameCombo, name="reMarkable Notebook", label=True,
             when_value_edited_cb=self._on_remote_file_selected,
             rm_dirents=self.fs_dirents, select_dir=False, relx=4,
-            begin_entry_at=24)
+            thumbnails=self.thumbnails, begin_entry_at=24)
         self.select_local = self.add(
             TitleCustomFilenameCombo, name="Output PDF",
             when_value_edited_cb=self._on_local_file_selected,
@@ -0,0 +1,94 @@
+"""Connection Metrics (hidden form, accessible via ^P from the main screen)"""
+import npyscreen as nps
+import os
+
+from remass.tui.utilities import add_empty_row
+from remass.tablet import TabletConnection
+from remass.config import RemassConfig, abbreviate_user
+
+
+class MetricsForm(nps.ActionFormMinimal):
+    OK_BUTTON_TEXT = 'Back'
+    def __init__(self, cfg: RemassConfig, connection: TabletConnection, *args, **kwargs):
+        self._cfg = cfg
+        self._connection = connection
+        super().__init__(*args, **kwargs)
+
+    def on_ok(self):
+        self._to_main()
+
+    def create(self):
+        self.add_handlers({
+            "^X": self.exit_application,
+            "^B": self._to_main
+        })
+        self.lbl_status = self.add(nps.Textfield, value='', editable=False, color='STANDOUT')
+        add_empty_row(self)
+        self.table = self.add(nps.Pager, max_height=-6, relx=4, scroll_exit=True)
+        self.btn_toggle = self.add(nps.ButtonPress, name='', relx=3,
+                                   when_pressed_function=self._toggle_metrics)
+        self.add(nps.ButtonPress, name='[Refresh]', relx=3,
+                 when_pressed_function=self._update_widgets)
+        self.add(nps.ButtonPress, name='[Reset]', relx=3,
+                 when_pressed_function=self._reset)
+        self.add(nps.ButtonPress, name='[Save as JSON/Prometheus]', relx=3,
+                 when_pressed_function=self._save)
+        self._update_widgets()
+
+    def _update_widgets(self, *args, **kwargs):
+        metrics = self._connection.metrics
+        if metrics is None:
+            self.lbl_status.value = 'Metrics collection is disabled.'
+            self.btn_toggle.name = '[Enable Metrics]'
+            self.table.values = list()
+        else:
+            # Bytes are measured on the shared SSH socket
+            self.lbl_status.value = 'Metrics collected since enabling/resetting (bytes of concurrent operations overlap):'
+            self.btn_toggle.name = '[Disable Metrics]'
+            lines = [f"{'Method':<24s}{'Calls':>7s}{'Avg [ms]':>10s}{'Sent [KB]':>11s}"
+                     f"{'Recv [KB]':>11s}{'Exec':>6s}{'SFTP':>7s}"]
+            for op, om in metrics.snapshot().items():
+                avg_ms = 1000 * om.total_seconds / max(1, om.calls)
+                lines.append(f'{op:<24s}{om.calls:>7d}{avg_ms:>10.1f}'
+                             f'{om.bytes_sent / 1024:>11.1f}{om.bytes_received / 1024:>11.1f}'
+                             f'{om.exec_round_trips:>6d}{om.sftp_round_trips:>7d}')
+            self.table.values = lines
+        super().display(clear=True)
+
+    def _toggle_metrics(self, *args, **kwargs):
+        if self._connection.metrics is None:
+            self._connection.enable_metrics()
+        else:
+            self._connection.disable_metrics()
+        self._update_widgets()
+
+    def _reset(self, *args, **kwargs):
+        if self._connection.metrics is not None:
+            self._connection.metrics.reset()
+        self._update_widgets()
+
+    def _save(self, *args, **kwargs):
+        metrics = self._connection.metrics
+        if metrics is None:
+            nps.notify_confirm('Metrics collection is disabled.', title='Error',
+                               form_color='CAUTION', editw=1)
+            return
+        fn_json = os.path.join(self._cfg.export_dir, 'remass-metrics.json')
+        fn_prom = os.path.join(self._cfg.export_dir, 'remass-metrics.prom')
+        with open(fn_json, 'w') as f:
+            f.write(metrics.to_json())
+        with open(fn_prom, 'w') as f:
+            f.write(metrics.to_prometheus())
+        nps.notify_confirm(f"Metrics have been saved to:\n{abbreviate_user(fn_json)}\n"
+                           f"{abbreviate_user(fn_prom)}",
+                           title='Info', form_color='STANDOUT', editw=1)
+
+    def exit_application(self, *args, **kwargs):
+        self.parentApp.setNextForm(None)
+        self.editing = False
+        self.parentApp.switchFormNow()
+
+    def _to_main(self, *args, **kwargs):
+        self.parentApp.setNextForm('MAIN')
+        self.editing = False
+        self.parentApp.switchFormNow()
@@ -5,7 +5,8 @@ import os
 from remass.tui.utilities import add_empty_row, open_with_default_application
 from remass.tui.widgets import TitleCustomFilenameCombo
 from remass.tablet import TabletConnection, SplashScreenUtil, NotEnoughDiskSpaceError
-from remass.config import RemassConfig, abbreviate_user, next_backup_filename
+from remass.config import RemassConfig, abbreviate_user, next_backup_filename, prune_backups
+from remass.screens import convert_screen
 
 
 class ScreenCustomizationForm(nps.ActionFormMinimal):
@@ -31,6 +32,8 @@ class ScreenCustomizationForm(nps.ActionFormMinimal):
         add_empty_row(self)
         self.add(nps.ButtonPress, name='[Validate Image]', relx=3,
                 when_pressed_function=self._validate_image)
+        self.add(nps.ButtonPress, name='[Convert Image]', relx=3,
+                when_pressed_function=self._convert_image)
         self.add(nps.ButtonPress, name='[Open Image Viewer]', relx=3,
                 when_pressed_function=self._open_image)
         add_empty_row(self)
@@ -62,6 +65,25 @@ class ScreenCustomizationForm(nps.ActionFormMinimal):
                                form_color='STANDOUT', editw=1)
         return True
 
+    def _convert_image(self, *args, **kwargs):
+        fname = self.screen_filename.filename
+        if fname is None or not os.path.exists(fname):
+            nps.notify_confirm('You must select an image file first.', title='Error',
+                               form_color='CAUTION', editw=1)
+            return
+        stem, _ = os.path.splitext(os.path.basename(fname))
+        dst = os.path.join(self._cfg.screen_dir, stem + '-screen.png')
+        try:
+            convert_screen(fname, dst)
+        except (OSError, ValueError) as e:
+            nps.notify_confirm(f'Cannot convert image:\n{e}', title='Error',
+                               form_color='CAUTION', editw=1)
+            return
+        self.screen_filename.value = dst
+        self.display()
+        nps.notify_confirm(f'Image has been converted to:\n{abbreviate_user(dst)}',
+                           title='Info', form_color='STANDOUT', editw=1)
+
     def _open_image(self, *args, **kwargs):
         fname = self.screen_filename.filename
         if fname is None or not os.path.exists(fname):
@@ -75,6 +97,7 @@ class ScreenCustomizationForm(nps.ActionFormMinimal):
         remote_file = SplashScreenUtil.tablet_screen_filename(screen_selection)
         bak_file = next_backup_filename(screen_selection[0], self._cfg.screen_backup_dir)
         self._connection.download_file(remote_file, bak_file)
+        prune_backups(screen_selection[0], self._cfg.screen_backup_dir, **self._cfg['backups'])
         nps.notify_confirm(f"'{screen_selection[1]}' screen has been sucessfully backed up to:\n"
                            f"{abbreviate_user(bak_file)}",
                            title='Info', form_color='STANDOUT', editw=1)
@@ -86,7 +109,12 @@ class ScreenCustomizationForm(nps.ActionFormMinimal):
         screen_selection = SplashScreenUtil.SCREENS[self.rm_screen.value[0]]
         remote_file = SplashScreenUtil.tablet_screen_filename(screen_selection)
         try:
-            self._connection.upload_file(self.screen_filename.filename, remote_file)
+            # Skipped if the tablet already shows this screen (checksums
+            # are compared via a single command)
+            if not self._connection.upload_file(self.screen_filename.filename, remote_file):
+                nps.notify_confirm(f"The tablet already uses this image as '{screen_selection[1]}' screen.",
+                                   title='Info', form_color='STANDOUT', editw=1)
+                return True
             nps.notify_confirm(f"'{screen_selection[1]}' screen has been sucessfully uploaded.\n"
                                "Please restart the UI/reboot the table to use it.",
                                title='Info', form_color='STANDOUT', editw=1)
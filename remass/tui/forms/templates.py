@@ -1,4 +1,5 @@
 """Screen Customization"""
+import logging
 import npyscreen as nps
 
 from remass.tui.utilities import add_empty_row
@@ -30,6 +31,8 @@ class TemplateSynchronizationForm(nps.ActionFormMinimal):
         add_empty_row(self)
         self.btn_load = self.add(nps.ButtonPress, name='[Download Templates From Tablet]', relx=3,
                                  when_pressed_function=self._download_templates)
+        self.btn_previews = self.add(nps.ButtonPress, name='[Render Template Previews]', relx=3,
+                                     when_pressed_function=self._render_previews)
         add_empty_row(self)
         self.lbl_uploads = self.add(nps.Textfield, value='', editable=False, color='STANDOUT')
         self.select_uploads = self.add(nps.TitleMultiSelect, max_height=-4, name='Select for Upload',
@@ -45,11 +48,12 @@ class TemplateSynchronizationForm(nps.ActionFormMinimal):
         lbl = f'Templates available on PC: {len(backed_up)}'
         self.lbl_backups.value = lbl
 
-        remote = self._organizer.load_remote_templates()
+        remote = self._organizer.get_remote_catalog()
         self.lbl_remote.value = f'Templates available on Tablet: {len(remote)}'
 
         uploadable = self._organizer.load_uploadable_templates()
-        lbl = f'Custom Templates for Upload: {len(uploadable)}'
+        num_new = len([u for u in uploadable if u not in remote])
+        lbl = f'Custom Templates for Upload: {len(uploadable)} ({num_new} not on tablet)'
         self.lbl_uploads.value = lbl
 
         
@@ -66,6 +70,21 @@ class TemplateSynchronizationForm(nps.ActionFormMinimal):
                            title='Info', form_color='STANDOUT', editw=1)
         self._update_widgets()
 
+    def _render_previews(self, *args, **kwargs):
+        # Render previews of new/changed SVGs, so they become uploadable.
+        # Warnings about unrenderable SVGs would be written over the curses
+        # screen, so we only report the number of rendered previews.
+        previous_disable = logging.root.manager.disable
+        logging.disable(max(previous_disable, logging.WARNING))
+        try:
+            rendered = self._organizer.generate_previews()
+        finally:
+            logging.disable(previous_disable)
+        nps.notify_confirm(f"Rendered {len(rendered)} template previews in\n"
+                           f"{abbreviate_user(self._cfg.template_dir)}",
+                           title='Info', form_color='STANDOUT', editw=1)
+        self._update_widgets()
+
     def _upload_templates(self, *args, **kwargs):
         to_upload = [self._uploadable[i] for i in self.select_uploads.value]
         if len(to_upload) > 0:
@@ -115,12 +134,12 @@ class TemplateRemovalForm(nps.ActionFormMinimal):
         self._update_widgets()
     
     def _update_widgets(self):
-        remote = self._organizer.load_remote_templates()
+        remote = self._organizer.get_remote_catalog()
         lbl = f'Templates available on Tablet: {len(remote)}'
         self.lbl_remote.value = lbl
         
         if len(remote) != len(self._remote_templates):
-            self._remote_templates= remote
+            self._remote_templates = remote.sorted()
             lbls = [template_name(u) for u in self._remote_templates]
             self.select_templates.values = lbls
             self.select_templates.value = [i for i in range(len(self._remote_templates))]
@@ -8,7 +8,8 @@ from remass import __version__ as remass_version
 from remass.tablet import TabletConnection
 from remass.config import RemassConfig
 from remass.tui.forms import StartUpForm, ExportForm, ScreenCustomizationForm,\
-    TemplateSynchronizationForm, TemplateRemovalForm, DeviceSettingsForm
+    TemplateSynchronizationForm, TemplateRemovalForm, DeviceSettingsForm,\
+    MetricsForm
 
 
 ###############################################################################
@@ -45,15 +46,14 @@ class MainForm(nps.ActionFormMinimal):
     def update_device_info(self):
         if self._connection.is_connected():
             max_text_width = 22
-            hostname = self._connection.get_hostname()
-            self._info_lbl.value = f"Connected to '{hostname}':"
-            self._tablet_model.value = self._connection.get_tablet_model().rjust(max_text_width)
-            self._tablet_fwver.value = self._connection.get_firmware_version().rjust(max_text_width)
-            self._tablet_free_space_root.value = self._connection.get_free_space_str('/').rjust(max_text_width)
-            self._tablet_free_space_home.value = self._connection.get_free_space_str('/home').rjust(max_text_width)
-            self._tablet_uptime.value = self._connection.get_uptime().rjust(max_text_width)
-            bcap, bhealth, btemp = self._connection.get_battery_info()
-            self._tablet_battery_info.value = f'{bcap} ({bhealth}), {btemp}'.rjust(max_text_width)
+            status = self._connection.get_device_status()
+            self._info_lbl.value = f"Connected to '{status.hostname}':"
+            self._tablet_model.value = status.model.rjust(max_text_width)
+            self._tablet_fwver.value = status.firmware.rjust(max_text_width)
+            self._tablet_free_space_root.value = status.free_space_root.rjust(max_text_width)
+            self._tablet_free_space_home.value = status.free_space_home.rjust(max_text_width)
+            self._tablet_uptime.value = status.uptime.rjust(max_text_width)
+            self._tablet_battery_info.value = f'{status.battery_capacity} ({status.battery_health}), {status.battery_temperature}'.rjust(max_text_width)
         else:
             self._info_lbl.value = '[ERROR] Not Connected!'
         super().display(clear=True)
@@ -64,7 +64,8 @@ class MainForm(nps.ActionFormMinimal):
             "^E": self._switch_form_export,
             "^T": self._switch_form_template_sync,
             "^R": self._switch_form_template_del,
-            "^S": self._switch_form_screens
+            "^S": self._switch_form_screens,
+            "^P": self._switch_form_metrics  # Hidden, there's no button for this form
         })
         self._info_lbl = self.add(
             nps.Textfield, value="", editable=False, color='STANDOUT')
@@ -149,6 +150,11 @@ class MainForm(nps.ActionFormMinimal):
         self.editing = False
         self.parentApp.switchFormNow()
 
+    def _switch_form_metrics(self, *args, **kwargs):
+        self.parentApp.setNextForm('METRICS')
+        self.editing = False
+        self.parentApp.switchFormNow()
+
     def _switch_form_export(self, *args, **kwargs):
         self.parentApp.setNextForm('EXPORT')
         self.editing = False
@@ -201,6 +207,9 @@ class RATui(nps.NPSAppManaged):
         self.addFormClass(
             'CONTROL', DeviceSettingsForm, self._cfg, self._connection,
             name=f'Device Settings - {vers_str}')
+        self.addFormClass(
+            'METRICS', MetricsForm, self._cfg, self._connection,
+            name=f'Connection Metrics - {vers_str}')
 
     def onCleanExit(self):
         self._connection.close()
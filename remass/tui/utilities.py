@@ -3,6 +3,8 @@ import npyscreen as nps
 import platform
 import os
 import subprocess
+# Re-exported for existing imports, the implementation is UI-independent
+from remass.utilities import safe_filename
 
 
 def add_empty_row(form: nps.Form) -> None:
@@ -20,36 +22,6 @@ def full_class_name(o: object):
     return module + '.' + o.__class__.__name__
 
 
-def safe_filename(fname: str) -> str:
-    """
-    Replaces all special (ASCII-only) characters in the given filename.
-    Note that this will also replace path separators if present.
-    """
-    replacements = {
-        '/': '_',
-        '\\': '_',
-        ':': '_',
-        '?': '-',
-        '!': '-',
-        '*': '-',
-        ' ': '-',
-        '%': '_',
-        '$': '_',
-        '|': '',
-        '"': '',
-        '<': '',
-        '>': ''
-    }
-    for needle, rep in replacements.items():
-        fname = fname.replace(needle, rep)
-    
-    if platform.system() == 'Windows':
-        # Filenames mustn't end with a dot on windows
-        if fname[-1] == '.':
-            return fname[:-1]
-    return fname
-
-
 def open_with_default_application(filename: str) -> None:
     """Opens the given file/folder with the system's default application."""
     if platform.system() == 'Darwin':
@@ -0,0 +1,32 @@
+"""Utilities which are shared by the TUI and the (non-interactive) API."""
+import platform
+
+
+def safe_filename(fname: str) -> str:
+    """
+    Replaces all special (ASCII-only) characters in the given filename.
+    Note that this will also replace path separators if present.
+    """
+    replacements = {
+        '/': '_',
+        '\\': '_',
+        ':': '_',
+        '?': '-',
+        '!': '-',
+        '*': '-',
+        ' ': '-',
+        '%': '_',
+        '$': '_',
+        '|': '',
+        '"': '',
+        '<': '',
+        '>': ''
+    }
+    for needle, rep in replacements.items():
+        fname = fname.replace(needle, rep)
+    
+    if platform.system() == 'Windows':
+        # Filenames mustn't end with a dot on windows
+        if fname[-1] == '.':
+            return fname[:-1]
+    return fname
@@ -24,11 +24,12 @@ setuptools.setup(
         'appdirs',
         'dataclasses',
         'npyscreen',
+        'numpy',
         'paramiko',
         'Pillow',
         'pdf2image',
         'pdfrw>=0.4',
-        'reportlab>=3.5.59',
+        'reportlab>=3.5.59,<4',
         'svglib>=1.0.1',
         'xdg',
         'rmrl @ git+https://github.com/snototter/rmrl.git',
@@ -0,0 +1,25 @@
+import os
+import pytest
+from remass.tablet import TabletConnection
+from remass.testserver import TabletServer, create_tablet_tree
+
+
+@pytest.fixture
+def tablet(tmp_path):
+    """Yields (server, connection) of a stand-in tablet."""
+    root = str(tmp_path / 'root')
+    create_tablet_tree(root, num_notebooks=1, num_pages=1, num_pdfs=1, num_templates=1)
+    with TabletServer(root) as srv:
+        connection = TabletConnection({'connection': srv.connection_config()})
+        connection.open()
+        try:
+            yield srv, connection
+        finally:
+            connection.close()
+
+
+def local_file(folder, name, content):
+    fn = os.path.join(str(folder), name)
+    with open(fn, 'wb') as f:
+        f.write(content)
+    return fn
@@ -0,0 +1,69 @@
+import os
+import pytest
+from remass.tablet import RemoteCommandError, TabletConnection
+from remass.testserver import _local
+from conftest import local_file
+
+
+TEMPLATE_DIR = '/usr/share/remarkable/templates'
+STAGING_DIR = '/usr/share/remarkable/remass-staging'
+# Template names of third-party packs may contain shell metacharacters
+NAMES = ['quote".svg', 'dollar $(touch pwned).svg', 'backtick `touch pwned`.svg', "single 'q'.svg"]
+
+
+def _remote(name):
+    return f'{TEMPLATE_DIR}/{name}'
+
+
+def _read(srv, name):
+    with open(_local(srv.root, _remote(name)), 'rb') as f:
+        return f.read()
+
+
+def _prepare(srv, tmp_path):
+    """Creates the originals on the tablet and returns the files to deploy."""
+    files = list()
+    for idx, name in enumerate(NAMES):
+        if idx % 2 == 0:
+            local_file(os.path.dirname(_local(srv.root, _remote(name))), name, b'original')
+        files.append((local_file(tmp_path, f'{idx}.svg', f'new {idx}'.encode()), _remote(name)))
+    return files
+
+
+def _assert_no_injection(srv):
+    for dirpath, _dirs, filenames in os.walk(srv.root):
+        assert 'pwned' not in filenames, dirpath
+
+
+def test_deploy_metacharacters(tablet, tmp_path):
+    srv, connection = tablet
+    files = _prepare(srv, tmp_path)
+    connection.deploy_files(files, STAGING_DIR)
+    for idx, name in enumerate(NAMES):
+        assert _read(srv, name) == f'new {idx}'.encode()
+    assert not os.path.exists(_local(srv.root, STAGING_DIR))
+    _assert_no_injection(srv)
+
+
+def test_recover_metacharacters(tablet, tmp_path, monkeypatch):
+    srv, connection = tablet
+    files = _prepare(srv, tmp_path)
+    exec_checked = TabletConnection._exec_checked
+
+    def _interrupted_swap(self, cmd, error_msg):
+        # The files are swapped, but the connection drops before the
+        # deployment is committed
+        exec_checked(self, cmd, error_msg)
+        if cmd.startswith('/bin/mv') and 'orig' not in cmd:
+            raise RemoteCommandError('connection lost')
+    monkeypatch.setattr(TabletConnection, '_exec_checked', _interrupted_swap)
+    with pytest.raises(RemoteCommandError):
+        connection.deploy_files(files, STAGING_DIR)
+    for idx, name in enumerate(NAMES):
+        if idx % 2 == 0:
+            assert _read(srv, name) == b'original'
+        else:
+            assert not os.path.exists(_local(srv.root, _remote(name)))
+    # The journal has been removed, i.e. there's nothing left to recover
+    assert not connection.recover_deployment(STAGING_DIR)
+    _assert_no_injection(srv)
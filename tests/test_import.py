@@ -0,0 +1,34 @@
+import os
+from reportlab.pdfgen import canvas
+from remass.filesystem import RDocument
+
+
+def _create_pdf(folder, name):
+    filename = os.path.join(str(folder), f'{name}.pdf')
+    pdf = canvas.Canvas(filename)
+    pdf.drawString(72, 720, name)
+    pdf.save()
+    return filename
+
+
+def _documents(connection, visible_name):
+    _root, _trash, dirents = connection.get_filesystem()
+    return [d for d in dirents.values()
+            if isinstance(d, RDocument) and d.visible_name == visible_name]
+
+
+def test_reimport_is_noop(tablet, tmp_path):
+    _srv, connection = tablet
+    document = _create_pdf(tmp_path, 'Import Test')
+    uuids = connection.import_documents([document], restart_ui=False)
+    assert len(uuids) == 1
+    assert connection.import_documents([document], restart_ui=False) == []
+    assert [d.uuid for d in _documents(connection, 'Import Test')] == uuids
+
+
+def test_reimport_without_skipping(tablet, tmp_path):
+    _srv, connection = tablet
+    document = _create_pdf(tmp_path, 'Import Test')
+    connection.import_documents([document], restart_ui=False)
+    connection.import_documents([document], skip_existing=False, restart_ui=False)
+    assert len(_documents(connection, 'Import Test')) == 2
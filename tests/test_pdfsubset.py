@@ -0,0 +1,309 @@
+import io
+import logging
+import zlib
+import pytest
+from pdfrw import PdfReader
+from remass.filesystem import REMOTE_XOCHITL_DIR, RemoteFile, RemoteFileSystemSource
+from remass.pdfsubset import LazyPdfReader, PdfSubsetError
+from remass.testserver import _local
+
+
+NUM_PAGES = 6
+# Padding of each page's content stream, so that transferring unselected
+# pages would be noticeable
+PADDING = 8 * 1024
+
+
+def _marker(idx, revision=0):
+    return b'PAGE-%03d-REV-%d' % (idx, revision)
+
+
+def _content(idx, revision=0):
+    return b'BT /F1 12 Tf 72 720 Td (' + _marker(idx, revision) + b') Tj ET\n'\
+        + b'%' + b'x' * PADDING + b'\n'
+
+
+def _png_up(data, columns):
+    """Encodes the rows with the PNG "Up" predictor (as /Predictor 12)."""
+    rows = [data[pos:pos + columns] for pos in range(0, len(data), columns)]
+    encoded = bytearray()
+    previous = bytes(columns)
+    for row in rows:
+        encoded.append(2)
+        encoded.extend((cur - prev) % 256 for cur, prev in zip(row, previous))
+        previous = row
+    return bytes(encoded)
+
+
+class _PdfBuilder(object):
+    """Writes PDF revisions object by object, so that the tests control the
+    file structure (xref tables/streams, object streams, updates)."""
+    def __init__(self):
+        self.data = bytearray(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+        # {page index: (start, end) of its content stream data}
+        self.content_ranges = dict()
+        self.startxref = None
+
+    def add(self, num, body, stream=None):
+        offset = len(self.data)
+        self.data += b'%d 0 obj\n' % num + body
+        if stream is not None:
+            self.data += b'\nstream\n'
+            start = len(self.data)
+            self.data += stream + b'\nendstream'
+        else:
+            start = None
+        self.data += b'\nendobj\n'
+        return offset, start
+
+    def add_content(self, num, idx, revision=0):
+        content = _content(idx, revision)
+        offset, start = self.add(num, b'<< /Length %d >>' % len(content), content)
+        self.content_ranges[idx] = (start, start + len(content))
+        return offset
+
+    def add_object_stream(self, num, objects):
+        """Stores {num: body} within an (uncompressed) object stream.
+        :return: xref entries of the compressed objects
+        """
+        header, bodies = list(), b''
+        for obj_num, body in objects.items():
+            header.append(b'%d %d' % (obj_num, len(bodies)))
+            bodies += body + b'\n'
+        header = b' '.join(header) + b'\n'
+        offset, _ = self.add(num, b'<< /Type /ObjStm /N %d /First %d /Length %d >>'
+                             % (len(objects), len(header), len(header) + len(bodies)),
+                             header + bodies)
+        entries = {obj_num: (2, num, idx) for idx, obj_num in enumerate(objects)}
+        entries[num] = (1, offset, 0)
+        return entries
+
+    def xref_table(self, entries, trailer):
+        self.startxref = len(self.data)
+        self.data += b'xref\n'
+        for num in sorted(entries):
+            self.data += b'%d 1\n%010d 00000 n \n' % (num, entries[num][1])
+        self.data += b'trailer\n' + trailer + b'\n'
+        self._finish()
+
+    def xref_stream(self, num, entries, trailer, size):
+        """Writes a FlateDecode'd xref stream with /W [1 3 1] and PNG predictors."""
+        entries = dict(entries)
+        entries[num] = (1, len(self.data), 0)
+        nums = sorted(entries)
+        rows = b''.join(bytes([entries[n][0]]) + entries[n][1].to_bytes(3, 'big')
+                        + bytes([entries[n][2]]) for n in nums)
+        index = b' '.join(b'%d 1' % n for n in nums)
+        stream = zlib.compress(_png_up(rows, 5))
+        self.startxref = len(self.data)
+        self.add(num, b'<< /Type /XRef /Size %d /W [1 3 1] /Index [%s] /Filter /FlateDecode '
+                 b'/DecodeParms << /Predictor 12 /Columns 5 >> /Length %d %s >>'
+                 % (size, index, len(stream), trailer), stream)
+        self._finish()
+
+    def _finish(self):
+        self.data += b'startxref\n%d\n%%%%EOF\n' % self.startxref
+
+    def bytes(self):
+        return bytes(self.data)
+
+
+def _page(idx, contents_num):
+    return (b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 445 594] /Rotate %d '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (90 * (idx % 2), contents_num))
+
+
+def _page_num(idx):
+    return 4 + 2 * idx
+
+
+def _base_objects():
+    kids = b' '.join(b'%d 0 R' % _page_num(idx) for idx in range(NUM_PAGES))
+    return {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, NUM_PAGES),
+        3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    }
+
+
+def build_pdf(structure):
+    """Creates a test PDF.
+    :structure: 'table' (xref table), 'stream' (xref stream & object
+                stream), 'hybrid' (xref table plus /XRefStm for the
+                compressed objects) or 'updated' (xref table plus an
+                incremental update, which replaces the content of page 2)
+    """
+    builder = _PdfBuilder()
+    size = 4 + 2 * NUM_PAGES
+    objects = _base_objects()
+    if structure in ('table', 'updated'):
+        entries = dict()
+        for num, body in objects.items():
+            entries[num] = (1, builder.add(num, body)[0], 0)
+        for idx in range(NUM_PAGES):
+            entries[_page_num(idx)] = (1, builder.add(_page_num(idx), _page(idx, _page_num(idx) + 1))[0], 0)
+            entries[_page_num(idx) + 1] = (1, builder.add_content(_page_num(idx) + 1, idx), 0)
+        builder.xref_table(entries, b'<< /Size %d /Root 1 0 R >>' % size)
+        if structure == 'updated':
+            # Second revision: page 2 gets a new content stream
+            prev = builder.startxref
+            offset_content = builder.add_content(size, 1, revision=1)
+            offset_page = builder.add(_page_num(1), _page(1, size))[0]
+            builder.xref_table({size: (1, offset_content, 0), _page_num(1): (1, offset_page, 0)},
+                               b'<< /Size %d /Root 1 0 R /Prev %d >>' % (size + 1, prev))
+        return builder
+    # Page dicts (and the document structure) are compressed objects
+    entries = dict()
+    for idx in range(NUM_PAGES):
+        entries[_page_num(idx) + 1] = (1, builder.add_content(_page_num(idx) + 1, idx), 0)
+    compressed = dict(objects)
+    compressed.update({_page_num(idx): _page(idx, _page_num(idx) + 1) for idx in range(NUM_PAGES)})
+    stream_entries = builder.add_object_stream(size, compressed)
+    if structure == 'stream':
+        entries.update(stream_entries)
+        builder.xref_stream(size + 1, entries, b'/Root 1 0 R', size + 2)
+    elif structure == 'hybrid':
+        # Readers which don't support xref streams only see the uncompressed
+        # objects, the others additionally load the /XRefStm section
+        entries[size] = stream_entries.pop(size)
+        xref_stm = len(builder.data)
+        builder.xref_stream(size + 1, stream_entries, b'', size + 2)
+        builder.data = builder.data[:builder.data.rfind(b'startxref')]
+        builder.xref_table(entries, b'<< /Size %d /Root 1 0 R /XRefStm %d >>' % (size + 2, xref_stm))
+    return builder
+
+
+class _RecordingStream(io.BytesIO):
+    """Records the (offset, length) of each read."""
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = list()
+
+    def read(self, size=-1):
+        offset = self.tell()
+        data = super().read(size)
+        self.reads.append((offset, len(data)))
+        return data
+
+
+def _overlap(ranges, start, end):
+    """Number of bytes within [start, end) which have been read."""
+    covered = set()
+    for offset, length in ranges:
+        covered.update(range(max(start, offset), min(end, offset + length)))
+    return len(covered)
+
+
+def _check_subset(data, selected, revision_of_page=lambda idx: 0):
+    reader = PdfReader(fdata=data)
+    assert len(reader.pages) == NUM_PAGES
+    for idx, page in enumerate(reader.pages):
+        assert page.MediaBox == ['0', '0', '445', '594']
+        assert int(page.Rotate) == 90 * (idx % 2)
+        if idx in selected:
+            assert _marker(idx, revision_of_page(idx)) in page.Contents.stream.encode('latin-1')
+        else:
+            assert page.Contents.stream == ''
+
+
+def _check_fetched(ranges, builder, selected, chunk_size):
+    for idx, (start, end) in builder.content_ranges.items():
+        fetched = _overlap(ranges, start, end)
+        if idx in selected:
+            assert fetched == end - start
+        else:
+            # Parsing the preceding object may read one chunk into an
+            # unselected page's content (as may reading the file's tail)
+            assert fetched <= chunk_size, f'content of page {idx + 1} was fetched'
+
+
+@pytest.mark.parametrize('structure', ['table', 'stream', 'hybrid', 'updated'])
+def test_subset(structure):
+    builder = build_pdf(structure)
+    stream = _RecordingStream(builder.bytes())
+    reader = LazyPdfReader(stream, len(builder.bytes()))
+    assert reader.num_pages == NUM_PAGES
+    selected = {1, 4}
+    subset = reader.subset(selected)
+    _check_subset(subset, selected, lambda idx: 1 if structure == 'updated' and idx == 1 else 0)
+    _check_fetched(stream.reads, builder, selected, 2 * LazyPdfReader.CHUNK_SIZE)
+
+
+def _truncated(data):
+    return data[:len(data) // 2]
+
+
+def _offset_xref(data):
+    startxref = data.rindex(b'startxref')
+    offset = int(data[startxref:].split()[1])
+    return data[:startxref] + b'startxref\n%d\n%%%%EOF\n' % (offset + 7)
+
+
+def _encrypted(data):
+    return data.replace(b'/Root 1 0 R', b'/Root 1 0 R /Encrypt << /Filter /Standard >>')
+
+
+@pytest.mark.parametrize('damage', [_truncated, _offset_xref, _encrypted])
+def test_unsupported(damage):
+    data = damage(build_pdf('table').bytes())
+    with pytest.raises(PdfSubsetError):
+        LazyPdfReader(io.BytesIO(data), len(data))
+
+
+def _store_base_pdf(srv, data, doc_id='subset-test'):
+    filename = _local(srv.root, f'{REMOTE_XOCHITL_DIR}/{doc_id}.pdf')
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return doc_id
+
+
+def test_remote_subset(tablet, monkeypatch):
+    srv, connection = tablet
+    builder = build_pdf('stream')
+    doc_id = _store_base_pdf(srv, builder.bytes())
+    fetched = list()
+    fetch_blocks = RemoteFile._fetch_blocks
+
+    def _recording_fetch_blocks(self, indices):
+        indices = list(indices)
+        fetched.extend((idx * self.block_size, self.block_size)
+                       for idx in indices if idx not in self._blocks)
+        return fetch_blocks(self, indices)
+    monkeypatch.setattr(RemoteFile, '_fetch_blocks', _recording_fetch_blocks)
+    with connection.sftp_session() as sftp:
+        src = RemoteFileSystemSource(sftp, doc_id, [(2, 2), (-1, -1)])
+        pdf = src.open('{ID}.pdf', 'rb')
+        assert isinstance(pdf, io.BytesIO)
+        selected = {1, NUM_PAGES - 1}
+        _check_subset(pdf.read(), selected)
+    assert src.num_pages == NUM_PAGES
+    assert src.placeholder_pages == set(range(NUM_PAGES)) - selected
+    # Blocks are aligned, i.e. a block may cover the start of the next content
+    _check_fetched(fetched, builder, selected,
+                   2 * LazyPdfReader.CHUNK_SIZE + 2 * RemoteFileSystemSource.PDF_BLOCK_SIZE)
+    assert sum(length for _, length in fetched) < len(builder.bytes()) / 2
+
+
+@pytest.mark.parametrize('damage', [_truncated, _offset_xref, _encrypted])
+def test_remote_fallback(tablet, caplog, damage):
+    srv, connection = tablet
+    data = damage(build_pdf('updated').bytes())
+    doc_id = _store_base_pdf(srv, data)
+    with caplog.at_level(logging.WARNING), connection.sftp_session() as sftp:
+        src = RemoteFileSystemSource(sftp, doc_id, [(1, 1)])
+        pdf = src.open('{ID}.pdf', 'rb')
+        assert isinstance(pdf, RemoteFile)
+        assert pdf.read() == data
+        pdf.close()
+    assert src.placeholder_pages == set()
+    assert any('Cannot subset base PDF' in r.getMessage() for r in caplog.records)
+
+
+def test_fixture_structures():
+    # Sanity check of the fixtures via an independent reader (pdfrw doesn't
+    # support the /XRefStm of hybrid files)
+    for structure in ('table', 'stream', 'updated'):
+        reader = PdfReader(fdata=build_pdf(structure).bytes())
+        assert len(reader.pages) == NUM_PAGES, structure
+        expected = _marker(1, 1 if structure == 'updated' else 0)
+        assert expected in reader.pages[1].Contents.stream.encode('latin-1'), structure